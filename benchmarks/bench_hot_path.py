@@ -0,0 +1,329 @@
+"""
+Benchmarks for the bridge's message hot path.
+
+Covers route table construction and topic lookup in TopicMatcher against a
+realistic wlanpi-core OpenAPI document, MQTTResponse construction and
+serialization, and the full Bridge.handle_message path against a local stub
+core and an in-process fake MQTT client.
+
+Run from the repository root:
+
+    python benchmarks/bench_hot_path.py
+    python benchmarks/bench_hot_path.py --json bench.json
+    python benchmarks/bench_hot_path.py --baseline bench.json --tolerance 0.2
+
+With --baseline, the run fails if any benchmark's throughput falls more than
+--tolerance below the baseline's.
+"""
+
+import argparse
+import json
+import logging
+import random
+import re
+import sys
+import threading
+import time
+from typing import Callable, Optional
+
+from common import (
+    FakeMessage,
+    FakeMQTTClient,
+    Result,
+    StubCore,
+    load_openapi_definition,
+    make_interfaces_response,
+    print_results,
+    time_calls,
+)
+
+from wlanpi_mqtt_bridge.MQTTBridge.AsyncCoreClient import CoreResponse
+from wlanpi_mqtt_bridge.MQTTBridge.Bridge import Bridge
+from wlanpi_mqtt_bridge.MQTTBridge.structures import (
+    BridgeConfig,
+    MQTTResponse,
+    Route,
+)
+from wlanpi_mqtt_bridge.MQTTBridge.TopicMatcher import TopicMatcher
+
+IDENTIFIER = "dc:a6:32:8e:04:17"
+MY_BASE_TOPIC = f"wlan-pi/{IDENTIFIER}"
+GLOBAL_BASE_TOPIC = "wlan-pi/all"
+PATH_PARAMETER_VALUES = ["eth0", "wlan0", "100", "2", "AA:BB:CC:DD:EE:FF", "up"]
+
+
+def build_matcher(openapi_definition: dict, **kwargs) -> TopicMatcher:
+    """Registers routes the same way Bridge.add_routes_from_openapi_definition does"""
+    matcher = TopicMatcher(**kwargs)
+    for uri, action in openapi_definition["paths"].items():
+        for method in action:
+            topic = f"{uri}/{method}"
+            my_route = Route(route=uri, topic=f"{MY_BASE_TOPIC}{topic}", method=method)
+            matcher.add_route(my_route)
+            matcher.add_route(
+                Route(
+                    route=uri,
+                    topic=f"{GLOBAL_BASE_TOPIC}{topic}",
+                    response_topic=my_route.response_topic,
+                    method=method,
+                )
+            )
+    return matcher
+
+
+def make_topics(openapi_definition: dict, count: int = 200) -> list[str]:
+    """Builds concrete command topics, with path parameters filled in"""
+    rng = random.Random(1234)
+    templates = [
+        f"{base}{uri}/{method}"
+        for uri, action in openapi_definition["paths"].items()
+        for method in action
+        for base in (MY_BASE_TOPIC, GLOBAL_BASE_TOPIC)
+    ]
+    return [
+        re.sub(r"{.+?}", lambda _: rng.choice(PATH_PARAMETER_VALUES), template)
+        for template in rng.choices(templates, k=count)
+    ]
+
+
+def cycle(items: list) -> Callable[[], object]:
+    """Returns a function that yields the items in turn, forever"""
+    state = {"index": 0}
+
+    def next_item():
+        index = state["index"]
+        state["index"] = (index + 1) % len(items)
+        return items[index]
+
+    return next_item
+
+
+def bench_matcher(openapi_definition: dict, iterations: int) -> list[Result]:
+    results = [
+        time_calls(
+            "matcher.add_route(full definition)",
+            lambda: build_matcher(openapi_definition),
+            iterations=max(10, iterations // 200),
+            warmup=2,
+            memory_iterations=5,
+        )
+    ]
+
+    topics = make_topics(openapi_definition)
+    modes = {
+        "tree": {},
+        "compiled": {"compiled": True},
+        "compiled+cache": {"compiled": True, "route_cache_size": 256},
+    }
+    for mode, kwargs in modes.items():
+        matcher = build_matcher(openapi_definition, **kwargs)
+        next_topic = cycle(topics)
+        results.append(
+            time_calls(
+                f"matcher.get_route_from_topic[{mode}]",
+                lambda: matcher.get_route_from_topic(next_topic()),
+                iterations=iterations,
+            )
+        )
+    return results
+
+
+def bench_response(iterations: int) -> list[Result]:
+    large_body = json.dumps(make_interfaces_response(count=64))
+    small_body = json.dumps({"status": "ok"})
+    results = []
+    for name, body in (("small", small_body), ("large", large_body)):
+        results.append(
+            time_calls(
+                f"MQTTResponse[{name}]",
+                lambda: MQTTResponse(
+                    data=body, rest_status=200, rest_reason="OK", bridge_ident="abc"
+                ),
+                iterations=iterations,
+            )
+        )
+        response = MQTTResponse(
+            data=body, rest_status=200, rest_reason="OK", bridge_ident="abc"
+        )
+        results.append(
+            time_calls(
+                f"MQTTResponse.to_json[{name}]",
+                response.to_json,
+                iterations=iterations,
+            )
+        )
+        core_response = CoreResponse(
+            status_code=200,
+            reason="OK",
+            content=body.encode(),
+            headers={"Content-Type": "application/json"},
+        )
+        results.append(
+            time_calls(
+                f"MQTTResponse.from_core_response.to_bytes[{name}]",
+                lambda: MQTTResponse.from_core_response(core_response).to_bytes(),
+                iterations=iterations,
+            )
+        )
+    return results
+
+
+def make_bridge(
+    base_url: str, openapi_definition: dict
+) -> tuple[Bridge, FakeMQTTClient]:
+    bridge = Bridge(
+        BridgeConfig(
+            identifier=IDENTIFIER,
+            wlan_pi_core_base_url=base_url,
+            openapi_cache_path=None,
+            route_snapshot_path=None,
+        )
+    )
+    client = FakeMQTTClient()
+    bridge.mqtt_client = client  # type: ignore[assignment]
+    bridge.add_routes_from_openapi_definition(openapi_definition)
+    bridge.dispatcher.start()
+    return bridge, client
+
+
+def bench_bridge(openapi_definition: dict, iterations: int) -> list[Result]:
+    topics = [
+        f"{MY_BASE_TOPIC}/api/v1/network/interfaces/get",
+        f"{GLOBAL_BASE_TOPIC}/api/v1/system/device/info/get",
+        f"{MY_BASE_TOPIC}/api/v1/network/ethernet/eth0/vlan/100/put",
+    ]
+    payload = json.dumps({"_bridge_ident": "bench", "name": "vlan100"}).encode()
+    iterations = max(50, iterations // 20)
+    results = []
+
+    with StubCore(openapi_definition) as core:
+        bridge, client = make_bridge(core.base_url, openapi_definition)
+        try:
+            # One message at a time: the latency of a single command, from
+            # arrival to its response being published.
+            done = threading.Event()
+            client.on_publish_hook = lambda topic, _: (
+                done.set() if topic.endswith("/_response") else None
+            )
+            next_topic = cycle(topics)
+
+            def one_message() -> None:
+                done.clear()
+                bridge.handle_message(client, None, FakeMessage(next_topic(), payload))
+                done.wait(5)
+
+            result = time_calls(
+                "Bridge.handle_message[sequential]",
+                one_message,
+                iterations=iterations,
+                warmup=20,
+                memory_iterations=50,
+            )
+            results.append(result)
+
+            # A burst of messages: throughput with the dispatcher saturated.
+            latencies: list[float] = []
+            started_at: dict[str, float] = {}
+            lock = threading.Lock()
+            remaining = threading.Semaphore(0)
+
+            def on_publish(topic: str, message) -> None:
+                if not topic.endswith("/_response"):
+                    return
+                ident = json.loads(message)["_bridge_ident"]
+                with lock:
+                    latencies.append(time.perf_counter() - started_at[ident])
+                remaining.release()
+
+            client.on_publish_hook = on_publish
+            messages = []
+            for i in range(iterations):
+                messages.append(
+                    FakeMessage(
+                        next_topic(), json.dumps({"_bridge_ident": f"m{i}"}).encode()
+                    )
+                )
+            started = time.perf_counter()
+            for i, message in enumerate(messages):
+                started_at[f"m{i}"] = time.perf_counter()
+                bridge.handle_message(client, None, message)
+            for _ in messages:
+                remaining.acquire(timeout=5)
+            results.append(
+                Result(
+                    "Bridge.handle_message[burst]",
+                    latencies,
+                    time.perf_counter() - started,
+                )
+            )
+        finally:
+            bridge.dispatcher.stop()
+            bridge.core_client.close()
+    return results
+
+
+def check_baseline(results: list[Result], baseline_path: str, tolerance: float) -> bool:
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = {entry["name"]: entry for entry in json.load(f)}
+    ok = True
+    for result in results:
+        previous = baseline.get(result.name)
+        if previous is None or not previous["ops_per_sec"]:
+            continue
+        change = result.ops_per_sec / previous["ops_per_sec"] - 1
+        if change < -tolerance:
+            ok = False
+            print(
+                f"REGRESSION: {result.name} {result.ops_per_sec:.1f} ops/s is "
+                f"{-change:.0%} below the baseline {previous['ops_per_sec']} ops/s"
+            )
+    return ok
+
+
+def setup_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument(
+        "--only",
+        choices=["matcher", "response", "bridge"],
+        action="append",
+        help="Only run the given benchmark group. May be repeated.",
+    )
+    parser.add_argument("--iterations", type=int, default=5000)
+    parser.add_argument("--json", dest="json_path", help="Write results to a file")
+    parser.add_argument("--baseline", help="Compare against a previous --json file")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument(
+        "--log-level",
+        default="WARNING",
+        help="Log level for the bridge while benchmarking",
+    )
+    return parser
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    args = setup_parser().parse_args(argv)
+    logging.basicConfig(level=args.log_level)
+    groups = args.only or ["matcher", "response", "bridge"]
+    openapi_definition = load_openapi_definition()
+
+    results: list[Result] = []
+    if "matcher" in groups:
+        results.extend(bench_matcher(openapi_definition, args.iterations))
+    if "response" in groups:
+        results.extend(bench_response(args.iterations))
+    if "bridge" in groups:
+        results.extend(bench_bridge(openapi_definition, args.iterations))
+
+    print_results(results)
+
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump([result.to_dict() for result in results], f, indent=2)
+
+    if args.baseline and not check_baseline(results, args.baseline, args.tolerance):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,153 @@
+"""
+Measures the memory held by the bridge's route table.
+
+Builds the TopicMatcher the way the bridge does (a route under the device's
+own base topic and one under wlan-pi/all for every operation in the
+wlanpi-core OpenAPI document), and reports what it costs with tracemalloc.
+The compiled table, which the bridge uses, is reported first; the plain tree
+it's compiled from is reported on its own below it.
+
+Run from the repository root:
+
+    python benchmarks/bench_memory.py
+    python benchmarks/bench_memory.py --scale 4 --json memory.json
+    python benchmarks/bench_memory.py --baseline benchmarks/data/memory_baseline.json
+
+--scale repeats the document's paths under extra API versions, to see how
+the table grows with the size of the API.
+
+With --baseline, each table's size is shown next to the baseline's, and the
+run fails if any grew more than --tolerance beyond it. The bundled
+memory_baseline.json was measured before Route and TopicNode were slimmed
+down, with the bundled document at --scale 1.
+"""
+
+import argparse
+import gc
+import json
+import logging
+import sys
+import tracemalloc
+from typing import Optional
+
+from bench_hot_path import build_matcher, make_topics
+from common import load_openapi_definition
+
+from wlanpi_mqtt_bridge.MQTTBridge.TopicMatcher import TopicMatcher
+
+
+def scale_definition(openapi_definition: dict, scale: int) -> dict:
+    """Repeats every path under /api/v2, /api/v3, ... up to `scale` copies"""
+    paths = dict(openapi_definition["paths"])
+    for version in range(2, scale + 1):
+        for uri, action in openapi_definition["paths"].items():
+            paths[uri.replace("/api/v1/", f"/api/v{version}/", 1)] = action
+    return {**openapi_definition, "paths": paths}
+
+
+def count_nodes(matcher: TopicMatcher) -> int:
+    count = 0
+    stack = [matcher]
+    while stack:
+        node = stack.pop()
+        count += 1
+        stack.extend(node.static_children.values())
+        stack.extend(node.dynamic_children)
+    return count
+
+
+def measure(openapi_definition: dict, compiled: bool) -> dict:
+    topics = make_topics(openapi_definition)
+    loggers_before = len(logging.Logger.manager.loggerDict)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        matcher = build_matcher(openapi_definition)
+        built, _ = tracemalloc.get_traced_memory()
+        if compiled:
+            matcher.compile()
+        gc.collect()
+        after, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    # Make sure the table actually works before reporting on it.
+    for topic in topics:
+        assert matcher.get_route_from_topic(topic) is not None, topic
+
+    routes = sum(len(action) for action in openapi_definition["paths"].values()) * 2
+    return {
+        "name": f"route table[{'compiled' if compiled else 'tree'}]",
+        "routes": routes,
+        "nodes": count_nodes(matcher),
+        "tree_kib": round((built - before) / 1024, 1),
+        "total_kib": round((after - before) / 1024, 1),
+        "peak_kib": round((peak - before) / 1024, 1),
+        "bytes_per_route": round((after - before) / routes),
+        "loggers_created": len(logging.Logger.manager.loggerDict) - loggers_before,
+    }
+
+
+def compare_baseline(results: list[dict], baseline_path: str, tolerance: float) -> bool:
+    """
+    Adds each result's size relative to the baseline's to it.
+    :return: Whether none grew by more than `tolerance`
+    """
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = {entry["name"]: entry for entry in json.load(f)}
+    ok = True
+    for result in results:
+        previous = baseline.get(result["name"])
+        if previous is None or previous["routes"] != result["routes"]:
+            continue
+        result["baseline_bytes_per_route"] = previous["bytes_per_route"]
+        change = result["bytes_per_route"] / previous["bytes_per_route"] - 1
+        result["change"] = f"{change:+.0%}"
+        if change > tolerance:
+            ok = False
+            print(
+                f"REGRESSION: {result['name']} {result['bytes_per_route']} bytes "
+                f"per route is {change:.0%} above the baseline "
+                f"{previous['bytes_per_route']}"
+            )
+    return ok
+
+
+def setup_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--scale", type=int, default=1)
+    parser.add_argument("--json", dest="json_path", help="Write results to a file")
+    parser.add_argument("--baseline", help="Compare against a previous --json file")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    return parser
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    args = setup_parser().parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    openapi_definition = scale_definition(load_openapi_definition(), args.scale)
+
+    results = [measure(openapi_definition, compiled) for compiled in (True, False)]
+    ok = True
+    if args.baseline:
+        ok = compare_baseline(results, args.baseline, args.tolerance)
+
+    columns = list(dict.fromkeys(column for result in results for column in result))
+    rows = [[str(result.get(column, "")) for column in columns] for result in results]
+    widths = [
+        max(len(column), *(len(row[i]) for row in rows))
+        for i, column in enumerate(columns)
+    ]
+    print("  ".join(column.ljust(width) for column, width in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(value.ljust(width) for value, width in zip(row, widths)))
+
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
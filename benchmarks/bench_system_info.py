@@ -0,0 +1,117 @@
+"""
+Compares the native system information readers with the commands they
+replace.
+
+Each collector the bridge uses (interface addresses, default gateways,
+uptime and MAC address) is timed both ways: reading the kernel directly
+(rtnetlink, /proc, /sys) and forking the command (`ip`, `jc`). CPU time
+includes child processes, so the cost of the fork and exec is counted.
+Commands that aren't installed are skipped.
+
+Run from the repository root:
+
+    python benchmarks/bench_system_info.py
+    python benchmarks/bench_system_info.py --iterations 500 --json system.json
+"""
+
+import argparse
+import json
+import os
+import sys
+from typing import Any, Callable, Optional
+
+from common import print_results, time_calls
+
+from wlanpi_mqtt_bridge.MQTTBridge import SystemInfo, Utils
+
+COLLECTORS: list[tuple[str, Callable[[], Any], Callable[[], Any]]] = [
+    (
+        "interface addresses",
+        SystemInfo.read_interface_addresses,
+        Utils.get_interface_ip_addr_from_command,
+    ),
+    (
+        "default gateways",
+        SystemInfo.read_default_gateways,
+        Utils.get_default_gateways_from_command,
+    ),
+    ("uptime", SystemInfo.read_uptime, Utils.get_uptime_from_command),
+    (
+        "mac address",
+        lambda: SystemInfo.read_mac_address("eth0"),
+        lambda: Utils.get_mac_address_from_command("eth0"),
+    ),
+]
+
+
+def cpu_seconds() -> float:
+    """CPU time used by this process and its finished children"""
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def cpu_per_call(func: Callable[[], Any], iterations: int) -> float:
+    started = cpu_seconds()
+    for _ in range(iterations):
+        func()
+    return (cpu_seconds() - started) / iterations
+
+
+def setup_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--json", dest="json_path", help="Write results to a file")
+    return parser
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    args = setup_parser().parse_args(argv)
+
+    results = []
+    cpu_costs = []
+    for name, native, command in COLLECTORS:
+        for method, func in (("native", native), ("command", command)):
+            try:
+                func()
+            except Exception as e:
+                print(f"Skipping {name}[{method}]: {e}")
+                continue
+            label = f"{name}[{method}]"
+            results.append(
+                time_calls(
+                    label,
+                    func,
+                    iterations=args.iterations,
+                    warmup=5,
+                    memory_iterations=10,
+                )
+            )
+            cpu_costs.append(
+                {
+                    "name": label,
+                    "cpu_us_per_call": round(
+                        cpu_per_call(func, args.iterations) * 1e6, 1
+                    ),
+                }
+            )
+
+    print_results(results)
+    print()
+    for cost in cpu_costs:
+        print(f"{cost['name']:<32}  {cost['cpu_us_per_call']:>10} us CPU/call")
+
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "results": [result.to_dict() for result in results],
+                    "cpu": cpu_costs,
+                },
+                f,
+                indent=2,
+            )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,258 @@
+"""
+Shared fixtures for the benchmarks: a stub wlanpi-core HTTP server, an
+in-process fake MQTT client, and timing/reporting helpers.
+"""
+
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Optional
+
+# Make the package importable when running from a checkout.
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+OPENAPI_PATH = os.path.join(DATA_DIR, "wlanpi_core_openapi.json")
+
+
+def load_openapi_definition() -> dict:
+    with open(OPENAPI_PATH, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def make_interfaces_response(count: int = 8) -> dict:
+    """Builds a response shaped like wlanpi-core's interface listing"""
+    interfaces = {}
+    for i in range(count):
+        name = f"eth{i}" if i < count // 2 else f"wlan{i - count // 2}"
+        interfaces[name] = {
+            "name": name,
+            "mac": f"dc:a6:32:8e:04:{i:02x}",
+            "state": "UP" if i % 3 else "DOWN",
+            "mtu": 1500,
+            "speed": 1000,
+            "addresses": [
+                {"family": "inet", "address": f"192.168.{i}.10", "prefixlen": 24},
+                {"family": "inet6", "address": f"fe80::{i:x}:1", "prefixlen": 64},
+            ],
+            "vlans": [{"id": 100 + v, "name": f"{name}.{100 + v}"} for v in range(3)],
+            "stats": {"rx_bytes": 123456789 * (i + 1), "tx_bytes": 98765432 * (i + 1)},
+        }
+    return {"interfaces": interfaces}
+
+
+class StubCoreHandler(BaseHTTPRequestHandler):
+    """Answers every request with a canned JSON body, over keep-alive."""
+
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes, which would otherwise
+    # stall on delayed ACKs.
+    disable_nagle_algorithm = True
+    openapi_body = b""
+    interfaces_body = json.dumps(make_interfaces_response()).encode()
+    small_body = json.dumps({"status": "ok"}).encode()
+
+    # noinspection PyShadowingBuiltins
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def send_body(self, body: bytes) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self) -> None:
+        length = int(self.headers.get("Content-Length", 0) or 0)
+        if length:
+            self.rfile.read(length)
+
+    def do_GET(self) -> None:
+        if self.path.startswith("/api/v1/openapi.json"):
+            self.send_body(self.openapi_body)
+        elif self.path.startswith("/api/v1/network/interfaces"):
+            self.send_body(self.interfaces_body)
+        else:
+            self.send_body(self.small_body)
+
+    def do_POST(self) -> None:
+        self.read_body()
+        self.send_body(self.small_body)
+
+    do_PUT = do_POST
+    do_DELETE = do_POST
+
+
+class StubCore:
+    """A local stand-in for wlanpi-core, served from a background thread"""
+
+    def __init__(self, openapi_definition: dict):
+        StubCoreHandler.openapi_body = json.dumps(openapi_definition).encode()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StubCoreHandler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def __enter__(self) -> "StubCore":
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FakeMessageInfo:
+    rc = 0
+    mid = 0
+
+    def wait_for_publish(self, timeout: Optional[float] = None) -> None:
+        pass
+
+    def is_published(self) -> bool:
+        return True
+
+
+class FakeMQTTClient:
+    """
+    Stands in for Paho's client. Published messages are handed to
+    `on_publish_hook`, if set, instead of being sent anywhere.
+    """
+
+    def __init__(self) -> None:
+        self.on_publish_hook: Optional[Callable[[str, Any], None]] = None
+        self.published = 0
+
+    # noinspection PyUnusedLocal
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        self.published += 1
+        if self.on_publish_hook is not None:
+            self.on_publish_hook(topic, payload)
+        return FakeMessageInfo()
+
+    # noinspection PyUnusedLocal
+    def subscribe(self, topic, *args, **kwargs):
+        return 0, 0
+
+    # noinspection PyUnusedLocal
+    def unsubscribe(self, topic, *args, **kwargs):
+        return 0, 0
+
+
+class FakeMessage:
+    def __init__(self, topic: str, payload: bytes = b""):
+        self.topic = topic
+        self.payload = payload
+        self.properties = None
+
+
+class Result:
+    """Timing results for a single benchmark"""
+
+    def __init__(
+        self,
+        name: str,
+        latencies: list[float],
+        elapsed: float,
+        peak_bytes: Optional[int] = None,
+        blocks_per_op: Optional[float] = None,
+    ):
+        self.name = name
+        self.latencies = sorted(latencies)
+        self.elapsed = elapsed
+        self.peak_bytes = peak_bytes
+        self.blocks_per_op = blocks_per_op
+
+    @property
+    def ops_per_sec(self) -> float:
+        return len(self.latencies) / self.elapsed if self.elapsed else 0.0
+
+    def percentile(self, p: float) -> float:
+        if not self.latencies:
+            return 0.0
+        index = min(len(self.latencies) - 1, int(round(p / 100 * len(self.latencies))))
+        return self.latencies[index]
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "ops": len(self.latencies),
+            "ops_per_sec": round(self.ops_per_sec, 1),
+            "p50_us": round(self.percentile(50) * 1e6, 1),
+            "p99_us": round(self.percentile(99) * 1e6, 1),
+            "mean_us": round(statistics.fmean(self.latencies) * 1e6, 1),
+            "peak_kib": (
+                round(self.peak_bytes / 1024, 1)
+                if self.peak_bytes is not None
+                else None
+            ),
+            "blocks_per_op": (
+                round(self.blocks_per_op, 2) if self.blocks_per_op is not None else None
+            ),
+        }
+
+
+def measure_memory(func: Callable[[], Any], iterations: int) -> tuple[int, float]:
+    """
+    Runs `func` under tracemalloc.
+    :return: The peak traced memory in bytes, and the number of memory blocks
+        still allocated afterwards, per call.
+    """
+    tracemalloc.start()
+    try:
+        func()  # Warm any caches so they don't count against every call
+        tracemalloc.reset_peak()
+        start_bytes, _ = tracemalloc.get_traced_memory()
+        start_blocks = sys.getallocatedblocks()
+        for _ in range(iterations):
+            func()
+        end_blocks = sys.getallocatedblocks()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak - start_bytes, (end_blocks - start_blocks) / iterations
+
+
+def time_calls(
+    name: str,
+    func: Callable[[], Any],
+    iterations: int,
+    warmup: int = 100,
+    memory_iterations: int = 200,
+) -> Result:
+    """Times `iterations` sequential calls of `func`."""
+    for _ in range(warmup):
+        func()
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(iterations):
+        call_started = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - call_started)
+    elapsed = time.perf_counter() - started
+    peak, blocks = measure_memory(func, memory_iterations)
+    return Result(name, latencies, elapsed, peak, blocks)
+
+
+def print_results(results: list[Result]) -> None:
+    columns = ["name", "ops_per_sec", "p50_us", "p99_us", "peak_kib", "blocks_per_op"]
+    rows = [[str(result.to_dict()[column]) for column in columns] for result in results]
+    widths = [
+        max(len(column), *(len(row[i]) for row in rows))
+        for i, column in enumerate(columns)
+    ]
+    print("  ".join(column.ljust(width) for column, width in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(value.ljust(width) for value, width in zip(row, widths)))
@@ -0,0 +1,116 @@
+import json
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from wlanpi_mqtt_bridge.MQTTBridge.Bridge import Bridge
+from wlanpi_mqtt_bridge.MQTTBridge.BroadcastPolicy import BroadcastPolicy
+from wlanpi_mqtt_bridge.MQTTBridge.structures import BridgeConfig
+from wlanpi_mqtt_bridge.MQTTBridge.TimerQueue import TimerQueue
+
+OPENAPI = {"paths": {"/api/v1/things": {"get": {}}}}
+
+
+@pytest.mark.parametrize("prefix", ["dc:a6:32", "DC-A6-32", "dca6", "dc:a"])
+def test_identifier_prefixes_ignore_case_and_separators(prefix):
+    policy = BroadcastPolicy("dc:a6:32:01:02:03")
+
+    assert policy.decide({"identifier_prefix": prefix}) == 0.0
+
+
+def test_identifier_prefixes_that_differ_dont_match():
+    policy = BroadcastPolicy("dc:a6:32:01:02:03")
+
+    assert policy.decide({"identifier_prefix": ["e4:5f", "b8:27"]}) is None
+
+
+class FakeClient:
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        self.published.append((topic, payload))
+
+
+def test_broadcasts_with_an_invalid_target_are_ignored():
+    bridge = Bridge(
+        BridgeConfig(
+            identifier="dc:a6:32:01:02:03",
+            openapi_cache_path=None,
+            route_snapshot_path=None,
+        )
+    )
+    bridge.add_routes_from_openapi_definition(OPENAPI)
+    client = FakeClient()
+    msg = SimpleNamespace(
+        topic="wlan-pi/all/api/v1/things/get",
+        payload=json.dumps({"_target": {"sample": "half"}}).encode(),
+        properties=None,
+    )
+
+    bridge.handle_message(client, None, msg)
+
+    assert client.published == []
+    assert bridge.dispatcher.queue_depth == 0
+
+
+def test_timer_queue_runs_calls_in_the_order_they_fall_due():
+    timers = TimerQueue()
+    ran = []
+    done = threading.Event()
+    try:
+        timers.call_later(0.2, lambda: (ran.append("late"), done.set()))
+        timers.call_later(0.1, lambda: ran.append("soon"))
+        timers.call_later(0.0, lambda: ran.append("now"))
+        assert done.wait(2)
+    finally:
+        timers.stop()
+
+    assert ran == ["now", "soon", "late"]
+
+
+def test_stopping_a_timer_queue_drops_pending_calls():
+    timers = TimerQueue()
+    ran = []
+    timers.call_later(0.1, lambda: ran.append(True))
+
+    timers.stop()
+    time.sleep(0.2)
+
+    assert ran == []
+    assert len(timers) == 0
+
+
+def test_deferred_broadcasts_share_the_dispatchers_limit():
+    bridge = Bridge(
+        BridgeConfig(
+            identifier="dc:a6:32:01:02:03",
+            openapi_cache_path=None,
+            route_snapshot_path=None,
+            dispatch_queue_depth=2,
+        )
+    )
+    rejected = []
+    bridge.reject_busy = lambda client, request: rejected.append(request)
+    # Workers aren't started, so this stays on the queue.
+    assert bridge.dispatcher.submit(lambda: None)
+
+    bridge.defer_request(None, "first", 60)
+    bridge.defer_request(None, "second", 60)
+
+    assert rejected == ["second"]
+    assert bridge.deferred_requests == 1
+
+    bridge.stop()
+
+    assert bridge.deferred_requests == 0
+
+
+def test_stopping_a_timer_queue_reports_the_calls_dropped():
+    timers = TimerQueue()
+    timers.call_later(60, lambda: None)
+    timers.call_later(60, lambda: None)
+
+    assert timers.stop() == 2
@@ -0,0 +1,19 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from wlanpi_mqtt_bridge.MQTTBridge import Compression
+
+zstandard = pytest.importorskip("zstandard")
+
+
+def test_zstd_compresses_from_many_threads_at_once():
+    payloads = [bytes([i]) * (64 * 1024 + i) for i in range(64)]
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        compressed = list(
+            pool.map(lambda payload: Compression.compress(payload, "zstd"), payloads)
+        )
+
+    decompressor = zstandard.ZstdDecompressor()
+    assert [decompressor.decompress(data) for data in compressed] == payloads
@@ -0,0 +1,161 @@
+import asyncio
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from wlanpi_mqtt_bridge.MQTTBridge.AsyncBridge import AsyncBridge
+from wlanpi_mqtt_bridge.MQTTBridge.Bridge import Bridge
+from wlanpi_mqtt_bridge.MQTTBridge.structures import BridgeConfig, BridgeRequest
+
+OPENAPI = {"paths": {"/api/v1/things": {"get": {}}}}
+
+
+class CoreHandler(BaseHTTPRequestHandler):
+    """Answers every GET with the path and query it was asked for"""
+
+    def do_GET(self) -> None:
+        body = json.dumps({"path": self.path}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+
+class FakeClient:
+    """Collects what the bridge publishes instead of sending it"""
+
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        self.published.append((topic, payload))
+
+
+@pytest.fixture(scope="module")
+def core_url():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), CoreHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def make_bridge(bridge_class, core_url):
+    return bridge_class(
+        BridgeConfig(
+            wlan_pi_core_base_url=core_url,
+            identifier="test",
+            netlink_events=False,
+            core_coalesce_gets=False,
+            openapi_cache_path=None,
+            route_snapshot_path=None,
+        )
+    )
+
+
+def make_request(bridge, payload):
+    route = bridge.routes_from_openapi_definition(OPENAPI)[0]
+    return BridgeRequest.from_payload(route, json.dumps(payload))
+
+
+def run_threaded(core_url, payload):
+    bridge = make_bridge(Bridge, core_url)
+    client = FakeClient()
+    try:
+        bridge.execute_request(client, make_request(bridge, payload))
+    finally:
+        bridge.core_client.close()
+    return client.published
+
+
+def run_asyncio(core_url, payload):
+    bridge = make_bridge(AsyncBridge, core_url)
+    client = FakeClient()
+
+    async def main():
+        bridge.loop = asyncio.get_running_loop()
+        bridge.request_semaphore = asyncio.Semaphore(1)
+        await bridge.async_core_client.start()
+        try:
+            bridge.outstanding_requests += 1
+            await bridge.execute_request_async(client, make_request(bridge, payload))
+        finally:
+            await bridge.async_core_client.close()
+            bridge.core_client.close()
+
+    asyncio.run(main())
+    return client.published
+
+
+@pytest.mark.parametrize(
+    "payload",
+    [
+        {"flag": True},
+        {"ids": [1, 2, 3]},
+        {"filter": {"name": "eth0"}},
+        {"q": "a b&c", "ratio": 1.5, "missing": None},
+    ],
+)
+def test_engines_send_the_same_query(core_url, payload):
+    threaded = run_threaded(core_url, payload)
+    asyncio_ = run_asyncio(core_url, payload)
+
+    assert len(threaded) == len(asyncio_) == 1
+    threaded_response = json.loads(threaded[0][1])
+    asyncio_response = json.loads(asyncio_[0][1])
+    assert threaded_response["status"] == "success"
+    assert asyncio_response["status"] == "success"
+    assert asyncio_response["data"]["path"] == threaded_response["data"]["path"]
+
+
+class ShutdownClient(FakeClient):
+    """Records when the bridge disconnects, among what it publishes"""
+
+    def disconnect(self):
+        self.published.append(("disconnect", None))
+
+    def loop_write(self):
+        pass
+
+
+def test_asyncio_engine_answers_commands_before_disconnecting(core_url):
+    bridge = make_bridge(AsyncBridge, core_url)
+    bridge.drain_timeout = 0.5
+    client = ShutdownClient()
+    bridge.mqtt_client = client
+    bridge.connected = True
+    bridge.run = True
+    stuck = asyncio.Event()
+
+    async def command():
+        await asyncio.sleep(0.1)
+        client.publish("reply", "answer")
+
+    async def main():
+        bridge.loop = asyncio.get_running_loop()
+        bridge.spawn(command())
+        stuck_task = bridge.spawn(stuck.wait())
+        periodic = asyncio.Event()
+        bridge.spawn_periodic(periodic.wait())
+
+        bridge.stop()
+        assert not bridge.submit_request(client, None)
+        await bridge.shutdown()
+        await asyncio.sleep(0)
+        return stuck_task
+
+    stuck_task = asyncio.run(main())
+    bridge.core_client.close()
+
+    assert [topic for topic, _ in client.published] == [
+        "reply",
+        f"{bridge.my_base_topic}/status",
+        "disconnect",
+    ]
+    assert stuck_task.cancelled()
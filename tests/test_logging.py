@@ -0,0 +1,23 @@
+import logging
+
+from wlanpi_mqtt_bridge.MQTTBridge.BridgeLogging import (
+    RateLimitFilter,
+    configure_rate_limits,
+)
+
+
+def rate_limits(name):
+    logger = logging.getLogger(f"wlanpi_mqtt_bridge.MQTTBridge.{name}")
+    return [f for f in logger.filters if isinstance(f, RateLimitFilter)]
+
+
+def test_every_module_in_the_package_is_rate_limited():
+    try:
+        configure_rate_limits(10, 5)
+
+        for name in ["NetlinkMonitor", "OpenAPICache", "TimerQueue", "Bridge"]:
+            assert len(rate_limits(name)) == 1
+    finally:
+        configure_rate_limits(0, 0)
+
+    assert rate_limits("TimerQueue") == []
@@ -0,0 +1,18 @@
+from wlanpi_mqtt_bridge.MQTTBridge.Bridge import Bridge
+from wlanpi_mqtt_bridge.MQTTBridge.structures import BridgeConfig
+
+
+def test_paho_queue_gauges_survive_a_changed_client():
+    bridge = Bridge(
+        BridgeConfig(
+            identifier="test", openapi_cache_path=None, route_snapshot_path=None
+        )
+    )
+    bridge.mqtt_client._out_packet = None
+    del bridge.mqtt_client._out_messages
+
+    text = bridge.metrics.to_text()
+
+    assert "wlanpi_bridge_connected 0" in text
+    assert "\nwlanpi_bridge_mqtt_queued_packets " not in text
+    assert "\nwlanpi_bridge_mqtt_inflight_messages " not in text
@@ -0,0 +1,118 @@
+import asyncio
+import errno
+import time
+
+from wlanpi_mqtt_bridge.MQTTBridge import Netlink
+from wlanpi_mqtt_bridge.MQTTBridge.AsyncBridge import AsyncBridge
+from wlanpi_mqtt_bridge.MQTTBridge.Bridge import Bridge
+from wlanpi_mqtt_bridge.MQTTBridge.NetlinkMonitor import NetlinkMonitor
+from wlanpi_mqtt_bridge.MQTTBridge.structures import BridgeConfig
+
+
+class FakeSocket:
+    """Hands out queued results of `receive`, raising any that are errors"""
+
+    def __init__(self, *results):
+        self.results = list(results)
+
+    def receive(self):
+        if not self.results:
+            raise BlockingIOError()
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def fileno(self):
+        return -1
+
+    def close(self):
+        pass
+
+
+def test_lost_events_refresh_everything():
+    monitor = NetlinkMonitor(lambda kinds: None, kinds={"link", "address"})
+    monitor.sock = FakeSocket(
+        [(Netlink.RTM_NEWLINK, b"")], OSError(errno.ENOBUFS, "No buffer space")
+    )
+
+    assert monitor.read_events() == {"link", "address"}
+
+
+def test_monitor_thread_dying_stops_it_running():
+    def fail(timeout):
+        raise RuntimeError("boom")
+
+    monitor = NetlinkMonitor(lambda kinds: None)
+    monitor.sock = FakeSocket()
+    monitor.wait_readable = fail  # type: ignore[method-assign]
+    monitor.start()
+    monitor.thread.join(timeout=2)
+
+    assert not monitor.running
+
+
+def make_bridge():
+    return Bridge(
+        BridgeConfig(
+            identifier="test",
+            force_refresh_interval=300,
+            openapi_cache_path=None,
+            route_snapshot_path=None,
+        )
+    )
+
+
+def test_event_driven_topics_are_still_polled_now_and_then():
+    bridge = make_bridge()
+    bridge.netlink_monitor.sock = FakeSocket()
+
+    assert bridge.poll_due("addresses", 10)
+    bridge.last_polled["addresses"] = time.monotonic()
+    assert not bridge.poll_due("addresses", 10)
+    bridge.last_polled["addresses"] = time.monotonic() - 300
+    assert bridge.poll_due("addresses", 10)
+
+
+def test_topics_are_polled_as_usual_once_the_monitor_stops():
+    bridge = make_bridge()
+    bridge.netlink_monitor.sock = FakeSocket()
+    bridge.last_polled["addresses"] = time.monotonic()
+    assert not bridge.poll_due("addresses", 10)
+
+    bridge.netlink_monitor.stop()
+
+    assert bridge.poll_due("addresses", 10)
+
+
+def test_asyncio_engine_doesnt_stack_polls_on_a_burst_of_events():
+    bridge = AsyncBridge(
+        BridgeConfig(
+            identifier="test", openapi_cache_path=None, route_snapshot_path=None
+        )
+    )
+    bridge.monitored_core_endpoints = [("api/v1/network/interfaces", True, 10)]
+    bridge.autopublished_topics = []
+    bridge.connected = True
+    bridge.run = True
+    polls = []
+
+    async def poll(endpoint, retain):
+        polls.append(endpoint)
+        await asyncio.sleep(0.1)
+
+    bridge.poll_monitored_endpoint_async = poll  # type: ignore[method-assign]
+
+    async def main():
+        bridge.loop = asyncio.get_running_loop()
+        for _ in range(3):
+            bridge.handle_netlink_events({"address"})
+            await asyncio.sleep(0.01)
+        while bridge.poll_tasks:
+            await asyncio.sleep(0.05)
+
+    asyncio.run(main())
+    bridge.core_client.close()
+
+    # The first poll, then one more for the events seen while it ran
+    assert polls == ["api/v1/network/interfaces"] * 2
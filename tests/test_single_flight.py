@@ -0,0 +1,52 @@
+import asyncio
+
+import pytest
+
+from wlanpi_mqtt_bridge.MQTTBridge.SingleFlight import AsyncSingleFlight
+
+
+def test_followers_get_the_result_when_the_leader_is_cancelled():
+    async def main():
+        flight = AsyncSingleFlight()
+        release = asyncio.Event()
+        calls = 0
+
+        async def fetch():
+            nonlocal calls
+            calls += 1
+            await release.wait()
+            return "data"
+
+        leader = asyncio.ensure_future(flight.do("key", fetch))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(flight.do("key", fetch))
+        await asyncio.sleep(0)
+        leader.cancel()
+        await asyncio.sleep(0)
+        release.set()
+
+        assert await follower == "data"
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        assert calls == 1
+        assert flight.shared == 1
+
+    asyncio.run(main())
+
+
+def test_followers_get_the_leaders_exception():
+    async def main():
+        flight = AsyncSingleFlight()
+
+        async def fetch():
+            await asyncio.sleep(0.01)
+            raise ConnectionError("core unavailable")
+
+        results = await asyncio.gather(
+            flight.do("key", fetch), flight.do("key", fetch), return_exceptions=True
+        )
+
+        assert [type(result) for result in results] == [ConnectionError] * 2
+        assert await flight.do("other", asyncio.sleep, 0, "fresh") == "fresh"
+
+    asyncio.run(main())
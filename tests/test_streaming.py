@@ -0,0 +1,146 @@
+import asyncio
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import paho.mqtt.client as mqtt
+import pytest
+
+from wlanpi_mqtt_bridge.MQTTBridge.AsyncBridge import AsyncBridge
+from wlanpi_mqtt_bridge.MQTTBridge.Bridge import Bridge
+from wlanpi_mqtt_bridge.MQTTBridge.structures import BridgeConfig, BridgeRequest
+
+OPENAPI = {"paths": {"/api/v1/logs": {"get": {}}}}
+BODY = bytes(range(256)) * 64
+CHUNK_SIZE = 4096
+
+
+class CoreHandler(BaseHTTPRequestHandler):
+    """Answers every GET with the same binary body"""
+
+    def do_GET(self) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(BODY)))
+        self.end_headers()
+        self.wfile.write(BODY)
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+
+class FakeClient:
+    """
+    Collects what the bridge publishes, and fails to publish once
+    `fail_after` messages have been sent, as if the connection had dropped.
+    """
+
+    def __init__(self, fail_after=None):
+        self.published = []
+        self.fail_after = fail_after
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        info = mqtt.MQTTMessageInfo(len(self.published))
+        if self.fail_after is not None and len(self.published) >= self.fail_after:
+            info.rc = mqtt.MQTT_ERR_NO_CONN
+        else:
+            info.rc = mqtt.MQTT_ERR_SUCCESS
+            info._set_as_published()
+        self.published.append((topic, payload, properties))
+        return info
+
+
+@pytest.fixture(scope="module")
+def core_url():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), CoreHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def make_bridge(bridge_class, core_url, **config):
+    return bridge_class(
+        BridgeConfig(
+            **config,
+            wlan_pi_core_base_url=core_url,
+            identifier="test",
+            netlink_events=False,
+            stream_chunk_size=CHUNK_SIZE,
+            openapi_cache_path=None,
+            route_snapshot_path=None,
+        )
+    )
+
+
+def make_request(bridge):
+    route = bridge.routes_from_openapi_definition(OPENAPI)[0]
+    return BridgeRequest.from_payload(route, json.dumps({"_stream": True}))
+
+
+def run_threaded(core_url, client, **config):
+    bridge = make_bridge(Bridge, core_url, **config)
+    try:
+        bridge.execute_request(client, make_request(bridge))
+    finally:
+        bridge.core_client.close()
+
+
+def run_asyncio(core_url, client, **config):
+    bridge = make_bridge(AsyncBridge, core_url, **config)
+
+    async def main():
+        bridge.loop = asyncio.get_running_loop()
+        bridge.request_semaphore = asyncio.Semaphore(1)
+        await bridge.async_core_client.start()
+        try:
+            bridge.outstanding_requests += 1
+            await bridge.execute_request_async(client, make_request(bridge))
+        finally:
+            await bridge.async_core_client.close()
+            bridge.core_client.close()
+
+    asyncio.run(main())
+
+
+@pytest.mark.parametrize("run", [run_threaded, run_asyncio])
+def test_stream_is_relayed_in_full(core_url, run):
+    client = FakeClient()
+
+    run(core_url, client)
+
+    manifest = json.loads(client.published[-1][1])["_stream"]
+    assert manifest["complete"] is True
+    assert manifest["chunks"] == len(client.published) - 1
+    assert manifest["size"] == len(BODY)
+
+
+@pytest.mark.parametrize("run", [run_threaded, run_asyncio])
+def test_stream_stops_when_a_chunk_cant_be_published(core_url, run):
+    client = FakeClient(fail_after=2)
+
+    run(core_url, client)
+
+    # Two chunks, the one that failed, then the manifest
+    assert len(client.published) == 4
+    message = json.loads(client.published[-1][1])
+    assert message["status"] == "bridge_error"
+    assert message["errors"][0][0] == "ConnectionError"
+    assert message["_stream"]["complete"] is False
+    assert message["_stream"]["chunks"] == 3
+
+
+@pytest.mark.parametrize("run", [run_threaded, run_asyncio])
+def test_v5_streams_raw_bytes(core_url, run):
+    client = FakeClient()
+
+    run(core_url, client, mqtt_protocol="5")
+
+    chunks = client.published[:-1]
+    assert b"".join(payload for _, payload, _ in chunks) == BODY
+    properties = chunks[0][2]
+    assert properties.ContentType == "application/octet-stream"
+    assert dict(properties.UserProperty)["_chunk"] == "0"
+    manifest = json.loads(client.published[-1][1])["_stream"]
+    assert manifest["encoding"] == "binary"
+    assert manifest["chunks"] == len(chunks)
@@ -0,0 +1,30 @@
+import json
+
+import pytest
+
+from wlanpi_mqtt_bridge.MQTTBridge.structures import MQTTResponse
+
+
+class CoreResponse:
+    def __init__(self, content, content_type="application/json"):
+        self.content = content
+        self.headers = {"Content-Type": content_type}
+        self.status_code = 200
+        self.reason = "OK"
+        self.ok = True
+
+
+def test_json_bodies_are_passed_through():
+    response = MQTTResponse.from_core_response(CoreResponse(b'{"a": [1, 2]}'))
+
+    assert b'"data":{"a": [1, 2]}' in response.to_bytes()
+    assert response.data == {"a": [1, 2]}
+
+
+@pytest.mark.parametrize("content", [b"", b"   ", b'{"a": ', b"Internal error"])
+def test_bodies_mislabelled_as_json_still_serialize(content):
+    response = MQTTResponse.from_core_response(CoreResponse(content))
+
+    message = json.loads(response.to_bytes())
+    assert message["data"] == content.decode("utf-8")
+    assert message["is_hydrated_object"] is False
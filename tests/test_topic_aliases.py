@@ -0,0 +1,133 @@
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+
+from wlanpi_mqtt_bridge.MQTTBridge.AsyncCoreClient import CoreResponse
+from wlanpi_mqtt_bridge.MQTTBridge.Bridge import Bridge
+from wlanpi_mqtt_bridge.MQTTBridge.structures import BridgeConfig, BridgeRequest
+from wlanpi_mqtt_bridge.MQTTBridge.TopicAliases import TopicAliases
+
+OPENAPI = {"paths": {"/api/v1/things": {"get": {}}}}
+
+
+class Sender:
+    """Records the topic each message was sent to, with its alias"""
+
+    def __init__(self):
+        self.sent = []
+        self.rc = mqtt.MQTT_ERR_SUCCESS
+
+    def publish(self, aliases, topic):
+        properties = Properties(PacketTypes.PUBLISH)
+
+        def send(sent_topic):
+            self.sent.append((sent_topic, properties.TopicAlias))
+            info = mqtt.MQTTMessageInfo(len(self.sent))
+            info.rc = self.rc
+            return info
+
+        return aliases.publish(topic, properties, send)
+
+
+def test_topics_are_sent_by_alias_after_the_first_message():
+    aliases = TopicAliases()
+    aliases.reset(server_maximum=10)
+    sender = Sender()
+
+    sender.publish(aliases, "a")
+    sender.publish(aliases, "a")
+
+    assert sender.sent == [("a", 1), ("", 1)]
+
+
+def test_alias_is_not_kept_when_its_first_message_fails():
+    aliases = TopicAliases()
+    aliases.reset(server_maximum=10)
+    sender = Sender()
+
+    sender.rc = mqtt.MQTT_ERR_NO_CONN
+    sender.publish(aliases, "a")
+    sender.rc = mqtt.MQTT_ERR_SUCCESS
+    sender.publish(aliases, "a")
+
+    assert sender.sent == [("a", 1), ("a", 1)]
+
+
+def test_evicted_topic_keeps_its_alias_when_the_new_topic_fails():
+    aliases = TopicAliases()
+    aliases.reset(server_maximum=1)
+    sender = Sender()
+    sender.publish(aliases, "a")
+
+    sender.rc = mqtt.MQTT_ERR_NO_CONN
+    sender.publish(aliases, "b")
+    sender.rc = mqtt.MQTT_ERR_SUCCESS
+    sender.publish(aliases, "a")
+
+    assert sender.sent == [("a", 1), ("b", 1), ("", 1)]
+
+
+class FailingClient:
+    """Fails to publish until `connected` is set, as if disconnected"""
+
+    def __init__(self):
+        self.connected = False
+        self.sent = []
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        self.sent.append((topic, properties.TopicAlias))
+        info = mqtt.MQTTMessageInfo(len(self.sent))
+        info.rc = mqtt.MQTT_ERR_SUCCESS if self.connected else mqtt.MQTT_ERR_NO_CONN
+        return info
+
+
+def test_core_responses_only_keep_an_alias_once_published():
+    bridge = Bridge(
+        BridgeConfig(
+            identifier="test",
+            mqtt_protocol="5",
+            openapi_cache_path=None,
+            route_snapshot_path=None,
+        )
+    )
+    bridge.topic_aliases.reset(server_maximum=10)
+    route = bridge.routes_from_openapi_definition(OPENAPI)[0]
+    response = CoreResponse(200, "OK", b"{}", {"Content-Type": "application/json"})
+    client = FailingClient()
+
+    bridge.publish_core_response(client, BridgeRequest(route), response)
+    client.connected = True
+    bridge.publish_core_response(client, BridgeRequest(route), response)
+
+    assert client.sent == [(route.response_topic, 1), (route.response_topic, 1)]
+
+
+def test_sends_by_alias_dont_wait_on_each_other():
+    aliases = TopicAliases()
+    aliases.reset(server_maximum=10)
+    sender = Sender()
+    sender.publish(aliases, "a")
+    sender.publish(aliases, "b")
+    blocked = threading.Event()
+    release = threading.Event()
+
+    def slow_send(topic):
+        blocked.set()
+        release.wait(5)
+
+    thread = threading.Thread(
+        target=aliases.publish, args=("a", Properties(PacketTypes.PUBLISH), slow_send)
+    )
+    thread.start()
+    try:
+        assert blocked.wait(2)
+        started = time.monotonic()
+        sender.publish(aliases, "b")
+        assert time.monotonic() - started < 1
+        assert sender.sent[-1] == ("", 2)
+    finally:
+        release.set()
+        thread.join()
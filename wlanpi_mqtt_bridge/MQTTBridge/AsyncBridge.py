@@ -0,0 +1,707 @@
+import asyncio
+import socket
+import time
+from collections import defaultdict
+from ssl import SSLCertVerificationError
+from typing import Callable, Coroutine, Optional
+
+import paho.mqtt.client as mqtt
+
+from . import Utils
+from .AsyncCoreClient import STREAM_ERRORS, AsyncCoreClient
+from .Bridge import Bridge
+from .ResponseStream import ResponseStream
+from .structures import BridgeConfig, BridgeRequest
+
+
+class AsyncBridge(Bridge):
+    """
+    Runs the bridge on a single asyncio event loop. Paho's socket is driven by
+    the loop instead of its own network thread, core requests are made with an
+    async HTTP client, and periodic publishing runs as asyncio tasks. Routing,
+    parsing and publishing are shared with `Bridge`.
+    """
+
+    def __init__(self, config: BridgeConfig):
+        super().__init__(config)
+        self.async_core_client = AsyncCoreClient(self.core_client)
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+
+        # Strong references to running tasks, so they aren't garbage
+        # collected mid-flight.
+        self.tasks: set[asyncio.Task] = set()
+        # The recurring poll tasks, which only end once cancelled
+        self.periodic_tasks: set[asyncio.Task] = set()
+        # The poll running for each endpoint or topic. Polls to run again
+        # once theirs finishes are kept in `polls_pending`, as for the
+        # threaded poller.
+        self.poll_tasks: dict[str, asyncio.Task] = {}
+
+        # Limits on in-flight commands, reusing the dispatcher's settings
+        self.outstanding_requests = 0
+        self.request_semaphore: Optional[asyncio.Semaphore] = None
+        self.serialization_locks: dict[str, asyncio.Lock] = {}
+        self.serialization_refs: dict[str, int] = defaultdict(int)
+
+        self.socket_misc_task: Optional[asyncio.Task] = None
+        self.route_validation_task: Optional[asyncio.Task] = None
+
+        # Netlink events gathered while waiting out a burst of them
+        self.pending_netlink_events: set[str] = set()
+        self.netlink_flush: Optional[asyncio.TimerHandle] = None
+
+    def go(self):
+        """
+        Run the bridge. This blocks until `stop` is called.
+        :return:
+        """
+        self.logger.info("Starting MQTTBridge with asyncio engine")
+        self.run = True
+        asyncio.run(self.main())
+
+    async def main(self) -> None:
+        self.loop = asyncio.get_running_loop()
+        self.start_startup_profile()
+        self.request_semaphore = asyncio.Semaphore(self.dispatcher.workers)
+        await self.async_core_client.start()
+
+        self.configure_client()
+        self.mqtt_client.on_socket_open = self.handle_socket_open
+        self.mqtt_client.on_socket_close = self.handle_socket_close
+        self.mqtt_client.on_socket_register_write = self.handle_socket_register_write
+        self.mqtt_client.on_socket_unregister_write = (
+            self.handle_socket_unregister_write
+        )
+
+        try:
+            self.start_netlink_monitor()
+            self.schedule_periodic_data()
+            if self.metrics_server:
+                self.metrics_server.start()
+            await self.maintain_connection()
+            await self.shutdown()
+        finally:
+            for task in list(self.tasks):
+                task.cancel()
+            self.stop_netlink_monitor()
+            if self.metrics_server:
+                self.metrics_server.stop()
+            if self.profiler is not None:
+                self.profiler.stop()
+            await self.async_core_client.close()
+            self.logger.info(
+                "Response cache statistics: %s",
+                self.core_client.response_cache.stats(),
+            )
+
+    def stop(self) -> None:
+        """
+        Stops taking commands, and has `main` shut the bridge down once those
+        under way have been answered. This may be called from a signal
+        handler, so it only flags the loop; `go` returns once it's done.
+        :return:
+        """
+        self.logger.info("Stopping MQTTBridge")
+        self.run = False
+
+    async def shutdown(self) -> None:
+        """
+        Lets the commands already under way publish their answers, for up to
+        `drain_timeout` seconds, then closes the MQTT connection. Periodic
+        polls are stopped first, and any task still running after the timeout
+        is cancelled.
+        :return:
+        """
+        self.stop_netlink_monitor()
+        for task in self.periodic_tasks:
+            task.cancel()
+        pending = self.tasks - self.periodic_tasks - {self.socket_misc_task}
+        if pending:
+            _, pending = await asyncio.wait(pending, timeout=self.drain_timeout)
+        if pending:
+            self.logger.warning(
+                "%d tasks still running after %.0f seconds, cancelling them",
+                len(pending),
+                self.drain_timeout,
+            )
+            for task in pending:
+                task.cancel()
+        if self.connected:
+            self.mqtt_client.publish(
+                f"{self.my_base_topic}/status", "Disconnected", 1, True
+            )
+        self.mqtt_client.disconnect()
+        # The loop won't run again to hand these packets to the socket.
+        self.mqtt_client.loop_write()
+
+    def spawn(self, coroutine: Coroutine) -> asyncio.Task:
+        """
+        Starts a task on the bridge's loop, keeping a reference to it until it
+        completes.
+        :param coroutine:
+        :return: The new task
+        """
+        assert self.loop is not None
+        task = self.loop.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def maintain_connection(self) -> None:
+        """
+        Connects to the MQTT server and reconnects whenever the connection
+        drops, until the bridge is stopped.
+        :return:
+        """
+        self.logger.info(
+            f"Connecting to MQTT server at {self.mqtt_server}:{self.mqtt_port}"
+        )
+        first_attempt = True
+        while self.run:
+            if self.mqtt_client.socket() is not None:
+                await asyncio.sleep(1)
+                continue
+            try:
+                if first_attempt:
+                    self.mqtt_client.connect(self.mqtt_server, self.mqtt_port, 60)
+                    first_attempt = False
+                else:
+                    self.mqtt_client.reconnect()
+            except (ConnectionRefusedError, socket.timeout, OSError) as e:
+                self.metrics.mqtt_connect_failures.inc()
+                self.logger.error(
+                    f"Connection to MQTT server failed. Retrying in 10 seconds. {e}"
+                )
+                await asyncio.sleep(10)
+            except SSLCertVerificationError as e:
+                self.metrics.mqtt_connect_failures.inc()
+                self.logger.error(f"SSL Error. Retrying in 10 seconds. Error: {e}")
+                await asyncio.sleep(10)
+
+    # Paho socket callbacks, which hand the socket over to the event loop.
+    # noinspection PyUnusedLocal
+    def handle_socket_open(self, client, userdata, sock) -> None:
+        assert self.loop is not None
+        self.loop.add_reader(sock, client.loop_read)
+        self.socket_misc_task = self.spawn(self.socket_misc(client))
+
+    # noinspection PyUnusedLocal
+    def handle_socket_close(self, client, userdata, sock) -> None:
+        assert self.loop is not None
+        self.loop.remove_reader(sock)
+        if self.socket_misc_task is not None:
+            self.socket_misc_task.cancel()
+            self.socket_misc_task = None
+
+    # noinspection PyUnusedLocal
+    def handle_socket_register_write(self, client, userdata, sock) -> None:
+        assert self.loop is not None
+        self.loop.add_writer(sock, client.loop_write)
+
+    # noinspection PyUnusedLocal
+    def handle_socket_unregister_write(self, client, userdata, sock) -> None:
+        assert self.loop is not None
+        self.loop.remove_writer(sock)
+
+    @staticmethod
+    async def socket_misc(client) -> None:
+        """Handles Paho's keepalives and retries while connected."""
+        while client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+    # noinspection PyUnusedLocal
+    def handle_connect(self, client, userdata, flags, reason_code, properties) -> None:
+        """
+        Handles the connect event from Paho. The slow parts of setting up the
+        connection are moved onto a task so that the loop isn't blocked.
+        """
+        self.logger.info(
+            f"Connected to MQTT server at {self.mqtt_server}:{self.mqtt_port} "
+            f"with result code {reason_code}."
+        )
+        self.spawn(self.complete_connection(client))
+
+    async def complete_connection(self, client) -> None:
+        validate = self.has_routes()
+        if not validate:
+            # There's nothing to route commands with until the core answers.
+            await self.refresh_openapi_definition_async()
+        model_info = await asyncio.to_thread(Utils.get_model_info)
+        self.setup_connection(client, model_info)
+        if validate:
+            self.validate_routes_in_background(client)
+
+        # Now do the first round of periodic data:
+        await self.publish_periodic_data_async()
+
+    def check_openapi_definition(self) -> None:
+        """
+        Checks the core's OpenAPI definition for changes on the bridge's
+        loop. Safe to call from any thread, or a signal handler.
+        :return:
+        """
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(super().check_openapi_definition)
+
+    def validate_routes_in_background(self, client) -> None:
+        """
+        Starts a task that waits for the core's OpenAPI definition, then
+        brings the routes and our `openapi` topic up to date with it. Does
+        nothing if one is already running.
+        :param client:
+        :return:
+        """
+        task = self.route_validation_task
+        if task is not None and not task.done():
+            return
+        self.route_validation_task = self.spawn(self.validate_routes_async(client))
+
+    def start_netlink_monitor(self) -> bool:
+        """
+        Starts listening for the kernel's network change notifications on the
+        bridge's loop.
+        :return: Whether network state is event driven, rather than polled
+        """
+        assert self.loop is not None
+        if self.netlink_monitor is None or not self.netlink_monitor.open():
+            return False
+        self.loop.add_reader(
+            self.netlink_monitor.fileno(), self.handle_netlink_readable
+        )
+        return True
+
+    def stop_netlink_monitor(self) -> None:
+        if self.netlink_flush is not None:
+            self.netlink_flush.cancel()
+            self.netlink_flush = None
+        if self.netlink_monitor is not None and self.netlink_monitor.running:
+            assert self.loop is not None
+            self.loop.remove_reader(self.netlink_monitor.fileno())
+            self.netlink_monitor.stop()
+
+    def handle_netlink_readable(self) -> None:
+        """
+        Reads the kernel's network change notifications, and acts on them
+        once the burst they're part of is over.
+        :return:
+        """
+        assert self.loop is not None and self.netlink_monitor is not None
+        try:
+            kinds = self.netlink_monitor.read_events()
+        except (OSError, ValueError) as e:
+            # The loop would only call us again straight away, so give up on
+            # events and go back to polling.
+            self.logger.error(
+                "Error reading netlink events, falling back to polling", exc_info=e
+            )
+            self.stop_netlink_monitor()
+            return
+        if not kinds:
+            return
+        self.pending_netlink_events |= kinds
+        if self.netlink_flush is None:
+            self.netlink_flush = self.loop.call_later(
+                self.netlink_monitor.debounce, self.flush_netlink_events
+            )
+
+    def flush_netlink_events(self) -> None:
+        kinds, self.pending_netlink_events = self.pending_netlink_events, set()
+        self.netlink_flush = None
+        self.handle_netlink_events(kinds)
+
+    def handle_netlink_events(self, kinds: set[str]) -> None:
+        """
+        Refreshes everything that follows the kind of network change the
+        kernel just reported.
+        :param kinds: The kinds of change seen, e.g. {"link", "address"}
+        :return:
+        """
+        self.core_client.response_cache.invalidate()
+        if not self.connected:
+            return
+        self.logger.info("Network changed (%s), refreshing", ", ".join(sorted(kinds)))
+        for endpoint, retain, _ in self.monitored_core_endpoints:
+            if self.triggered_by(endpoint, kinds):
+                self.spawn_poll(
+                    self.poll_monitored_endpoint_async, endpoint, retain, rerun=True
+                )
+        for topic, data_function, retain, _ in self.autopublished_topics:
+            if self.triggered_by(topic, kinds):
+                self.spawn_poll(
+                    self.poll_autopublished_topic_async,
+                    topic,
+                    data_function,
+                    retain,
+                    rerun=True,
+                )
+
+    def spawn_poll(self, poll: Callable, name: str, *args, rerun: bool = False) -> None:
+        """
+        Starts a task for a poll, unless the previous poll of the same
+        endpoint or topic is still running.
+        :param poll: The poll coroutine function to run
+        :param name: The endpoint or topic being polled
+        :param rerun: If the previous poll is still running, poll again once
+            it finishes, as it may have read the old state
+        :return:
+        """
+        running = self.poll_tasks.get(name)
+        if running is not None and not running.done():
+            if rerun:
+                self.polls_pending.add(name)
+            else:
+                self.logger.debug("Previous poll of '%s' still running, skipping", name)
+            return
+
+        def finished(task: asyncio.Task) -> None:
+            if self.poll_tasks.get(name) is task:
+                del self.poll_tasks[name]
+            again = name in self.polls_pending
+            self.polls_pending.discard(name)
+            if again and self.run and self.connected:
+                self.spawn_poll(poll, name, *args)
+
+        task = self.spawn(poll(name, *args))
+        self.poll_tasks[name] = task
+        task.add_done_callback(finished)
+
+    async def check_openapi_definition_async(self) -> None:
+        self.validate_routes_in_background(self.mqtt_client)
+
+    async def validate_routes_async(self, client) -> None:
+        """
+        Waits for the core's OpenAPI definition, then brings the routes and
+        our `openapi` topic up to date with it.
+        :param client:
+        :return:
+        """
+        try:
+            await self.refresh_openapi_definition_async(wait_for_core=True)
+            self.update_routes()
+            if self.connected:
+                self.publish_openapi_definition(client)
+        except Exception as e:
+            self.logger.error("Unable to validate routes against the core", exc_info=e)
+
+    async def refresh_openapi_definition_async(
+        self, wait_for_core: bool = False
+    ) -> bool:
+        """
+        Revalidates the cached OpenAPI definition against the core. If there
+        is no cached copy yet, this waits until the core answers.
+        :param wait_for_core: Wait for the core to answer even if there is a
+            cached copy.
+        :return: Whether the definition changed
+        """
+        while self.run or not wait_for_core:
+            try:
+                response = await self.async_core_client.fetch_openapi_definition(
+                    self.openapi_cache.etag
+                )
+                return self.openapi_cache.update_from_response(response)
+            except Exception as e:
+                if self.openapi_cache.definition is not None and not wait_for_core:
+                    self.logger.warning(
+                        "Unable to revalidate OpenAPI definition, using the "
+                        "cached copy: %s",
+                        e,
+                    )
+                    return False
+                self.logger.warning(
+                    "Failed to fetch OpenAPI definition from %s, waiting 5 "
+                    "seconds. %s",
+                    self.core_client.openapi_def_path,
+                    e,
+                )
+                await asyncio.sleep(5)
+        return False
+
+    def submit_request(self, client, request: BridgeRequest) -> bool:
+        """
+        Starts a task to execute a parsed command, unless too many are already
+        in flight.
+        :param client:
+        :param request: The parsed command
+        :return: Whether the command was accepted
+        """
+        if not self.run:
+            # Shutting down, commands already under way are being drained.
+            return False
+        if self.outstanding_requests >= self.dispatcher.max_queue_depth:
+            self.logger.warning(
+                "%d requests in flight, rejecting request", self.outstanding_requests
+            )
+            return False
+        self.outstanding_requests += 1
+        self.spawn(self.execute_request_async(client, request))
+        return True
+
+    def commands_outstanding(self) -> int:
+        return self.outstanding_requests
+
+    def core_requests_shared(self) -> int:
+        return (
+            self.core_client.in_flight.shared + self.async_core_client.in_flight.shared
+        )
+
+    def call_soon_threadsafe(self, func: Callable) -> None:
+        """
+        Runs `func` on the bridge's loop, from any thread.
+        :param func:
+        :return:
+        """
+        assert self.loop is not None
+        self.loop.call_soon_threadsafe(func)
+
+    def call_later(self, delay: float, func: Callable) -> None:
+        """
+        Runs `func` on the bridge's loop after `delay` seconds.
+        :param delay:
+        :param func:
+        :return:
+        """
+        assert self.loop is not None
+        self.loop.call_later(delay, func)
+
+    async def execute_request_async(self, client, request: BridgeRequest) -> None:
+        key = self.get_serialization_key(request)
+        try:
+            if key is None:
+                await self.call_core(client, request)
+                return
+
+            # asyncio locks are fair, so requests on the same key run in the
+            # order their tasks started.
+            self.serialization_refs[key] += 1
+            lock = self.serialization_locks.setdefault(key, asyncio.Lock())
+            try:
+                async with lock:
+                    await self.call_core(client, request)
+            finally:
+                self.serialization_refs[key] -= 1
+                if not self.serialization_refs[key]:
+                    del self.serialization_refs[key]
+                    del self.serialization_locks[key]
+        finally:
+            self.outstanding_requests -= 1
+
+    async def call_core(self, client, request: BridgeRequest) -> None:
+        assert self.request_semaphore is not None
+        route = request.route
+        try:
+            if self.should_stream(request):
+                async with self.request_semaphore:
+                    await self.stream_core_response_async(client, request)
+                return
+            async with self.request_semaphore:
+                started = time.perf_counter()
+                response = await self.async_core_client.execute_request(
+                    method=route.method,
+                    path=route.route,
+                    data=request.data,
+                    params=request.params,
+                )
+                self.metrics.command_phase_seconds.observe(
+                    time.perf_counter() - started, "rest"
+                )
+            self.publish_core_response(client, request, response)
+        except Exception as e:
+            self.publish_bridge_error(client, request, e)
+
+    async def stream_core_response_async(self, client, request: BridgeRequest) -> None:
+        """
+        Executes a parsed command against the REST API, and publishes the
+        response's body in chunks as it's read, followed by a manifest. See
+        `ResponseStream`. Error responses are published as usual.
+        :param client:
+        :param request: The parsed command
+        :return:
+        """
+        route = request.route
+        started = time.perf_counter()
+        async with self.async_core_client.open_stream(
+            method=route.method,
+            path=route.route,
+            data=request.data,
+            params=request.params,
+            chunk_size=self.stream_chunk_size,
+        ) as response:
+            self.metrics.command_phase_seconds.observe(
+                time.perf_counter() - started, "rest"
+            )
+            if not response.ok:
+                self.publish_core_response(client, request, await response.read())
+                return
+            stream = ResponseStream(
+                bridge_ident=request.bridge_ident,
+                rest_status=response.status_code,
+                rest_reason=response.reason,
+                content_type=response.headers.get("Content-Type"),
+                binary=self.mqtt_v5,
+            )
+            error: Optional[Exception] = None
+            try:
+                async for data in response.chunks:
+                    await self.publish_chunk_async(client, request, *stream.chunk(data))
+            except STREAM_ERRORS + (ConnectionError,) as e:
+                # See `Bridge.stream_core_response`
+                self.logger.error(
+                    "Stopped streaming the response on '%s' after %d bytes: %s",
+                    route.topic,
+                    stream.size,
+                    e,
+                )
+                error = e
+        self.publish_reply(client, request, stream.manifest(error).to_bytes())
+
+    async def publish_chunk_async(
+        self,
+        client,
+        request: BridgeRequest,
+        message: bytes,
+        user_properties: list[tuple[str, str]],
+        timeout: float = 30.0,
+    ) -> None:
+        """
+        Publishes part of a streamed response, and waits for the loop to
+        write it so that only one chunk at a time is held in memory.
+        :param client:
+        :param request: The parsed command being answered
+        :param message: The chunk message
+        :param user_properties: The chunk's user properties, if it's binary
+        :param timeout: Seconds to wait for it to be written
+        :raises ConnectionError: If it wasn't written in time, or couldn't be
+            published at all
+        :return:
+        """
+        assert self.loop is not None
+        info = self.publish_reply(
+            client, request, message, self.chunk_properties(user_properties)
+        )
+        deadline = self.loop.time() + timeout
+        while True:
+            # Checked first, as is_published raises if publishing failed.
+            if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                raise ConnectionError(
+                    f"Unable to publish a chunk to '{request.reply_topic}': "
+                    f"{mqtt.error_string(info.rc)}"
+                )
+            if info.is_published():
+                return
+            if self.loop.time() > deadline:
+                raise ConnectionError(
+                    f"Timed out publishing a chunk to '{request.reply_topic}'"
+                )
+            await asyncio.sleep(0.005)
+
+    def schedule_periodic_data(self) -> None:
+        """
+        Starts a recurring poll task for each periodically published topic.
+        Those refreshed by netlink events skip most of their polls, see
+        `poll_due`.
+        """
+        for endpoint, retain, interval in self.monitored_core_endpoints:
+            self.spawn_periodic(
+                self.poll_forever(
+                    interval,
+                    self.poll_if_due,
+                    interval,
+                    self.poll_monitored_endpoint_async,
+                    endpoint,
+                    retain,
+                )
+            )
+        for topic, data_function, retain, interval in self.autopublished_topics:
+            self.spawn_periodic(
+                self.poll_forever(
+                    interval,
+                    self.poll_if_due,
+                    interval,
+                    self.poll_autopublished_topic_async,
+                    topic,
+                    data_function,
+                    retain,
+                )
+            )
+        if self.openapi_check_interval > 0:
+            self.spawn_periodic(
+                self.poll_forever(
+                    self.openapi_check_interval, self.check_openapi_definition_async
+                )
+            )
+        if self.metrics_publish_interval > 0:
+            self.spawn_periodic(
+                self.poll_forever(
+                    self.metrics_publish_interval, self.publish_metrics_async
+                )
+            )
+
+    def spawn_periodic(self, coroutine: Coroutine) -> None:
+        self.periodic_tasks.add(self.spawn(coroutine))
+
+    async def poll_if_due(
+        self, interval: float, poll: Callable, name: str, *args
+    ) -> None:
+        if self.poll_due(name, interval):
+            self.spawn_poll(poll, name, *args)
+
+    async def publish_metrics_async(self) -> None:
+        self.publish_metrics()
+
+    async def poll_forever(self, interval: float, poll: Callable, *args) -> None:
+        """
+        Runs a poll every `interval` seconds, measured from the start of each
+        poll, after a random initial delay.
+        """
+        assert self.loop is not None
+        await asyncio.sleep(self.first_poll_delay(interval))
+        while self.run:
+            started = self.loop.time()
+            if self.connected:
+                await poll(*args)
+            await asyncio.sleep(max(0.0, interval - (self.loop.time() - started)))
+
+    async def publish_periodic_data_async(self) -> None:
+        """Publishes all periodic data now, polling the core concurrently"""
+        if not self.connected:
+            self.logger.info("Not connected, skipping periodic publish")
+            return
+
+        self.logger.info("Publishing periodic data.")
+        await asyncio.gather(
+            *[
+                self.poll_monitored_endpoint_async(endpoint, retain)
+                for endpoint, retain, _ in self.monitored_core_endpoints
+            ],
+            *[
+                self.poll_autopublished_topic_async(topic, data_function, retain)
+                for topic, data_function, retain, _ in self.autopublished_topics
+            ],
+        )
+
+    async def poll_monitored_endpoint_async(self, endpoint: str, retain: bool) -> None:
+        self.logger.debug("Publishing monitored topic: '%s'", endpoint)
+        self.last_polled[endpoint] = time.monotonic()
+        started = time.perf_counter()
+        try:
+            response = await self.async_core_client.execute_request("get", endpoint)
+            self.publish_monitored_endpoint(endpoint, retain, response)
+        except Exception as e:
+            self.logger.error(
+                'Error publishing monitored core endpoint "%s" %s', endpoint, e
+            )
+        self.metrics.poll_seconds.observe(time.perf_counter() - started, endpoint)
+
+    async def poll_autopublished_topic_async(
+        self, topic: str, data_function: Callable, retain: bool
+    ) -> None:
+        self.logger.debug("Auto-Publishing: '%s'", topic)
+        self.last_polled[topic] = time.monotonic()
+        started = time.perf_counter()
+        try:
+            # Data functions may shell out, so keep them off the loop.
+            data = await asyncio.to_thread(data_function)
+            self.publish_autopublished_topic(topic, data, retain)
+        except Exception as e:
+            self.logger.error('Error auto-publishing topic "%s" %s', topic, e)
+        self.metrics.poll_seconds.observe(time.perf_counter() - started, topic)
@@ -0,0 +1,327 @@
+import asyncio
+import contextlib
+import functools
+import json
+import logging
+from typing import Any, AsyncIterator, Hashable, Mapping, Optional
+
+from requests import RequestException
+
+from .CoreClient import SAFE_METHODS, CoreClient
+from .SingleFlight import AsyncSingleFlight
+
+try:
+    import aiohttp
+    from yarl import URL
+except ImportError:  # pragma: no cover
+    aiohttp = None  # type: ignore
+
+# What reading a streamed response's body may raise if the core or the
+# connection to it fails part way through
+STREAM_ERRORS: tuple[type[Exception], ...] = (RequestException,)
+if aiohttp is not None:
+    STREAM_ERRORS += (aiohttp.ClientError, asyncio.TimeoutError)
+
+
+class CoreResponse:
+    """
+    A fully-read response from the core, shaped like the parts of
+    `requests.Response` the bridge uses so that both engines can share the
+    code that publishes responses.
+    """
+
+    def __init__(
+        self,
+        status_code: int,
+        reason: Optional[str],
+        content: bytes,
+        headers: Mapping[str, str],
+    ):
+        self.status_code = status_code
+        self.reason = reason
+        self.content = content
+        self.headers = headers
+
+    @property
+    def ok(self) -> bool:
+        return self.status_code < 400
+
+    @property
+    def text(self) -> str:
+        return self.content.decode("utf-8", errors="replace")
+
+    def json(self) -> Any:
+        return json.loads(self.content)
+
+
+class StreamedCoreResponse:
+    """
+    A response from the core whose body hasn't been read yet, and is read a
+    piece at a time from `chunks`.
+    """
+
+    def __init__(
+        self,
+        status_code: int,
+        reason: Optional[str],
+        headers: Mapping[str, str],
+        chunks: AsyncIterator[bytes],
+    ):
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers
+        self.chunks = chunks
+
+    @property
+    def ok(self) -> bool:
+        return self.status_code < 400
+
+    async def read(self) -> CoreResponse:
+        """
+        :return: The response with its body read in full
+        """
+        content = b"".join([chunk async for chunk in self.chunks])
+        return CoreResponse(self.status_code, self.reason, content, self.headers)
+
+
+class AsyncCoreClient:
+    """
+    An asyncio counterpart to `CoreClient`, configured from an existing
+    `CoreClient` so both talk to the core the same way.
+
+    Requests are made with aiohttp when it is installed. Without it, requests
+    fall back to running the synchronous client in the default executor.
+    """
+
+    def __init__(self, core_client: CoreClient):
+        self.logger = logging.getLogger(__name__)
+        self.core_client = core_client
+        self.base_url = core_client.base_url
+        self.session: Optional[Any] = None
+        self.in_flight = AsyncSingleFlight()
+        # Shared with the synchronous client
+        self.response_cache = core_client.response_cache
+
+        if aiohttp is None:
+            self.logger.warning(
+                "aiohttp is not installed, core requests will run in a thread pool"
+            )
+
+    async def start(self) -> None:
+        """
+        Opens the HTTP session. Must be called from within the running loop.
+        :return:
+        """
+        if aiohttp is None or self.session is not None:
+            return
+        connector: aiohttp.BaseConnector
+        if self.core_client.socket_path:
+            connector = aiohttp.UnixConnector(
+                path=self.core_client.socket_path, limit=self.core_client.pool_size
+            )
+        else:
+            connector = aiohttp.TCPConnector(limit=self.core_client.pool_size)
+        connect_timeout, read_timeout = self.core_client.timeout
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            headers=self.core_client.base_headers,
+            timeout=aiohttp.ClientTimeout(
+                connect=connect_timeout, sock_read=read_timeout
+            ),
+        )
+
+    async def close(self) -> None:
+        """Closes any open connections to the core."""
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def get_openapi_definition(self) -> dict:
+        while True:
+            try:
+                response = await self.execute_request("get", "api/v1/openapi.json")
+                return response.json()
+            except Exception as e:
+                self.logger.warning(
+                    "Failed to fetch OpenAPI definition from "
+                    f"{self.core_client.openapi_def_path}, waiting 5 seconds. {e}"
+                )
+                await asyncio.sleep(5)
+
+    async def fetch_openapi_definition(
+        self, etag: Optional[str] = None
+    ) -> CoreResponse:
+        """
+        Makes a single request for the OpenAPI definition, conditional on
+        `etag` if given.
+        :param etag: The ETag of the copy we already have
+        :return: The core's response, which is a 304 if our copy is current
+        """
+        if self.session is None:
+            response = await asyncio.to_thread(
+                self.core_client.fetch_openapi_definition, etag
+            )
+            return CoreResponse(
+                status_code=response.status_code,
+                reason=response.reason,
+                content=response.content,
+                headers=response.headers,
+            )
+
+        headers = {"If-None-Match": etag} if etag else None
+        async with self.session.get(
+            self.core_client.openapi_def_path, headers=headers
+        ) as response:
+            return CoreResponse(
+                status_code=response.status,
+                reason=response.reason,
+                content=await response.read(),
+                headers=response.headers,
+            )
+
+    def url_for(self, path: str, params: Optional[Any] = None) -> Any:
+        """
+        :param path: The path of a core endpoint, relative to the base URL
+        :param params: Query parameters from a command
+        :return: The endpoint's URL, with the parameters encoded just as the
+            synchronous client encodes them. aiohttp on its own rejects
+            values such as booleans and nested lists.
+        """
+        return URL(self.core_client.url_for(path, params), encoded=True)
+
+    async def execute_request(
+        self,
+        method: str,
+        path: str,
+        data: Optional[Any] = None,
+        params: Optional[Any] = None,
+    ) -> Any:
+        key = self.core_client.request_key(method, path, data, params)
+        if key is None:
+            response = await self.send_request(method, path, data, params)
+            if method.lower() not in SAFE_METHODS:
+                self.response_cache.invalidate()
+            return response
+
+        if self.response_cache.ttl_for(path) > 0:
+            cached = self.response_cache.get(key)
+            if cached is not None:
+                return cached
+        if not self.core_client.coalesce_gets:
+            return await self.fetch(key, method, path, data, params)
+        return await self.in_flight.do(key, self.fetch, key, method, path, data, params)
+
+    async def fetch(
+        self,
+        key: Hashable,
+        method: str,
+        path: str,
+        data: Optional[Any] = None,
+        params: Optional[Any] = None,
+    ) -> Any:
+        """Sends a GET request, caching the response if it succeeds"""
+        generation = self.response_cache.generation
+        response = await self.send_request(method, path, data, params)
+        if response.status_code == 200:
+            self.response_cache.put(key, path, response, generation)
+        return response
+
+    @contextlib.asynccontextmanager
+    async def open_stream(
+        self,
+        method: str,
+        path: str,
+        data: Optional[Any] = None,
+        params: Optional[Any] = None,
+        chunk_size: int = 65536,
+    ) -> AsyncIterator[StreamedCoreResponse]:
+        """
+        Sends a request, yielding the response as soon as its headers arrive.
+        Its body is read in pieces of up to `chunk_size` bytes, and the
+        response isn't cached.
+        """
+        if self.session is None:
+            response = await asyncio.to_thread(
+                self.core_client.open_stream, method, path, data, params
+            )
+            try:
+                iterator = response.iter_content(chunk_size)
+
+                async def chunks() -> AsyncIterator[bytes]:
+                    while True:
+                        chunk = await asyncio.to_thread(next, iterator, None)
+                        if chunk is None:
+                            return
+                        yield chunk
+
+                yield StreamedCoreResponse(
+                    response.status_code, response.reason, response.headers, chunks()
+                )
+            finally:
+                response.close()
+            return
+
+        metrics = self.core_client.metrics
+        try:
+            async with self.session.request(
+                method=method,
+                url=self.url_for(path, params),
+                json=data,
+            ) as response:
+                if metrics:
+                    metrics.core_requests.inc(method.lower(), str(response.status))
+                if method.lower() not in SAFE_METHODS:
+                    self.response_cache.invalidate()
+                yield StreamedCoreResponse(
+                    response.status,
+                    response.reason,
+                    response.headers,
+                    response.content.iter_chunked(chunk_size),
+                )
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            if metrics:
+                metrics.core_request_errors.inc(method.lower())
+            raise
+
+    async def send_request(
+        self,
+        method: str,
+        path: str,
+        data: Optional[Any] = None,
+        params: Optional[Any] = None,
+    ) -> Any:
+        self.logger.debug(
+            "Executing %s on path %s with data: %s", method.upper(), path, data
+        )
+        if self.session is None:
+            return await asyncio.get_running_loop().run_in_executor(
+                None,
+                functools.partial(
+                    self.core_client.send_request,
+                    method=method,
+                    path=path,
+                    data=data,
+                    params=params,
+                ),
+            )
+
+        metrics = self.core_client.metrics
+        try:
+            async with self.session.request(
+                method=method,
+                url=self.url_for(path, params),
+                json=data,
+            ) as response:
+                core_response = CoreResponse(
+                    status_code=response.status,
+                    reason=response.reason,
+                    content=await response.read(),
+                    headers=response.headers,
+                )
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            if metrics:
+                metrics.core_request_errors.inc(method.lower())
+            raise
+        if metrics:
+            metrics.core_requests.inc(method.lower(), str(core_response.status_code))
+        return core_response
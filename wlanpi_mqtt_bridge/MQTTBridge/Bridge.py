@@ -1,113 +1,526 @@
+import datetime
 import json
 import logging
+import random
 import socket
+import threading
 import time
 from ssl import SSLCertVerificationError
-from typing import Optional, Union
+from typing import Any, Callable, Iterable, Optional, Union
 
 import paho.mqtt.client as mqtt
 import schedule
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+from requests import RequestException
 
-from . import Utils
+from . import Compression, Utils
+from .BridgeLogging import StructuredMessage, configure_rate_limits
+from .BroadcastPolicy import BroadcastPolicy
+from .ChangeTracker import ChangeTracker
 from .CoreClient import CoreClient
-from .structures import MQTTResponse, Route, TLSConfig
-from .TopicMatcher import TopicMatcher
+from .Dispatcher import Dispatcher
+from .Metrics import BridgeMetrics, GaugeValue, MetricsServer
+from .NetlinkMonitor import NetlinkMonitor
+from .OpenAPICache import OpenAPICache
+from .Profiler import SamplingProfiler
+from .ResponseCache import matches_template, ttls_from_openapi_definition
+from .ResponseStream import ResponseStream
+from .RouteSnapshot import RouteSnapshot
+from .structures import BridgeConfig, BridgeRequest, MQTTResponse, Route
+from .TimerQueue import TimerQueue
+from .TopicAliases import TopicAliases
+from .TopicMatcher import (
+    TopicMatcher,
+    collapse_topic_filters,
+    is_command_topic,
+    topic_filter_covers,
+)
 from .Utils import get_full_class_name
 
 
 class Bridge:
     __global_base_topic = "wlan-pi/all"
 
-    def __init__(
-        self,
-        mqtt_server: str = "wi.fi",
-        mqtt_port: int = 1883,
-        tls_config: Optional[TLSConfig] = None,
-        wlan_pi_core_base_url: str = "http://127.0.0.1:31415",
-        identifier: Optional[str] = None,
-    ):
+    def __init__(self, config: BridgeConfig):
+        """
+        :param config: How the bridge is configured, see `BridgeConfig`
+        """
         self.logger = logging.getLogger(__name__)
+        # Keep a flood of failures (a core outage, a misbehaving client) from
+        # flooding the journal as well.
+        configure_rate_limits(config.log_rate_limit, config.log_burst)
         self.logger.info("Initializing MQTTBridge")
+        self.config = config
 
         self.run = False
         self.connected = False
 
-        self.topic_matcher: TopicMatcher = TopicMatcher()
+        # Runtime telemetry, served over HTTP for Prometheus on
+        # `metrics_port` (0 disables it), and published as JSON to our
+        # `$SYS/metrics` topic every `metrics_publish_interval` seconds.
+        self.metrics = BridgeMetrics()
+        self.metrics_server = (
+            MetricsServer(self.metrics, config.metrics_host, config.metrics_port)
+            if config.metrics_port
+            else None
+        )
+        self.metrics_publish_interval = config.metrics_publish_interval
 
-        self.mqtt_server = mqtt_server
-        self.mqtt_port = mqtt_port
-        self.tls_config = tls_config
-        self.core_base_url = wlan_pi_core_base_url
+        self.route_cache_size = config.route_cache_size
+        self.topic_matcher: TopicMatcher = self.new_topic_matcher()
 
-        self.my_base_topic = f"wlan-pi/{identifier}"
-        self.mqtt_client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+        self.mqtt_server = config.mqtt_server
+        self.mqtt_port = config.mqtt_port
+        self.tls_config = config.tls_config
+        self.core_base_url = config.wlan_pi_core_base_url
+
+        self.my_base_topic = f"wlan-pi/{config.identifier}"
+        self.global_topic_prefix = f"{self.__global_base_topic}/"
+        # MQTT v5 lets us label payloads with their content type and
+        # encoding.
+        self.mqtt_v5 = str(config.mqtt_protocol).lower().lstrip("v") in ("5", "5.0")
+        self.mqtt_client = mqtt.Client(
+            mqtt.CallbackAPIVersion.VERSION2,
+            protocol=mqtt.MQTTv5 if self.mqtt_v5 else mqtt.MQTTv311,
+        )
         if self.tls_config:
             self.mqtt_client.tls_set(**self.tls_config.__dict__)
-        self.core_client = CoreClient(base_url=self.core_base_url)
+        self.core_client = CoreClient(
+            base_url=self.core_base_url,
+            socket_path=config.core_socket_path,
+            # One connection per dispatch worker, plus one for the poller.
+            pool_size=config.core_pool_size or config.dispatch_workers + 1,
+            connect_timeout=config.core_connect_timeout,
+            read_timeout=config.core_read_timeout,
+            metrics=self.metrics,
+            coalesce_gets=config.core_coalesce_gets,
+            cache_max_entries=config.cache_max_entries,
+            cache_default_ttl=config.cache_default_ttl,
+            cache_ttls=config.cache_ttls,
+        )
+
+        # The core's OpenAPI definition, kept across reconnects (and restarts,
+        # with a cache path) so it's only re-processed when it changes.
+        self.openapi_cache = OpenAPICache(config.openapi_cache_path)
+        self.openapi_cache.load()
+        self.core_client.response_cache.set_core_ttls(
+            ttls_from_openapi_definition(self.openapi_cache.definition)
+        )
+        # The definition digests the routes were built from, and that was
+        # last published to our `openapi` topic.
+        self.routes_digest: Optional[str] = None
+        self.published_openapi_digest: Optional[str] = None
+        # Held while the route table is replaced or subscribed to, which may
+        # happen on Paho's thread and on the route validation thread.
+        self.routes_lock = threading.RLock()
+        self.route_validation: Optional[threading.Thread] = None
+        # How often to check the core's OpenAPI definition for changes while
+        # connected, in seconds. 0 only checks on connect.
+        self.openapi_check_interval = config.openapi_check_interval
+
+        # Inbound commands are handed from Paho's network thread to this pool
+        # so that a slow core endpoint doesn't hold up everything else.
+        self.dispatcher = Dispatcher(
+            workers=config.dispatch_workers,
+            max_queue_depth=config.dispatch_queue_depth,
+            name="command-dispatch",
+        )
+        # How long the Paho thread may wait for room in the dispatch queue
+        # before the command is rejected as busy.
+        self.dispatch_timeout = config.dispatch_timeout
+        # How long `stop` waits, per pool, for commands and polls under way
+        # to finish before disconnecting.
+        self.drain_timeout = 10.0
+
+        # How often each monitored endpoint or autopublished topic is polled,
+        # in seconds, keyed by endpoint/topic.
+        poll_intervals = config.poll_intervals or {}
+
+        def interval(name: str) -> float:
+            return float(poll_intervals.get(name, config.default_poll_interval))
 
         # Endpoints in the core that should be routinely polled and updated
-        # This may go away if we can figure out to do event-based updates
-        # ['Topic', retain]
-        self.monitored_core_endpoints = [
-            ("api/v1/network/ethernet/all/vlan/all", True),
-            ("api/v1/network/ethernet/all", True),
-            ("api/v1/network/interfaces", True),
+        # ['Topic', retain, poll interval]
+        self.monitored_core_endpoints: list[tuple[str, bool, float]] = [
+            (endpoint, True, interval(endpoint))
+            for endpoint in [
+                "api/v1/network/ethernet/all/vlan/all",
+                "api/v1/network/ethernet/all",
+                "api/v1/network/interfaces",
+            ]
         ]
 
         # Topics that the bridge itself populates and publishes:
-        # [topic, function to call, retain
-        self.autopublished_topics = [
-            ("status", lambda: "Connected", True),
+        # [topic, function to call, retain, poll interval]
+        self.autopublished_topics: list[tuple[str, Callable, bool, float]] = [
+            ("status", lambda: "Connected", True, interval("status")),
             (
                 "addresses",
                 lambda: MQTTResponse(data=Utils.get_interface_ip_addr()),
                 True,
+                interval("addresses"),
             ),
         ]
 
+        # Polls run on their own small pool so that one slow endpoint doesn't
+        # delay the rest, and are given a random initial delay so that a
+        # fleet which starts at the same time doesn't poll in lockstep.
+        self.poll_jitter = config.poll_jitter
+        self.poller = Dispatcher(
+            workers=config.poll_workers, max_queue_depth=64, name="poller"
+        )
+        self.polls_in_flight: set[str] = set()
+        # Polls to run again once their in-flight poll finishes, because
+        # what they report changed while it was running.
+        self.polls_pending: set[str] = set()
+        self.polls_in_flight_lock = threading.Lock()
+
+        # Endpoints and topics that follow the kernel's network state, and
+        # the kinds of netlink event that change it. While the netlink
+        # monitor is listening they're refreshed on those events, and only
+        # polled every `force_refresh_interval` seconds in case one was missed.
+        self.netlink_triggers: dict[str, tuple[str, ...]] = {
+            "addresses": ("link", "address"),
+            "api/v1/network/interfaces": ("link", "address"),
+            "api/v1/network/ethernet/all": ("link", "address"),
+            "api/v1/network/ethernet/all/vlan/all": ("link",),
+        }
+        self.netlink_monitor: Optional[NetlinkMonitor] = None
+        if config.netlink_events:
+            self.netlink_monitor = NetlinkMonitor(
+                self.handle_netlink_events,
+                kinds={
+                    kind for kinds in self.netlink_triggers.values() for kind in kinds
+                },
+                debounce=config.netlink_debounce,
+            )
+        # When each endpoint and topic was last polled, by `time.monotonic`
+        self.last_polled: dict[str, float] = {}
+
+        # Periodically published data is only sent when it changes, or when
+        # `force_refresh_interval` seconds have passed since it was last sent.
+        # With `publish_patches`, a JSON merge patch of each change is also
+        # published to the topic's `_patch` subtopic.
+        self.change_tracker = ChangeTracker(
+            force_refresh_interval=config.force_refresh_interval,
+            keep_snapshots=config.publish_patches,
+        )
+
         # Topics to monitor for changes
         self.topics_of_interest: list[str] = [
             # f"{self.__global_base_topic}/#",
             # f"{self.__my_base_topic}/#"
         ]
 
+        # Subscriptions are sent as multi-topic SUBSCRIBE packets of up to
+        # `subscription_batch_size` filters. With a collapse depth, filters
+        # are first widened to that many segments plus `#`, which turns the
+        # whole route table into a handful of filters.
+        self.subscription_batch_size = max(1, config.subscription_batch_size)
+        self.subscription_collapse_depth = config.subscription_collapse_depth
+        # The filters actually subscribed to on the current connection
+        self.subscribed_filters: list[str] = []
+
+        # Commands on the `wlan-pi/all` topics reach the whole fleet, so
+        # answers are spread out, and may be limited to some devices.
+        self.broadcast_policy = BroadcastPolicy(
+            identifier=str(config.identifier),
+            tags=config.tags or (),
+            spread=config.broadcast_spread,
+            max_spread=config.broadcast_max_spread,
+            sample_rate=config.broadcast_sample_rate,
+        )
+        # Broadcast commands waiting out their delay. They count against the
+        # dispatch queue depth, so a flood of them is still turned away.
+        self.deferred_requests = 0
+        self.deferred_requests_lock = threading.Lock()
+        self.timers = TimerQueue(name="deferred")
+
+        # On request, the stacks of every thread are sampled for a while to
+        # see where the time goes. Profiles can be asked for over MQTT with
+        # `profiling_enabled`, and one taken for `profile_on_start` seconds
+        # from startup, and are written to `profile_dir`.
+        self.profiling_enabled = config.profiling_enabled
+        self.profile_on_start = config.profile_on_start
+        self.profile_dir = config.profile_dir
+        self.profile_interval = config.profile_interval
+        self.profile_max_duration = config.profile_max_duration
+        self.profiler: Optional[SamplingProfiler] = None
+        self.profiler_lock = threading.Lock()
+
+        # Responses from these routes, or to commands with `_stream` set, are
+        # relayed in chunks of up to `stream_chunk_size` bytes as they're
+        # read from the core, rather than read in full and published at once.
+        self.stream_chunk_size = max(1, config.stream_chunk_size)
+        self.stream_routes = [
+            template.strip("/").split("/") for template in config.stream_routes or ()
+        ]
+
+        # Payloads of at least `compression_min_size` bytes are compressed
+        # when a command asks for it with `_compression`, and for the
+        # periodically published topics in `compressed_topics`, which maps
+        # topic or endpoint names to an encoding.
+        self.compression_min_size = config.compression_min_size
+        self.compressed_topics: dict[str, str] = {}
+        for name, encoding in (config.compressed_topics or {}).items():
+            supported = Compression.negotiate(encoding)
+            if supported is None:
+                self.logger.warning(
+                    "Unsupported encoding '%s' for topic '%s', not compressing it",
+                    encoding,
+                    name,
+                )
+                continue
+            self.compressed_topics[name] = supported
+
+        # On MQTT v5, answers to commands expire after `response_expiry`
+        # seconds (0 for never) if they can't be delivered, and up to
+        # `topic_alias_maximum` of the topics they're published to are sent
+        # as aliases rather than in full.
+        self.response_expiry = config.response_expiry
+        self.topic_aliases = TopicAliases(config.topic_alias_maximum)
+
+        # Topics served by the bridge itself rather than the core
+        self.bridge_endpoints = self.additional_supported_endpoints()
+
         # Holds scheduled jobs from `scheduler` so we can clean them up
         # on exit.
         self.scheduled_jobs: list[schedule.Job] = []
 
+        # The route table as last built, saved so that after a restart we can
+        # take commands straight away rather than waiting for the core.
+        self.route_snapshot = RouteSnapshot(config.route_snapshot_path)
+        self.load_route_snapshot()
+
+        self.register_gauges()
+
+    def register_gauges(self) -> None:
+        """Adds the metrics that are read from the bridge's state"""
+        metrics = self.metrics
+        metrics.gauge(
+            "wlanpi_bridge_connected",
+            "Whether the bridge is connected to the MQTT server",
+            lambda: float(self.connected),
+        )
+        metrics.gauge(
+            "wlanpi_bridge_routes",
+            "Routes being served",
+            lambda: len(self.topic_matcher.routes),
+        )
+        metrics.gauge(
+            "wlanpi_bridge_commands_outstanding",
+            "Commands queued or running",
+            self.commands_outstanding,
+        )
+        metrics.gauge(
+            "wlanpi_bridge_commands_deferred",
+            "Broadcast commands waiting out their spread delay",
+            lambda: self.deferred_requests,
+        )
+        metrics.gauge(
+            "wlanpi_bridge_mqtt_queued_packets",
+            "Packets queued in the MQTT client waiting to be written",
+            lambda: self.mqtt_client_queue_length("_out_packet"),
+        )
+        metrics.gauge(
+            "wlanpi_bridge_mqtt_inflight_messages",
+            "QoS 1 and 2 messages published but not yet acknowledged",
+            lambda: self.mqtt_client_queue_length("_out_messages"),
+        )
+        metrics.gauge(
+            "wlanpi_bridge_core_requests_shared",
+            "GET requests answered by another identical request in flight",
+            self.core_requests_shared,
+        )
+        metrics.gauge(
+            "wlanpi_bridge_route_cache",
+            "Topic to route cache statistics",
+            lambda: {
+                (name,): value
+                for name, value in self.topic_matcher.cache_info().items()
+            },
+            ["stat"],
+        )
+        metrics.gauge(
+            "wlanpi_bridge_response_cache",
+            "Core response cache statistics",
+            lambda: {
+                (name,): value
+                for name, value in self.core_client.response_cache.stats().items()
+            },
+            ["stat"],
+        )
+
+    def commands_outstanding(self) -> int:
+        return self.dispatcher.queue_depth
+
+    def mqtt_client_queue_length(self, name: str) -> GaugeValue:
+        """
+        Reads the length of one of the Paho client's internal queues. They
+        aren't part of its API, so if an upgrade renames or changes one, its
+        gauge is left without a value rather than failing.
+        :param name: The queue's attribute on the client
+        :return: Its length, or no value if it can't be read
+        """
+        queue = getattr(self.mqtt_client, name, None)
+        try:
+            return float(len(queue))  # type: ignore[arg-type]
+        except TypeError:
+            return {}
+
+    def core_requests_shared(self) -> int:
+        return self.core_client.in_flight.shared
+
+    def publish_metrics(self) -> None:
+        """Publishes the current metrics to our retained `$SYS/metrics` topic"""
+        if not self.connected:
+            return
+        self.mqtt_client.publish(
+            f"{self.my_base_topic}/$SYS/metrics", self.metrics.to_json(), 0, True
+        )
+
     @staticmethod
-    def additional_supported_endpoints():
+    def route_label(route: Route, parameters: dict[str, str]) -> str:
         """
-        Defines a list of additional endpoints supported by this bridge
-        itself that are not part of the openapi definition
-        :return: []
+        :param route: A route with its path parameters filled in
+        :param parameters: The values it was filled in with
+        :return: The route's path with the parameters put back, to label
+            metrics by without a label value for every VLAN or interface
         """
-        return []
+        if not parameters:
+            return route.route
+        remaining = list(parameters.items())
+        segments = route.route.split("/")
+        for i, segment in enumerate(segments):
+            if remaining and segment == remaining[0][1]:
+                segments[i] = f"{{{remaining.pop(0)[0]}}}"
+        return "/".join(segments)
 
-    def go(self):
+    def additional_supported_endpoints(
+        self,
+    ) -> dict[str, Callable[[Any, BridgeRequest], None]]:
         """
-        Run the bridge. This calls the Paho client's `.loop_forever()` method,
-        which blocks until the Paho client is disconnected.
+        Defines the additional endpoints supported by this bridge itself that
+        are not part of the openapi definition
+        :return: Handlers keyed by the topic they're served on. Each is called
+            with the client and the parsed command, and answers on the
+            topic's `_response` subtopic.
+        """
+        endpoints: dict[str, Callable[[Any, BridgeRequest], None]] = {}
+        if self.profiling_enabled:
+            endpoints[f"{self.my_base_topic}/$SYS/profile"] = self.handle_profile
+        return endpoints
+
+    def handle_bridge_command(
+        self, client, msg, handler: Callable[[Any, BridgeRequest], None]
+    ) -> None:
+        """
+        Parses a command on one of the bridge's own endpoints and hands it to
+        the endpoint's handler, answering with any error it raises.
+        :param client:
+        :param msg: The MQTT message
+        :param handler: The endpoint's handler
         :return:
         """
-        self.logger.info("Starting MQTTBridge")
-        self.run = True
+        route = Route(
+            route=msg.topic.removeprefix(self.my_base_topic),
+            topic=msg.topic,
+            method="post",
+            callback=self.default_callback,
+        )
+        request = BridgeRequest(route, **BridgeRequest.reply_fields(msg.properties))
+        try:
+            request = BridgeRequest.from_payload(route, msg.payload, msg.properties)
+            handler(client, request)
+        except Exception as e:
+            self.publish_bridge_error(client, request, e)
 
-        def on_connect(client, userdata, flags, reason_code, properties) -> None:
-            return self.handle_connect(client, userdata, flags, reason_code, properties)
+    def start_profile(
+        self,
+        duration: float,
+        interval: Optional[float] = None,
+        on_complete: Optional[Callable[[SamplingProfiler], Any]] = None,
+    ) -> SamplingProfiler:
+        """
+        Starts sampling every thread's stack for up to `profile_max_duration`
+        seconds.
+        :param duration: Seconds to profile for
+        :param interval: Seconds between samples, `profile_interval` if not
+            given
+        :param on_complete: Called with the profiler once it's done, on the
+            profiler's thread
+        :raises RuntimeError: If a profile is already being taken
+        :return: The running profiler
+        """
+        duration = min(duration, self.profile_max_duration)
+        if duration <= 0:
+            raise ValueError("duration must be positive")
+        with self.profiler_lock:
+            if self.profiler is not None and self.profiler.running:
+                raise RuntimeError("A profile is already being taken")
+            profiler = SamplingProfiler(interval or self.profile_interval)
+            self.profiler = profiler
+            profiler.start(duration, on_complete)
+        return profiler
 
-        self.mqtt_client.on_connect = on_connect
+    def start_startup_profile(self) -> None:
+        if self.profile_on_start <= 0:
+            return
 
-        def on_message(client, userdata, msg) -> None:
-            return self.handle_message(client, userdata, msg)
+        def write(profiler: SamplingProfiler) -> None:
+            profiler.write(self.profile_dir)
 
-        self.mqtt_client.on_message = on_message
-        self.mqtt_client.on_disconnect = lambda *args: self.handle_disconnect(*args)
-        self.mqtt_client.on_connect_fail = lambda *args: self.handle_connect_fail(*args)
+        self.start_profile(self.profile_on_start, on_complete=write)
 
-        self.mqtt_client.will_set(
-            f"{self.my_base_topic}/status", "Abnormally Disconnected", 1, True
+    def handle_profile(self, client, request: BridgeRequest) -> None:
+        """
+        Takes a profile and publishes its summary once it's done. The payload
+        may set `duration` and `interval` in seconds, `top`, the number of
+        functions to list, and `write`, to also write it to `profile_dir`.
+        :param client:
+        :param request: The parsed command
+        :return:
+        """
+        options = request.payload or {}
+        duration = float(options.get("duration", 10.0))
+        interval = options.get("interval")
+        top = int(options.get("top", 20))
+        write = bool(options.get("write", False))
+
+        def publish(profiler: SamplingProfiler) -> None:
+            summary = profiler.summary(top)
+            if write:
+                summary["file"] = profiler.write(self.profile_dir, top)
+            message = MQTTResponse(
+                data=summary, bridge_ident=request.bridge_ident
+            ).to_bytes()
+            self.call_soon_threadsafe(
+                lambda: self.publish_reply(client, request, message)
+            )
+
+        self.start_profile(
+            duration, float(interval) if interval else None, on_complete=publish
         )
+
+    def call_soon_threadsafe(self, func: Callable) -> None:
+        """
+        Runs `func` where it may use the MQTT client, from any thread.
+        :param func:
+        :return:
+        """
+        func()
+
+    def go(self):
+        """
+        Run the bridge. This calls the Paho client's `.loop_forever()` method,
+        which blocks until the Paho client is disconnected.
+        :return:
+        """
+        self.logger.info("Starting MQTTBridge")
+        self.run = True
+        self.start_startup_profile()
+        self.configure_client()
         self.logger.info(
             f"Connecting to MQTT server at {self.mqtt_server}:{self.mqtt_port}"
         )
@@ -117,31 +530,71 @@ class Bridge:
                 self.mqtt_client.connect(self.mqtt_server, self.mqtt_port, 60)
                 break
             except ConnectionRefusedError:
+                self.metrics.mqtt_connect_failures.inc()
                 self.logger.error(
                     "Connection to MQTT server refused. Retrying in 10 seconds"
                 )
                 time.sleep(10)
             except socket.timeout:
+                self.metrics.mqtt_connect_failures.inc()
                 self.logger.error(
                     "Connection to MQTT server timed out. Retrying in 10 seconds"
                 )
                 time.sleep(10)
             except SSLCertVerificationError as e:
+                self.metrics.mqtt_connect_failures.inc()
                 self.logger.error(f"SSL Error. Retrying in 10 seconds. Error: {e}")
                 time.sleep(10)
 
-        # Schedule some tasks with `https://schedule.readthedocs.io/en/stable/`
-        self.scheduled_jobs.append(
-            schedule.every(10).seconds.do(self.publish_periodic_data)
-        )
+        # Listen for network changes, then schedule polls for everything
+        # else with `https://schedule.readthedocs.io/en/stable/`
+        self.start_netlink_monitor()
+        self.schedule_periodic_data()
+        if self.metrics_server:
+            self.metrics_server.start()
 
-        # Start the MQTT client loop,
+        # Start the workers that handle inbound commands and polls, then the
+        # MQTT client loop,
+        self.dispatcher.start()
+        self.poller.start()
         self.mqtt_client.loop_start()
 
         while self.run:
             schedule.run_pending()
             time.sleep(1)
 
+    def configure_client(self) -> None:
+        """
+        Wires the Paho client's callbacks up to the bridge and sets our last
+        will.
+        :return:
+        """
+
+        def on_connect(client, userdata, flags, reason_code, properties) -> None:
+            if reason_code.is_failure:
+                self.metrics.mqtt_connect_failures.inc()
+            else:
+                self.metrics.mqtt_connects.inc()
+            # Aliases are per connection, and the server says how many it'll
+            # take.
+            self.topic_aliases.reset(
+                getattr(properties, "TopicAliasMaximum", 0) if self.mqtt_v5 else 0
+            )
+            return self.handle_connect(client, userdata, flags, reason_code, properties)
+
+        self.mqtt_client.on_connect = on_connect
+
+        def on_message(client, userdata, msg) -> None:
+            return self.handle_message(client, userdata, msg)
+
+        self.mqtt_client.on_message = on_message
+        self.mqtt_client.on_disconnect = lambda *args: self.handle_disconnect(*args)
+        self.mqtt_client.on_connect_fail = lambda *args: self.handle_connect_fail(*args)
+
+        self.mqtt_client.will_set(
+            f"{self.my_base_topic}/status", "Abnormally Disconnected", 1, True
+        )
+
     def stop(self) -> None:
         """
         Closes the MQTT connection and shuts down any scheduled tasks for a clean exit.
@@ -149,13 +602,31 @@ class Bridge:
         """
         self.logger.info("Stopping MQTTBridge")
         self.run = False
+        # Let the commands and polls already under way publish their answers
+        # while we're still connected. New commands are answered as busy,
+        # and broadcasts still waiting out their delay are dropped.
+        dropped = self.timers.stop()
+        with self.deferred_requests_lock:
+            self.deferred_requests -= dropped
+        self.dispatcher.stop(timeout=self.drain_timeout)
+        self.poller.stop(timeout=self.drain_timeout)
         self.mqtt_client.publish(
             f"{self.my_base_topic}/status", "Disconnected", 1, True
         )
         self.mqtt_client.disconnect()
         self.mqtt_client.loop_stop()
+        if self.netlink_monitor:
+            self.netlink_monitor.stop()
+        if self.metrics_server:
+            self.metrics_server.stop()
+        if self.profiler is not None:
+            self.profiler.stop()
+        self.core_client.close()
+        self.logger.info(
+            "Response cache statistics: %s", self.core_client.response_cache.stats()
+        )
 
-        for job in self.scheduled_jobs:
+        for job in list(self.scheduled_jobs):
             schedule.cancel_job(job)
             self.scheduled_jobs.remove(job)
 
@@ -165,13 +636,102 @@ class Bridge:
         :param topic: The MQTT topic to subscribe to
         :return: Whether the subscription was successfully added
         """
-        if topic not in self.topics_of_interest:
-            result, mid = self.mqtt_client.subscribe(topic)
-            self.topics_of_interest.append(topic)
-            self.logger.debug(f"Sub result: {str(result)}")
-            return result == mqtt.MQTT_ERR_SUCCESS
-        else:
-            return True
+        return self.add_subscriptions([topic])
+
+    def add_subscriptions(self, topics: Iterable[str]) -> bool:
+        """
+        Adds MQTT subscriptions, and tracks them for re-subscription on
+        reconnect. While disconnected, they are only tracked, and will be
+        subscribed to along with everything else once connected.
+        :param topics: The MQTT topics to subscribe to
+        :return: Whether the subscriptions were successfully added
+        """
+        with self.routes_lock:
+            known = set(self.topics_of_interest)
+            new_topics = [t for t in dict.fromkeys(topics) if t not in known]
+            self.topics_of_interest.extend(new_topics)
+            if not new_topics or not self.connected:
+                return True
+            return self.subscribe(self.mqtt_client, new_topics)
+
+    def set_subscriptions(self, topics: Iterable[str]) -> None:
+        """
+        Replaces the tracked subscriptions. While connected, only the
+        difference is sent: new filters are subscribed to before stale ones
+        are unsubscribed from, so no message is missed in between.
+        :param topics: The MQTT topics to be subscribed to
+        :return:
+        """
+        with self.routes_lock:
+            self.topics_of_interest = list(dict.fromkeys(topics))
+            if self.connected:
+                self.sync_subscriptions(self.mqtt_client)
+
+    def sync_subscriptions(self, client) -> bool:
+        """
+        Subscribes to whatever the topics of interest need that isn't
+        subscribed to on this connection yet, then unsubscribes from filters
+        they no longer need.
+        :param client:
+        :return: Whether every SUBSCRIBE and UNSUBSCRIBE was sent successfully
+        """
+        wanted = set(
+            collapse_topic_filters(
+                [*self.topics_of_interest, *self.bridge_endpoints],
+                self.subscription_collapse_depth,
+            )
+        )
+        stale = [f for f in self.subscribed_filters if f not in wanted]
+        self.subscribed_filters = [f for f in self.subscribed_filters if f in wanted]
+        success = self.subscribe(client, wanted)
+        for start in range(0, len(stale), self.subscription_batch_size):
+            end = start + self.subscription_batch_size
+            batch = stale[start:end]
+            result, mid = client.unsubscribe(batch)
+            self.logger.debug(
+                "Unsubscribed from %d filters in one packet, result: %s",
+                len(batch),
+                result,
+            )
+            if result != mqtt.MQTT_ERR_SUCCESS:
+                success = False
+        return success
+
+    def subscribe(self, client, topics: Iterable[str]) -> bool:
+        """
+        Subscribes to topics in as few SUBSCRIBE packets as possible, skipping
+        any already covered by a filter subscribed to on this connection.
+        :param client:
+        :param topics: The MQTT topics or filters to subscribe to
+        :return: Whether every SUBSCRIBE was sent successfully
+        """
+        filters = [
+            topic_filter
+            for topic_filter in collapse_topic_filters(
+                topics, self.subscription_collapse_depth
+            )
+            if not any(
+                topic_filter_covers(subscribed, topic_filter)
+                for subscribed in self.subscribed_filters
+            )
+        ]
+        success = True
+        for start in range(0, len(filters), self.subscription_batch_size):
+            end = start + self.subscription_batch_size
+            batch = filters[start:end]
+            result, mid = client.subscribe(
+                [(topic_filter, 0) for topic_filter in batch]
+            )
+            self.logger.debug(
+                "Subscribed to %d filters in one packet, result: %s",
+                len(batch),
+                result,
+            )
+            if result == mqtt.MQTT_ERR_SUCCESS:
+                self.subscribed_filters.extend(batch)
+            else:
+                success = False
+        return success
 
     # noinspection PyUnusedLocal
     def handle_disconnect(self, client, *data) -> None:
@@ -179,6 +739,8 @@ class Bridge:
             f"Disconnected from MQTT server at {self.mqtt_server}:{self.mqtt_port}!"
         )
         self.connected = False
+        self.metrics.mqtt_disconnects.inc()
+        self.topic_aliases.reset()
 
         self.logger.warning(f"Disconnect details: {data}")
 
@@ -188,6 +750,7 @@ class Bridge:
             f"Failed to connect to MQTT server at {self.mqtt_server}:{self.mqtt_port}!"
         )
         self.connected = False
+        self.metrics.mqtt_connect_failures.inc()
         self.logger.warning(f"Failure details: {data}")
 
     # noinspection PyUnusedLocal
@@ -209,177 +772,953 @@ class Bridge:
             f"Connected to MQTT server at {self.mqtt_server}:{self.mqtt_port} with result code {reason_code}."
         )
 
-        # Get our routes added.
-        self.add_routes_from_openapi_definition()
+        if self.has_routes():
+            # Serve the routes we have now, and check them against the core
+            # without holding up the connection.
+            self.setup_connection(client, Utils.get_model_info())
+            self.validate_routes_in_background(client)
+        else:
+            # There's nothing to route commands with until the core answers.
+            self.refresh_openapi_definition()
+            self.setup_connection(client, Utils.get_model_info())
+
+        # Now do the first round of periodic data:
+        self.publish_periodic_data()
 
-        self.logger.info("Subscribing to topics of interest.")
-        # Subscribe to the topics we're going to care about.
-        for topic in self.topics_of_interest:
-            self.logger.debug(f"Subscribing to {topic}")
-            client.subscribe(topic)
+    def has_routes(self) -> bool:
+        """
+        :return: Whether routes can be set up without asking the core, from
+            an earlier connection, the route snapshot, or the cached OpenAPI
+            definition.
+        """
+        return (
+            self.routes_digest is not None or self.openapi_cache.definition is not None
+        )
 
-        # Once we're ready, announce that we're connected:
-        client.publish(f"{self.my_base_topic}/status", "Connected", 1, True)
+    def refresh_openapi_definition(self, wait_for_core: bool = False) -> bool:
+        """
+        Revalidates the cached OpenAPI definition against the core. If there
+        is no cached copy yet, this waits until the core answers.
+        :param wait_for_core: Wait for the core to answer even if there is a
+            cached copy.
+        :return: Whether the definition changed
+        """
+        while self.run or not wait_for_core:
+            try:
+                return self.openapi_cache.update_from_response(
+                    self.core_client.fetch_openapi_definition(self.openapi_cache.etag)
+                )
+            except (ValueError, RequestException) as e:
+                if self.openapi_cache.definition is not None and not wait_for_core:
+                    self.logger.warning(
+                        "Unable to revalidate OpenAPI definition, using the "
+                        "cached copy: %s",
+                        e,
+                    )
+                    return False
+                self.logger.warning(
+                    "Failed to fetch OpenAPI definition from %s, waiting 5 "
+                    "seconds. %s",
+                    self.core_client.openapi_def_path,
+                    e,
+                )
+                time.sleep(5)
+        return False
 
-        self.connected = True
+    def check_openapi_definition(self) -> None:
+        """
+        Checks the core's OpenAPI definition for changes in the background,
+        such as after the core has been upgraded, and updates the routes and
+        subscriptions to match. Safe to call from any thread.
+        :return:
+        """
+        if self.connected:
+            self.validate_routes_in_background(self.mqtt_client)
 
-        # Publish our current API definition to our own topic:
-        self.logger.debug("Telling them a little about ourselves.")
-        openapi_definition = self.core_client.get_openapi_definition()
-        client.publish(
-            f"{self.my_base_topic}/openapi", json.dumps(openapi_definition), 1, True
+    def validate_routes_in_background(self, client) -> None:
+        """
+        Starts a thread that waits for the core's OpenAPI definition, then
+        brings the routes and our `openapi` topic up to date with it. Does
+        nothing if one is already running.
+        :param client:
+        :return:
+        """
+        if self.route_validation is not None and self.route_validation.is_alive():
+            return
+        self.route_validation = threading.Thread(
+            target=self.validate_routes,
+            args=(client,),
+            name="route-validation",
+            daemon=True,
         )
+        self.route_validation.start()
+
+    def validate_routes(self, client) -> None:
+        """
+        Waits for the core's OpenAPI definition, then brings the routes and
+        our `openapi` topic up to date with it.
+        :param client:
+        :return:
+        """
+        try:
+            self.refresh_openapi_definition(wait_for_core=True)
+            self.update_routes()
+            if self.connected:
+                self.publish_openapi_definition(client)
+        except Exception as e:
+            self.logger.error("Unable to validate routes against the core", exc_info=e)
+
+    def setup_connection(self, client, model_info: dict[str, str]) -> None:
+        """
+        Adds routes, subscribes to them and announces ourselves once a
+        connection is established and the core's API definition, or a route
+        snapshot, is known.
+        :param client:
+        :param model_info: Model information about this device
+        :return:
+        """
+        # The broker may have lost our retained messages while we were away,
+        # so publish everything on the next round.
+        self.change_tracker.reset()
+
+        with self.routes_lock:
+            # Get our routes added, unless they're already built from this
+            # definition.
+            self.update_routes()
+
+            self.logger.info("Subscribing to topics of interest.")
+            # Subscribe to the topics we're going to care about. This is a new
+            # session, so nothing is subscribed yet.
+            self.subscribed_filters = []
+            self.subscribe(client, [*self.topics_of_interest, *self.bridge_endpoints])
+
+            # Once we're ready, announce that we're connected:
+            client.publish(f"{self.my_base_topic}/status", "Connected", 1, True)
+
+            self.connected = True
+
+        self.publish_openapi_definition(client)
+
+        self.broadcast_policy.model = model_info.get("Model")
 
         # Publish model data
         model_base_topic = f"{self.my_base_topic}/model"
-        for name, value in Utils.get_model_info().items():
+        for name, value in model_info.items():
             client.publish(
                 f"{model_base_topic}/{name.lower().replace(' ', '_')}", value, 1, True
             )
 
-        # Now do the first round of periodic data:
-        self.publish_periodic_data()
+    def update_routes(self) -> bool:
+        """
+        Updates the routes from the cached OpenAPI definition if they were
+        built from a different one, and saves them to the route snapshot.
+        :return: Whether the routes were updated
+        """
+        with self.routes_lock:
+            openapi_definition = self.openapi_cache.definition
+            digest = self.openapi_cache.digest
+            if openapi_definition is None or digest is None:
+                return False
+            if digest == self.routes_digest:
+                return False
+            routes = self.routes_from_openapi_definition(openapi_definition)
+            self.reconcile_routes(routes, digest)
+            self.core_client.response_cache.set_core_ttls(
+                ttls_from_openapi_definition(openapi_definition)
+            )
+            self.route_snapshot.update(
+                digest, self.my_base_topic, routes, self.topics_of_interest
+            )
+            return True
+
+    def publish_openapi_definition(self, client) -> None:
+        """
+        Publishes the core's API definition to our own topic. It's retained,
+        so this only does so when it has changed.
+        :param client:
+        :return:
+        """
+        openapi_definition = self.openapi_cache.definition
+        digest = self.openapi_cache.digest
+        if openapi_definition is None or digest == self.published_openapi_digest:
+            return
+        self.logger.debug("Telling them a little about ourselves.")
+        payload, properties = self.encode_payload(
+            json.dumps(openapi_definition).encode("utf-8"),
+            self.compressed_topics.get("openapi"),
+        )
+        client.publish(
+            f"{self.my_base_topic}/openapi",
+            payload,
+            1,
+            True,
+            properties=properties,
+        )
+        self.published_openapi_digest = digest
+
+    def first_poll_delay(self, interval: float) -> float:
+        """
+        :param interval: The poll interval
+        :return: How long to wait before the first scheduled poll
+        """
+        return random.uniform(0, interval) if self.poll_jitter else interval
+
+    def start_netlink_monitor(self) -> bool:
+        """
+        Starts listening for the kernel's network change notifications.
+        :return: Whether network state is event driven, rather than polled
+        """
+        return self.netlink_monitor is not None and self.netlink_monitor.start()
+
+    def is_event_driven(self, name: str) -> bool:
+        """
+        :param name: A monitored endpoint or autopublished topic
+        :return: Whether it's refreshed by netlink events instead of polled
+        """
+        return (
+            self.netlink_monitor is not None
+            and self.netlink_monitor.running
+            and name in self.netlink_triggers
+        )
+
+    def poll_due(self, name: str, interval: float) -> bool:
+        """
+        Decides, each time its scheduled poll comes round, whether to poll an
+        endpoint or topic. Those refreshed by netlink events are only polled
+        every `force_refresh_interval` seconds, to catch any change an event
+        missed. If the netlink monitor stops they're polled as usual again.
+        :param name: A monitored endpoint or autopublished topic
+        :param interval: Its poll interval
+        :return: Whether to poll it now
+        """
+        if not self.is_event_driven(name) or name not in self.last_polled:
+            return True
+        fallback = max(interval, self.change_tracker.force_refresh_interval)
+        # Allow for the scheduler waking a little early.
+        return time.monotonic() - self.last_polled[name] >= fallback - interval / 2
+
+    def triggered_by(self, name: str, kinds: set[str]) -> bool:
+        """
+        :param name: A monitored endpoint or autopublished topic
+        :param kinds: The kinds of netlink event seen
+        :return: Whether those events should refresh it
+        """
+        return not kinds.isdisjoint(self.netlink_triggers.get(name, ()))
+
+    def handle_netlink_events(self, kinds: set[str]) -> None:
+        """
+        Refreshes everything that follows the kind of network change the
+        kernel just reported. Runs on the netlink monitor's thread.
+        :param kinds: The kinds of change seen, e.g. {"link", "address"}
+        :return:
+        """
+        # Cached core responses may describe the network as it was.
+        self.core_client.response_cache.invalidate()
+        if not self.connected:
+            return
+        self.logger.info("Network changed (%s), refreshing", ", ".join(sorted(kinds)))
+        for endpoint, retain, _ in self.monitored_core_endpoints:
+            if self.triggered_by(endpoint, kinds):
+                self.submit_poll(
+                    self.poll_monitored_endpoint, endpoint, retain, rerun=True
+                )
+        for topic, data_function, retain, _ in self.autopublished_topics:
+            if self.triggered_by(topic, kinds):
+                self.submit_poll(
+                    self.poll_autopublished_topic,
+                    topic,
+                    data_function,
+                    retain,
+                    rerun=True,
+                )
+
+    def schedule_periodic_data(self) -> None:
+        """
+        Schedules a recurring poll for each periodically published topic. Those
+        refreshed by netlink events skip most of theirs, see `poll_due`.
+        """
+        polls: list[tuple[float, Callable, tuple]] = [
+            (interval, self.poll_monitored_endpoint, (endpoint, retain))
+            for endpoint, retain, interval in self.monitored_core_endpoints
+        ] + [
+            (interval, self.poll_autopublished_topic, (topic, data_function, retain))
+            for topic, data_function, retain, interval in self.autopublished_topics
+        ]
+        for interval, poll, args in polls:
+            # schedule handles fractional intervals fine, despite its hints.
+            job = schedule.every(interval).seconds.do(  # type: ignore[arg-type]
+                self.submit_scheduled_poll, interval, poll, *args
+            )
+            job.next_run = datetime.datetime.now() + datetime.timedelta(
+                seconds=self.first_poll_delay(interval)
+            )
+            self.scheduled_jobs.append(job)
+
+        if self.openapi_check_interval > 0:
+            job = schedule.every(
+                self.openapi_check_interval  # type: ignore[arg-type]
+            ).seconds.do(self.check_openapi_definition)
+            self.scheduled_jobs.append(job)
+
+        if self.metrics_publish_interval > 0:
+            job = schedule.every(
+                self.metrics_publish_interval  # type: ignore[arg-type]
+            ).seconds.do(self.publish_metrics)
+            self.scheduled_jobs.append(job)
 
     def publish_periodic_data(self) -> None:
-        """Publishes data periodically"""
-        # self.__client.publish()
+        """Publishes all periodic data now"""
         if not self.connected:
             self.logger.info("Not connected, skipping periodic publish")
             return
 
         self.logger.info("Publishing periodic data.")
-        for endpoint, retain in self.monitored_core_endpoints:
-            self.logger.debug(f"Publishing monitored topic: '{endpoint}'")
-            try:
-
-                response = self.core_client.execute_request("get", endpoint)
-                self.mqtt_client.publish(
-                    f"{self.my_base_topic}/{endpoint}/_current",
-                    MQTTResponse(
-                        data=response.text,
-                        rest_reason=response.reason,
-                        rest_status=response.status_code,
-                    ).to_json(),
-                    1,
-                    retain,
-                )
-            except Exception as e:
-                self.logger.error(
-                    f'Error publishing monitored core endpoint "{endpoint}" {e}'
-                )
+        for endpoint, retain, _ in self.monitored_core_endpoints:
+            self.submit_poll(self.poll_monitored_endpoint, endpoint, retain)
         # Publish current ip config
+        for topic, data_function, retain, _ in self.autopublished_topics:
+            self.submit_poll(
+                self.poll_autopublished_topic, topic, data_function, retain
+            )
+
+    def submit_scheduled_poll(
+        self, interval: float, poll: Callable, name: str, *args
+    ) -> None:
+        if self.poll_due(name, interval):
+            self.submit_poll(poll, name, *args)
+
+    def submit_poll(
+        self, poll: Callable, name: str, *args, rerun: bool = False
+    ) -> None:
+        """
+        Hands a poll to the poller, unless the previous poll of the same
+        endpoint or topic is still running.
+        :param poll: The poll method to run
+        :param name: The endpoint or topic being polled
+        :param rerun: If the previous poll is still running, poll again once
+            it finishes, as it may have read the old state
+        :return:
+        """
+        if not self.connected:
+            return
+        with self.polls_in_flight_lock:
+            if name in self.polls_in_flight:
+                if rerun:
+                    self.polls_pending.add(name)
+                    return
+                self.logger.debug("Previous poll of '%s' still running, skipping", name)
+                return
+            self.polls_in_flight.add(name)
 
-        for topic, data_function, retain in self.autopublished_topics:
-            self.logger.debug(f"Auto-Publishing: '{topic}'")
+        def run() -> None:
             try:
+                poll(name, *args)
+            finally:
+                with self.polls_in_flight_lock:
+                    self.polls_in_flight.discard(name)
+                    again = name in self.polls_pending
+                    self.polls_pending.discard(name)
+                if again:
+                    self.submit_poll(poll, name, *args)
 
-                data = data_function()
-                converted_data: Union[str, float, None] = data
-                if type(data) is MQTTResponse:
-                    converted_data = data.to_json()
-                elif type(data) not in [str, int, float, bool]:
-                    converted_data = json.dumps(data)
-                self.mqtt_client.publish(
-                    f"{self.my_base_topic}/{topic}", converted_data, 1, retain
-                )
-            except Exception as e:
-                self.logger.error(f'Error auto-publishing topic "{endpoint}" {e}')
+        if not self.poller.submit(run, timeout=0):
+            with self.polls_in_flight_lock:
+                self.polls_in_flight.discard(name)
+
+    def poll_monitored_endpoint(self, endpoint: str, retain: bool) -> None:
+        self.logger.debug("Publishing monitored topic: '%s'", endpoint)
+        self.last_polled[endpoint] = time.monotonic()
+        started = time.perf_counter()
+        try:
+            response = self.core_client.execute_request("get", endpoint)
+            self.publish_monitored_endpoint(endpoint, retain, response)
+        except Exception as e:
+            self.logger.error(
+                'Error publishing monitored core endpoint "%s" %s', endpoint, e
+            )
+        self.metrics.poll_seconds.observe(time.perf_counter() - started, endpoint)
+
+    def poll_autopublished_topic(
+        self, topic: str, data_function: Callable, retain: bool
+    ) -> None:
+        self.logger.debug("Auto-Publishing: '%s'", topic)
+        self.last_polled[topic] = time.monotonic()
+        started = time.perf_counter()
+        try:
+            self.publish_autopublished_topic(topic, data_function(), retain)
+        except Exception as e:
+            self.logger.error('Error auto-publishing topic "%s" %s', topic, e)
+        self.metrics.poll_seconds.observe(time.perf_counter() - started, topic)
+
+    def publish_monitored_endpoint(self, endpoint: str, retain: bool, response) -> None:
+        """
+        Publishes the core's response for a monitored endpoint to its
+        `_current` topic.
+        :param endpoint: The monitored core endpoint
+        :param retain: Whether the message should be retained
+        :param response: The core's response to a GET on the endpoint
+        :return:
+        """
+        topic = f"{self.my_base_topic}/{endpoint}/_current"
+        fingerprint = b"%d:" % response.status_code + response.content
+        if not self.change_tracker.should_publish(topic, fingerprint):
+            self.logger.debug("Monitored topic '%s' is unchanged, skipping", endpoint)
+            return
+
+        mqtt_response = MQTTResponse.from_core_response(response, status="success")
+        payload, properties = self.encode_payload(
+            mqtt_response.to_bytes(), self.compressed_topics.get(endpoint)
+        )
+        self.mqtt_client.publish(topic, payload, 1, retain, properties=properties)
+        if self.change_tracker.keep_snapshots:
+            self.publish_patch(
+                f"{self.my_base_topic}/{endpoint}/_patch", mqtt_response.data
+            )
+
+    def publish_autopublished_topic(self, topic: str, data: Any, retain: bool) -> None:
+        """
+        Publishes data the bridge produces itself to one of our own topics.
+        :param topic: The topic, relative to our base topic
+        :param data: The data to publish
+        :param retain: Whether the message should be retained
+        :return:
+        """
+        full_topic = f"{self.my_base_topic}/{topic}"
+        converted_data: Union[str, bytes, float, None] = data
+        properties: Optional[Properties] = None
+        if type(data) is MQTTResponse:
+            converted_data = data.to_bytes()
+            # The response's timestamp changes every time, so only its data
+            # is used to detect changes.
+            fingerprint = json.dumps(data.data, sort_keys=True, default=str)
+        elif type(data) not in [str, int, float, bool]:
+            converted_data = json.dumps(data).encode("utf-8")
+            fingerprint = converted_data.decode("utf-8")
+        else:
+            fingerprint = str(data)
+
+        if not self.change_tracker.should_publish(full_topic, fingerprint.encode()):
+            self.logger.debug("Auto-published topic '%s' is unchanged, skipping", topic)
+            return
+
+        # Only JSON is encoded, not plain values like our status.
+        if isinstance(converted_data, bytes):
+            converted_data, properties = self.encode_payload(
+                converted_data, self.compressed_topics.get(topic)
+            )
+        self.mqtt_client.publish(
+            full_topic, converted_data, 1, retain, properties=properties
+        )
+        if type(data) is MQTTResponse:
+            self.publish_patch(f"{full_topic}/_patch", data.data)
+
+    def publish_patch(self, patch_topic: str, data: Any) -> None:
+        """
+        If patches are enabled, publishes a JSON merge patch between the data
+        last published to a topic and its current data.
+        :param patch_topic: The topic to publish the patch to
+        :param data: The data that was just published
+        :return:
+        """
+        previous = self.change_tracker.swap_snapshot(patch_topic, data)
+        if previous is None or previous == data:
+            return
+        self.mqtt_client.publish(
+            patch_topic,
+            MQTTResponse(data=Utils.json_merge_patch(previous, data)).to_bytes(),
+            1,
+            False,
+        )
 
     def handle_message(self, client, userdata, msg) -> None:
         """
         Handles all incoming MQTT messages, usually dispatching them onward
-        to the REST API
+        to the REST API. This runs on Paho's network thread, so the REST call
+        itself is handed off to the dispatcher.
         :param client:
         :param userdata:
         :param msg:
         :return:
         """
-        self.logger.debug(
-            f"Received message on topic '{msg.topic}': {str(msg.payload)}"
-        )
-        self.logger.debug(f"User Data: {str(userdata)}")
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(
+                StructuredMessage(
+                    "Received message",
+                    topic=msg.topic,
+                    payload=msg.payload,
+                    userdata=userdata,
+                )
+            )
+
+        handler = self.bridge_endpoints.get(msg.topic)
+        if handler is not None:
+            self.handle_bridge_command(client, msg, handler)
+            return
 
-        route = self.topic_matcher.get_route_from_topic(msg.topic)
-        if route:
-            bridge_ident = None
+        if self.subscription_collapse_depth > 0 and not is_command_topic(msg.topic):
+            # Collapsed filters also deliver our own responses and published
+            # data. Only commands get an answer, or we'd answer ourselves.
+            return
+
+        started = time.perf_counter()
+        resolved = self.topic_matcher.resolve_topic(msg.topic)
+        if resolved:
+            route, parameters = resolved
+            self.metrics.messages.inc(self.route_label(route, parameters), route.method)
             try:
-                if msg.payload is not None and msg.payload not in ["", b""]:
-                    payload = json.loads(msg.payload)
-                    bridge_ident = payload.get("_bridge_ident", None)
-                    if bridge_ident is not None:
-                        del payload["_bridge_ident"]
-                    query_params = payload.get("_query_params", None)
-                    if query_params is not None:
-                        del payload["_query_params"]
-                    if not payload:
-                        payload = None
-                else:
-                    query_params = None
-                    payload = None
-
-                response = self.core_client.execute_request(
-                    method=route.method,
-                    path=route.route,
-                    data=payload if route.method.lower() != "get" else None,
-                    params=(
-                        payload
-                        if route.method.lower() == "get" and not query_params
-                        else query_params
-                    ),
-                )
-                mqtt_response = MQTTResponse(
-                    status="success" if response.ok else "rest_error",
-                    rest_status=response.status_code,
-                    rest_reason=response.reason,
-                    data=response.text,
-                    bridge_ident=bridge_ident,
-                )
-                route.callback(
-                    client=client,
-                    topic=route.response_topic,
-                    message=mqtt_response.to_json(),
-                )
+                request = BridgeRequest.from_payload(route, msg.payload, msg.properties)
             except Exception as e:
                 self.logger.error(
-                    f"Exception while handling message on topic '{msg.topic}'",
-                    exc_info=e,
+                    "Unable to parse message on topic '%s'", msg.topic, exc_info=e
                 )
-                client.publish(
-                    route.response_topic,
+                self.publish_reply(
+                    client,
+                    BridgeRequest(route, **BridgeRequest.reply_fields(msg.properties)),
                     MQTTResponse(
                         status="bridge_error",
                         errors=[[get_full_class_name(e), str(e)]],
-                        bridge_ident=bridge_ident,
-                    ).to_json(),
+                    ).to_bytes(),
                 )
+                return
+
+            self.metrics.command_phase_seconds.observe(
+                time.perf_counter() - started, "match"
+            )
+
+            delay: Optional[float] = 0.0
+            if msg.topic.startswith(self.global_topic_prefix):
+                try:
+                    delay = self.broadcast_policy.decide(
+                        request.target, request.bridge_ident
+                    )
+                except ValueError as e:
+                    # Every device would answer at once, so don't.
+                    self.logger.warning(
+                        "Ignoring broadcast with invalid target on topic '%s': %s",
+                        msg.topic,
+                        e,
+                    )
+                    return
+                if delay is None:
+                    self.logger.debug(
+                        "Broadcast on '%s' isn't for this device", msg.topic
+                    )
+                    return
+
+            if delay:
+                self.defer_request(client, request, delay)
+            else:
+                self.accept_request(client, request)
 
         else:
-            client.publish(
-                f"{msg.topic}/_response",
+            self.metrics.unrouted_messages.inc()
+            self.publish_reply(
+                client,
+                BridgeRequest(
+                    Route(route=msg.topic, topic=msg.topic),
+                    **BridgeRequest.reply_fields(msg.properties),
+                ),
                 MQTTResponse(
                     status="bridge_error",
                     errors=[
                         [
                             "NoBridgeRouteFound",
-                            "No route found for topic  '{msg.topic}'",
+                            f"No route found for topic '{msg.topic}'",
                         ]
                     ],
-                ).to_json(),
+                ).to_bytes(),
             )
-            self.logger.warning(f"No route found for topic '{msg.topic}'")
+            self.logger.warning("No route found for topic '%s'", msg.topic)
 
-    def add_routes_from_openapi_definition(
-        self, openapi_definition: Optional[dict] = None
+    def accept_request(self, client, request: BridgeRequest) -> None:
+        """
+        Submits a parsed command, answering that the bridge is busy if it
+        can't be.
+        :param client:
+        :param request: The parsed command
+        :return:
+        """
+        if not self.submit_request(client, request):
+            self.reject_busy(client, request)
+
+    def reject_busy(self, client, request: BridgeRequest) -> None:
+        """
+        Answers a command the bridge has no room for.
+        :param client:
+        :param request: The parsed command
+        :return:
+        """
+        self.logger.warning(
+            StructuredMessage(
+                "Rejected request, bridge is busy",
+                topic=request.route.topic,
+                bridge_ident=request.bridge_ident,
+            )
+        )
+        self.publish_reply(
+            client,
+            request,
+            MQTTResponse(
+                status="bridge_error",
+                errors=[
+                    [
+                        "BridgeBusy",
+                        "Too many requests are already queued, try again later",
+                    ]
+                ],
+                bridge_ident=request.bridge_ident,
+            ).to_bytes(),
+        )
+
+    def defer_request(self, client, request: BridgeRequest, delay: float) -> None:
+        """
+        Submits a parsed command after a delay.
+        :param client:
+        :param request: The parsed command
+        :param delay: Seconds to wait first
+        :return:
+        """
+        # Commands waiting out their delay will land on the dispatcher's
+        # queue, so they count against its limit alongside those already there.
+        with self.deferred_requests_lock:
+            accepted = (
+                self.deferred_requests + self.dispatcher.queue_depth
+                < self.dispatcher.max_queue_depth
+            )
+            if accepted:
+                self.deferred_requests += 1
+        if not accepted:
+            self.reject_busy(client, request)
+            return
+
+        def run() -> None:
+            with self.deferred_requests_lock:
+                self.deferred_requests -= 1
+            self.accept_request(client, request)
+
+        self.call_later(delay, run)
+
+    def call_later(self, delay: float, func: Callable) -> None:
+        """
+        Runs `func` after `delay` seconds.
+        :param delay:
+        :param func:
+        :return:
+        """
+        self.timers.call_later(delay, func)
+
+    @staticmethod
+    def get_serialization_key(request: BridgeRequest) -> Optional[str]:
+        """
+        Requests that change state on the same REST path are run in the order
+        they arrived; everything else may run concurrently.
+        :param request: The parsed command
+        :return: The key to serialize the request on, if any
+        """
+        return None if request.is_get else request.route.route
+
+    def submit_request(self, client, request: BridgeRequest) -> bool:
+        """
+        Hands a parsed command off to be executed against the REST API.
+        :param client:
+        :param request: The parsed command
+        :return: Whether the command was accepted
+        """
+        return self.dispatcher.submit(
+            self.execute_request,
+            client,
+            request,
+            key=self.get_serialization_key(request),
+            timeout=self.dispatch_timeout,
+        )
+
+    def execute_request(self, client, request: BridgeRequest) -> None:
+        """
+        Executes a parsed command against the REST API and publishes the
+        result to the route's response topic. Runs on a dispatcher worker.
+        :param client:
+        :param request: The parsed command
+        :return:
+        """
+        route = request.route
+        try:
+            if self.should_stream(request):
+                self.stream_core_response(client, request)
+                return
+            started = time.perf_counter()
+            response = self.core_client.execute_request(
+                method=route.method,
+                path=route.route,
+                data=request.data,
+                params=request.params,
+            )
+            self.metrics.command_phase_seconds.observe(
+                time.perf_counter() - started, "rest"
+            )
+            self.publish_core_response(client, request, response)
+        except Exception as e:
+            self.publish_bridge_error(client, request, e)
+
+    def should_stream(self, request: BridgeRequest) -> bool:
+        """
+        :param request: The parsed command
+        :return: Whether to relay the core's response to it in chunks
+        """
+        if request.stream:
+            return True
+        if not self.stream_routes:
+            return False
+        segments = request.route.route.strip("/").split("/")
+        return any(
+            matches_template(template, segments) for template in self.stream_routes
+        )
+
+    def stream_core_response(self, client, request: BridgeRequest) -> None:
+        """
+        Executes a parsed command against the REST API, and publishes the
+        response's body in chunks as it's read, followed by a manifest. See
+        `ResponseStream`. Error responses are published as usual.
+        :param client:
+        :param request: The parsed command
+        :return:
+        """
+        route = request.route
+        started = time.perf_counter()
+        response = self.core_client.open_stream(
+            method=route.method,
+            path=route.route,
+            data=request.data,
+            params=request.params,
+        )
+        with response:
+            self.metrics.command_phase_seconds.observe(
+                time.perf_counter() - started, "rest"
+            )
+            if not response.ok:
+                self.publish_core_response(client, request, response)
+                return
+            stream = ResponseStream(
+                bridge_ident=request.bridge_ident,
+                rest_status=response.status_code,
+                rest_reason=response.reason,
+                content_type=response.headers.get("Content-Type"),
+                binary=self.mqtt_v5,
+            )
+            error: Optional[Exception] = None
+            try:
+                for data in response.iter_content(self.stream_chunk_size):
+                    self.publish_chunk(client, request, *stream.chunk(data))
+            except (RequestException, ConnectionError) as e:
+                # Either the core or the MQTT connection failed. There's no
+                # point in carrying on, as the receiver can't reassemble a
+                # body with a chunk missing.
+                self.logger.error(
+                    "Stopped streaming the response on '%s' after %d bytes: %s",
+                    route.topic,
+                    stream.size,
+                    e,
+                )
+                error = e
+        self.publish_reply(client, request, stream.manifest(error).to_bytes())
+
+    def publish_chunk(
+        self,
+        client,
+        request: BridgeRequest,
+        message: bytes,
+        user_properties: list[tuple[str, str]],
+        timeout: float = 30.0,
     ) -> None:
         """
-        Add routes to the bridge based on the open api definition.
-        :param openapi_definition: The parsed OpenAPI definition. If not
-            provided, the OpenAPI definition will be retrieved from the CoreClient.
-        :return: None
+        Publishes part of a streamed response, and waits for it to be written
+        so that only one chunk at a time is held in memory.
+        :param client:
+        :param request: The parsed command being answered
+        :param message: The chunk message
+        :param user_properties: The chunk's user properties, if it's binary
+        :param timeout: Seconds to wait for it to be written
+        :raises ConnectionError: If it wasn't written in time, or couldn't be
+            published at all
+        :return:
         """
-        if openapi_definition is None:
-            openapi_definition = self.core_client.get_openapi_definition()
+        info = self.publish_reply(
+            client, request, message, self.chunk_properties(user_properties)
+        )
+        if info.rc != mqtt.MQTT_ERR_SUCCESS:
+            raise ConnectionError(
+                f"Unable to publish a chunk to '{request.reply_topic}': "
+                f"{mqtt.error_string(info.rc)}"
+            )
+        try:
+            info.wait_for_publish(timeout)
+        except (RuntimeError, ValueError) as e:
+            raise ConnectionError(
+                f"Unable to publish a chunk to '{request.reply_topic}': {e}"
+            ) from e
+        if not info.is_published():
+            raise ConnectionError(
+                f"Timed out publishing a chunk to '{request.reply_topic}'"
+            )
+
+    def chunk_properties(
+        self, user_properties: list[tuple[str, str]]
+    ) -> Optional[Properties]:
+        """
+        :param user_properties: A chunk's user properties, if it's binary
+        :return: The chunk's publish properties. JSON chunks get the same
+            properties as any other answer.
+        """
+        if not user_properties:
+            return None
+        properties = Properties(PacketTypes.PUBLISH)
+        properties.ContentType = "application/octet-stream"
+        properties.UserProperty = user_properties
+        return properties
+
+    def publish_core_response(self, client, request: BridgeRequest, response) -> None:
+        """
+        Publishes the core's response to a command on the route's response
+        topic.
+        :param client:
+        :param request: The parsed command
+        :param response: The core's response
+        :return:
+        """
+        route = request.route
+        started = time.perf_counter()
+        message, properties = self.encode_payload(
+            MQTTResponse.from_core_response(
+                response, bridge_ident=request.bridge_ident
+            ).to_bytes(),
+            request.compression,
+        )
+        serialized = time.perf_counter()
+        self.publish_reply(client, request, message, properties, route.callback)
+        self.metrics.command_phase_seconds.observe(serialized - started, "serialize")
+        self.metrics.command_phase_seconds.observe(
+            time.perf_counter() - serialized, "publish"
+        )
+
+    def encode_payload(
+        self,
+        payload: bytes,
+        encoding: Optional[str] = None,
+        content_type: str = "application/json",
+    ) -> tuple[bytes, Optional[Properties]]:
+        """
+        Compresses a payload if asked to and it's big enough to be worth it,
+        and labels it with its content type and encoding on MQTT v5. On MQTT
+        3.1.1 there's nowhere to say, so receivers that asked for compression
+        should check whether a payload starts with `{` before decompressing.
+        :param payload: The serialized payload
+        :param encoding: The encoding to compress it with, if any
+        :param content_type: The payload's content type
+        :return: The payload to publish, and its publish properties
+        """
+        compressed = False
+        if encoding is not None and len(payload) >= self.compression_min_size:
+            payload = Compression.compress(payload, encoding)
+            compressed = True
+        if not self.mqtt_v5:
+            return payload, None
+        properties = Properties(PacketTypes.PUBLISH)
+        properties.ContentType = content_type
+        if compressed:
+            properties.UserProperty = [(Compression.ENCODING_PROPERTY, encoding)]
+        return payload, properties
+
+    def reply_properties(
+        self, request: BridgeRequest, properties: Optional[Properties] = None
+    ) -> Optional[Properties]:
+        """
+        :param request: The parsed command being answered
+        :param properties: The answer's publish properties so far, if any
+        :return: The answer's publish properties. On MQTT v5, these echo the
+            command's Correlation Data back and set the answer's expiry.
+        """
+        if not self.mqtt_v5:
+            return properties
+        if properties is None:
+            properties = Properties(PacketTypes.PUBLISH)
+            properties.ContentType = "application/json"
+        if request.correlation_data is not None:
+            properties.CorrelationData = request.correlation_data
+        if self.response_expiry > 0:
+            properties.MessageExpiryInterval = self.response_expiry
+        return properties
 
+    def publish_reply(
+        self,
+        client,
+        request: BridgeRequest,
+        message: bytes,
+        properties: Optional[Properties] = None,
+        publish: Optional[Callable] = None,
+    ) -> Any:
+        """
+        Publishes an answer to a command on its reply topic: the Response
+        Topic it was sent with on MQTT v5, or else the route's response
+        topic. On MQTT v5 the topic is sent as an alias where it can be.
+        :param client:
+        :param request: The parsed command being answered
+        :param message: The answer
+        :param properties: The answer's publish properties, if any
+        :param publish: Publishes the answer, called like a route's callback.
+            By default, it's published with `client.publish`.
+        :return: Whatever `publish` returns
+        """
+        properties = self.reply_properties(request, properties)
+
+        def send(topic: str) -> Any:
+            if publish is None:
+                return client.publish(topic, message, properties=properties)
+            return publish(
+                client=client, topic=topic, message=message, properties=properties
+            )
+
+        return self.topic_aliases.publish(request.reply_topic, properties, send)
+
+    def publish_bridge_error(
+        self, client, request: BridgeRequest, error: Exception
+    ) -> None:
+        """
+        Reports an exception raised while handling a command on the route's
+        response topic.
+        :param client:
+        :param request: The parsed command
+        :param error: The exception that was raised
+        :return:
+        """
+        route = request.route
+        self.logger.error(
+            StructuredMessage(
+                "Exception while handling request",
+                topic=route.topic,
+                bridge_ident=request.bridge_ident,
+            ),
+            exc_info=error,
+        )
+        self.publish_reply(
+            client,
+            request,
+            MQTTResponse(
+                status="bridge_error",
+                errors=[[get_full_class_name(error), str(error)]],
+                bridge_ident=request.bridge_ident,
+            ).to_bytes(),
+        )
+
+    def new_topic_matcher(self) -> TopicMatcher:
+        return TopicMatcher(compiled=True, route_cache_size=self.route_cache_size)
+
+    def routes_from_openapi_definition(self, openapi_definition: dict) -> list[Route]:
+        """
+        Works out the bridge's routes for an OpenAPI definition.
+        :param openapi_definition: The parsed OpenAPI definition
+        :return: A route on our own topics and one on the global topics for
+            each operation in the definition.
+        """
+        routes = []
         for uri, action in openapi_definition["paths"].items():
             for method, definition in action.items():
                 topic = f"{uri}/{method}"
@@ -390,42 +1729,152 @@ class Bridge:
                     method=method,
                     callback=self.default_callback,
                 )
-                self.add_route(my_route)
-                self.logger.debug("New OAPI route: ", my_route.__dict__)
+                routes.append(my_route)
                 # Add route to respond to global topics, but respond on our own.
-                global_route = Route(
-                    route=uri,
-                    topic=f"{self.__global_base_topic}{topic}",
-                    response_topic=my_route.response_topic,
-                    method=method,
-                    callback=self.default_callback,
+                routes.append(
+                    Route(
+                        route=uri,
+                        topic=f"{self.__global_base_topic}{topic}",
+                        response_topic=my_route.response_topic,
+                        method=method,
+                        callback=self.default_callback,
+                    )
                 )
-                self.add_route(global_route)
+        return routes
+
+    def add_routes_from_openapi_definition(
+        self, openapi_definition: Optional[dict] = None
+    ) -> None:
+        """
+        Add routes to the bridge based on the open api definition.
+        :param openapi_definition: The parsed OpenAPI definition. If not
+            provided, the OpenAPI definition will be retrieved from the CoreClient.
+        :return: None
+        """
+        if openapi_definition is None:
+            openapi_definition = self.core_client.get_openapi_definition()
+
+        # Subscribe to all the new routes at once, rather than a route at a
+        # time.
+        new_routes = {}
+        for route in self.routes_from_openapi_definition(openapi_definition):
+            new_routes.update(self.add_route(route, subscribe=False))
+            self.logger.debug("New OAPI route: %s", route.topic)
+        self.add_subscriptions(
+            route_node.get_wildcard_topic()
+            for route_path, route_node in new_routes.values()
+        )
         self.logger.debug("Routes from openapi definition added")
 
-    def add_route(self, route: Route):
+    def reconcile_routes(
+        self,
+        routes: Iterable[Route],
+        digest: Optional[str],
+        subscriptions: Optional[Iterable[str]] = None,
+    ) -> None:
+        """
+        Brings the route table in line with `routes`, adding and removing
+        only the routes that differ, then subscribes to the topics of new
+        routes and unsubscribes from those of removed ones. Commands arriving
+        meanwhile are routed by the table as it was until the change is
+        complete, and commands already accepted are unaffected.
+        :param routes: The routes to serve
+        :param digest: The digest of the OpenAPI definition they came from
+        :param subscriptions: The topic filters the routes need, if already
+            known. By default, they're worked out from the routes.
+        :return:
+        """
+
+        def signature(route: Optional[Route]) -> Optional[tuple]:
+            if route is None:
+                return None
+            return route.route, route.response_topic, route.method
+
+        with self.routes_lock:
+            current = {
+                topic: route_node.route
+                for topic, (route_path, route_node) in self.topic_matcher.routes.items()
+            }
+            wanted = {route.topic.lstrip("/"): route for route in routes}
+            # A route whose topic stays but whose details change is replaced.
+            remove = [
+                topic
+                for topic, route in current.items()
+                if topic not in wanted or signature(route) != signature(wanted[topic])
+            ]
+            add = [
+                route
+                for topic, route in wanted.items()
+                if topic not in current or topic in remove
+            ]
+            added, removed = self.topic_matcher.update(add=add, remove=remove)
+            self.routes_digest = digest
+
+            if subscriptions is None:
+                subscriptions = [
+                    route_node.get_wildcard_topic()
+                    for route_path, route_node in self.topic_matcher.routes.values()
+                ]
+            self.set_subscriptions(subscriptions)
+        self.logger.info(
+            "Serving %d routes for OpenAPI definition %s: %d added, %d removed",
+            len(self.topic_matcher.routes),
+            digest,
+            len(added),
+            len(removed),
+        )
+
+    def load_route_snapshot(self) -> bool:
+        """
+        Sets up the routes saved in the route snapshot, if there is one.
+        :return: Whether the snapshot was loaded
+        """
+        if not self.route_snapshot.load(self.my_base_topic):
+            return False
+        for route in self.route_snapshot.routes:
+            route.callback = self.default_callback
+        self.reconcile_routes(
+            self.route_snapshot.routes,
+            self.route_snapshot.digest,
+            self.route_snapshot.subscriptions,
+        )
+        return True
+
+    def add_route(self, route: Route, subscribe: bool = True):
         """
         Adds a route to the route lookup table
         :param route: A populated Route object.
+        :param subscribe: Whether to subscribe to the route's topic now. If
+            not, the caller is expected to.
         :return: Whether the Route was added to the lookup table.
         """
 
         new_routes = self.topic_matcher.add_route(route)
-        for route_key, [route_path, route_node] in new_routes.items():
-            new_topic = route_node.get_wildcard_topic()
-            self.add_subscription(new_topic)
+        if subscribe:
+            self.add_subscriptions(
+                route_node.get_wildcard_topic()
+                for route_path, route_node in new_routes.values()
+            )
         return new_routes
 
-    def default_callback(self, client, topic, message: Union[str, bytes]) -> None:
+    def default_callback(
+        self,
+        client,
+        topic,
+        message: Union[str, bytes],
+        properties: Optional[Properties] = None,
+    ) -> mqtt.MQTTMessageInfo:
         """
         Default callback for sending a REST response on to the MQTT endpoint.
         :param client:
-        :param topic:
+        :param topic: The topic to publish to, which is empty when a topic
+            alias in `properties` stands in for it
         :param message:
-        :return:
+        :param properties: MQTT v5 publish properties, if any
+        :return: The result of the publish, so a failed one can be told apart
         """
-        self.logger.info(f"Default callback. Topic: {topic} Message: {str(message)}")
-        client.publish(topic, message)
+        self.logger.debug("Default callback. Topic: %s Message: %s", topic, message)
+        return client.publish(topic, message, properties=properties)
 
     def __enter__(self) -> object:
         return self
@@ -0,0 +1,107 @@
+import importlib
+import logging
+import pkgutil
+import threading
+import time
+from typing import Any, Iterable, Optional
+
+PACKAGE = __name__.rsplit(".", 1)[0]
+
+
+class StructuredMessage:
+    """
+    A log message followed by `key=value` fields. Nothing is formatted unless
+    a handler actually emits the record, so pass one of these as the message
+    instead of building an f-string.
+
+        logger.debug(StructuredMessage("Received message", topic=msg.topic))
+    """
+
+    __slots__ = ("message", "fields")
+
+    def __init__(self, message: str, **fields: Any):
+        self.message = message
+        self.fields = fields
+
+    def __str__(self) -> str:
+        if not self.fields:
+            return self.message
+        fields = " ".join(f"{key}={value!r}" for key, value in self.fields.items())
+        return f"{self.message} {fields}"
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Limits how many records a logger emits with a token bucket: up to `burst`
+    records at once, refilled at `rate` records per second. Records over the
+    limit are dropped and counted, and the count is added to the next record
+    that gets through.
+
+    Logger filters only see records that passed the level check, so debug
+    records don't use up the budget while running at INFO.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        super().__init__()
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.suppressed = 0
+        self.lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            if self.tokens < 1:
+                self.suppressed += 1
+                return False
+            self.tokens -= 1
+            suppressed, self.suppressed = self.suppressed, 0
+
+        if suppressed:
+            record.msg = (
+                f"{record.getMessage()} ({suppressed} earlier messages from "
+                f"{record.name} were suppressed)"
+            )
+            record.args = None
+        return True
+
+
+def subsystems() -> list[str]:
+    """
+    Finds the modules that make up the bridge. Each logs through one logger
+    named after the module, so the set of loggers stays fixed no matter how
+    many routes, requests or nodes exist.
+    :return: The module names, relative to the package
+    """
+    package = importlib.import_module(PACKAGE)
+    return sorted(
+        module.name.removeprefix(f"{PACKAGE}.")
+        for module in pkgutil.walk_packages(package.__path__, f"{PACKAGE}.")
+    )
+
+
+def configure_rate_limits(
+    rate: float, burst: int, names: Optional[Iterable[str]] = None
+) -> None:
+    """
+    Gives each subsystem's logger its own rate limit, replacing any limit
+    set before.
+    :param rate: Records per second each subsystem may log once its burst is
+        used up. 0 or less removes the limits.
+    :param burst: Records each subsystem may log at once
+    :param names: The subsystems to limit, by module name. Defaults to every
+        module in the package.
+    :return:
+    """
+    for subsystem in subsystems() if names is None else names:
+        logger = logging.getLogger(f"{PACKAGE}.{subsystem}")
+        for existing in [f for f in logger.filters if isinstance(f, RateLimitFilter)]:
+            logger.removeFilter(existing)
+        if rate > 0:
+            logger.addFilter(RateLimitFilter(rate, burst))
@@ -0,0 +1,141 @@
+import hashlib
+import random
+from typing import Any, Iterable, Optional
+
+
+class BroadcastPolicy:
+    """
+    Decides whether, and after how long, this device answers a command sent
+    to every device on the `wlan-pi/all` topics. Without this, one broadcast
+    has the whole fleet call its core and publish a response at once.
+
+    Responses are spread over a random delay of up to `spread` seconds, and
+    only a `sample_rate` fraction of devices answer. A command can narrow
+    this further with a `_target` object in its payload, whose fields are
+    all optional and must all match:
+
+        {
+            "models": ["WLAN Pi Pro"],          # any of these models
+            "identifier_prefix": ["dc:a6:32"],  # identifiers starting with any
+            "tags": ["lab", "floor-2"],         # any of these tags
+            "sample": 0.1,                      # fraction of matching devices
+            "spread": 30                        # seconds to spread answers over
+        }
+
+    Identifiers are compared without case or the separators in MAC
+    addresses, so "DC-A6-32" and "dca632" select the same devices as
+    "dc:a6:32". A command whose `_target` is malformed is ignored rather
+    than answered, as every device would answer it at once.
+
+    Sampling is decided by hashing the identifier with the command's
+    `_bridge_ident`, so a repeated command reaches the same devices.
+    """
+
+    def __init__(
+        self,
+        identifier: str,
+        tags: Iterable[str] = (),
+        spread: float = 0.0,
+        max_spread: float = 60.0,
+        sample_rate: float = 1.0,
+    ):
+        """
+        :param identifier: This device's identifier
+        :param tags: Tags that `_target` may select this device by
+        :param spread: Seconds to spread answers over by default
+        :param max_spread: The longest spread a command may ask for
+        :param sample_rate: The fraction of devices that answer by default
+        """
+        self.identifier = identifier.lower()
+        self.identifier_key = self.identifier_key_of(identifier)
+        self.tags = {tag.lower() for tag in tags}
+        self.spread = max(0.0, spread)
+        self.max_spread = max(0.0, max_spread)
+        self.sample_rate = sample_rate
+        # Filled in once the model is known
+        self.model: Optional[str] = None
+
+    @staticmethod
+    def identifier_key_of(identifier: str) -> str:
+        """
+        :param identifier: An identifier, or the start of one
+        :return: It in lower case, without any MAC address separators
+        """
+        return identifier.lower().translate(str.maketrans("", "", ":-."))
+
+    @staticmethod
+    def as_list(target: dict, name: str) -> Optional[list[str]]:
+        value = target.get(name)
+        if value is None:
+            return None
+        if isinstance(value, str):
+            return [value.lower()]
+        if isinstance(value, list) and all(isinstance(item, str) for item in value):
+            return [item.lower() for item in value]
+        raise ValueError(f"_target.{name} must be a string or a list of strings")
+
+    @staticmethod
+    def as_number(target: dict, name: str, default: float) -> float:
+        value = target.get(name, default)
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError(f"_target.{name} must be a number")
+        return float(value)
+
+    def matches(self, target: dict) -> bool:
+        """
+        :param target: The command's `_target` object
+        :raises ValueError: If `target` is malformed
+        :return: Whether this device is one of the devices it selects
+        """
+        models = self.as_list(target, "models")
+        if models is not None and (self.model or "").lower() not in models:
+            return False
+        prefixes = self.as_list(target, "identifier_prefix")
+        if prefixes is not None and not self.identifier_key.startswith(
+            tuple(self.identifier_key_of(prefix) for prefix in prefixes)
+        ):
+            return False
+        tags = self.as_list(target, "tags")
+        if tags is not None and self.tags.isdisjoint(tags):
+            return False
+        return True
+
+    def sampled(self, rate: float, bridge_ident: Optional[Any]) -> bool:
+        """
+        :param rate: The fraction of devices that should answer
+        :param bridge_ident: The command's identifier, if it has one
+        :return: Whether this device is in the sample
+        """
+        if rate >= 1:
+            return True
+        if rate <= 0:
+            return False
+        if bridge_ident is None:
+            return random.random() < rate
+        digest = hashlib.blake2b(
+            f"{self.identifier}:{bridge_ident}".encode("utf-8"), digest_size=8
+        ).digest()
+        return int.from_bytes(digest, "big") / 2**64 < rate
+
+    def decide(
+        self, target: Optional[Any], bridge_ident: Optional[Any] = None
+    ) -> Optional[float]:
+        """
+        :param target: The command's `_target` object, if it has one
+        :param bridge_ident: The command's identifier, if it has one
+        :raises ValueError: If `target` is malformed
+        :return: How many seconds to wait before answering, or None if this
+            device shouldn't answer
+        """
+        if target is None:
+            target = {}
+        elif not isinstance(target, dict):
+            raise ValueError("_target must be an object")
+        if not self.matches(target):
+            return None
+        if not self.sampled(
+            self.as_number(target, "sample", self.sample_rate), bridge_ident
+        ):
+            return None
+        spread = min(self.as_number(target, "spread", self.spread), self.max_spread)
+        return random.uniform(0, spread) if spread > 0 else 0.0
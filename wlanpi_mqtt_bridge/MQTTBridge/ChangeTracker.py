@@ -0,0 +1,80 @@
+import hashlib
+import threading
+import time
+from typing import Any, Optional
+
+
+class ChangeTracker:
+    """
+    Remembers a digest of the last payload published to each topic, so that
+    periodic publishing can skip payloads that haven't changed. A payload is
+    still republished once `force_refresh_interval` seconds have passed since
+    it was last sent, so late subscribers and lost retained messages recover.
+
+    Optionally keeps the last published data for each topic as well, so that
+    callers can publish a patch describing what changed.
+    """
+
+    def __init__(
+        self, force_refresh_interval: float = 300.0, keep_snapshots: bool = False
+    ):
+        self.force_refresh_interval = force_refresh_interval
+        self.keep_snapshots = keep_snapshots
+        self._lock = threading.Lock()
+        # topic -> (digest, monotonic time last published)
+        self._published: dict[str, tuple[bytes, float]] = {}
+        self._snapshots: dict[str, Any] = {}
+
+    @staticmethod
+    def digest(fingerprint: bytes) -> bytes:
+        return hashlib.blake2b(fingerprint, digest_size=16).digest()
+
+    def should_publish(self, topic: str, fingerprint: bytes) -> bool:
+        """
+        Checks whether a payload needs to be published, and if so records it
+        as published.
+        :param topic: The topic the payload would be published to
+        :param fingerprint: Bytes that change whenever the payload's content
+            does. This should leave out things like timestamps.
+        :return: Whether the payload should be published
+        """
+        if self.force_refresh_interval <= 0:
+            return True
+
+        digest = self.digest(fingerprint)
+        now = time.monotonic()
+        with self._lock:
+            previous = self._published.get(topic)
+            if (
+                previous is not None
+                and previous[0] == digest
+                and now - previous[1] < self.force_refresh_interval
+            ):
+                return False
+            self._published[topic] = (digest, now)
+            return True
+
+    def swap_snapshot(self, topic: str, data: Any) -> Optional[Any]:
+        """
+        Stores the latest data published to a topic.
+        :param topic: The topic the data was published to
+        :param data: The data that was published
+        :return: The data previously published to the topic, if any
+        """
+        if not self.keep_snapshots:
+            return None
+        with self._lock:
+            previous = self._snapshots.get(topic)
+            self._snapshots[topic] = data
+            return previous
+
+    def reset(self) -> None:
+        """
+        Forgets everything that has been published, so that the next round
+        publishes everything again. Used after reconnecting, since the broker
+        may have lost retained messages.
+        :return:
+        """
+        with self._lock:
+            self._published.clear()
+            self._snapshots.clear()
@@ -0,0 +1,67 @@
+import threading
+import zlib
+from typing import Any, Callable, Optional
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None  # type: ignore
+
+# The user property that names a compressed payload's encoding on MQTT v5
+ENCODING_PROPERTY = "content-encoding"
+
+# A ZstdCompressor can't be used from more than one thread at once, and
+# responses are published from many, so each thread gets its own.
+_local = threading.local()
+
+
+def zstd_compress(payload: bytes) -> bytes:
+    compressor = getattr(_local, "zstd", None)
+    if compressor is None:
+        compressor = _local.zstd = zstandard.ZstdCompressor(level=3)
+    return compressor.compress(payload)
+
+
+# Compressors by encoding name, in order of preference. zstd is only offered
+# when the zstandard package is installed.
+COMPRESSORS: dict[str, Callable[[bytes], bytes]] = {}
+if zstandard is not None:
+    COMPRESSORS["zstd"] = zstd_compress
+COMPRESSORS["zlib"] = lambda payload: zlib.compress(payload, 6)
+
+
+def supported_encodings() -> list[str]:
+    return list(COMPRESSORS)
+
+
+def negotiate(requested: Optional[Any]) -> Optional[str]:
+    """
+    Picks an encoding from those a command asked for.
+    :param requested: An encoding name, a list of them in order of
+        preference, or True for the best we support
+    :raises ValueError: If `requested` is malformed
+    :return: The first requested encoding we support, or None
+    """
+    if requested is None or requested is False:
+        return None
+    if requested is True:
+        return next(iter(COMPRESSORS))
+    if isinstance(requested, str):
+        requested = [requested]
+    if not isinstance(requested, list) or not all(
+        isinstance(name, str) for name in requested
+    ):
+        raise ValueError("_compression must be an encoding or a list of encodings")
+    for name in requested:
+        if name.lower() in COMPRESSORS:
+            return name.lower()
+    return None
+
+
+def compress(payload: bytes, encoding: str) -> bytes:
+    """
+    :param payload: The payload to compress
+    :param encoding: One of the supported encodings
+    :return: The compressed payload
+    """
+    return COMPRESSORS[encoding](payload)
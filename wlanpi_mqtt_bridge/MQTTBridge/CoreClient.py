@@ -1,19 +1,125 @@
+import json
 import logging
+import socket
 import time
-from typing import Any, Optional
+from typing import TYPE_CHECKING, Any, Hashable, Optional
 
 import requests
-from requests import JSONDecodeError
+from requests import JSONDecodeError, RequestException
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.connectionpool import HTTPConnectionPool
+
+from .ResponseCache import ResponseCache
+from .SingleFlight import SingleFlight
+
+if TYPE_CHECKING:
+    from .Metrics import BridgeMetrics
+
+# Methods that don't change the core's state, so needn't invalidate cached
+# responses.
+SAFE_METHODS = ("get", "head", "options")
+
+
+class UnixSocketConnection(HTTPConnection):
+    """An HTTP connection made over a Unix domain socket instead of TCP"""
+
+    def __init__(self, *args, socket_path: str, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.socket_path = socket_path
+
+    def _new_conn(self) -> socket.socket:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if isinstance(self.timeout, (int, float)):
+            sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        return sock
+
+
+class UnixSocketConnectionPool(HTTPConnectionPool):
+    ConnectionCls = UnixSocketConnection
+
+    def __init__(self, socket_path: str, **kwargs):
+        super().__init__("localhost", **kwargs)
+        self.conn_kw["socket_path"] = socket_path
+
+
+class UnixSocketAdapter(HTTPAdapter):
+    """
+    A requests transport adapter that sends every request through a single
+    keep-alive connection pool on a Unix domain socket.
+    """
+
+    def __init__(self, socket_path: str, pool_maxsize: int = 10, **kwargs):
+        super().__init__(pool_maxsize=pool_maxsize, **kwargs)
+        self.socket_path = socket_path
+        self.unix_pool = UnixSocketConnectionPool(
+            socket_path, maxsize=pool_maxsize, block=False
+        )
+
+    # noinspection PyUnusedLocal
+    def get_connection_with_tls_context(self, request, verify, proxies=None, cert=None):
+        return self.unix_pool
+
+    # noinspection PyUnusedLocal
+    def get_connection(self, url, proxies=None):
+        return self.unix_pool
+
+    def close(self) -> None:
+        super().close()
+        self.unix_pool.close()
 
 
 class CoreClient:
     def __init__(
         self,
         base_url="http://127.0.0.1:31415",
+        socket_path: Optional[str] = None,
+        pool_size: int = 4,
+        connect_timeout: float = 3.0,
+        read_timeout: float = 30.0,
+        coalesce_gets: bool = True,
+        cache_max_entries: int = 256,
+        cache_default_ttl: float = 0.0,
+        cache_ttls: Optional[dict[str, float]] = None,
+        metrics: Optional["BridgeMetrics"] = None,
     ):
+        """
+        :param base_url: The base URL of the core REST API. When a socket path
+            is given, only the path portion of requests is meaningful.
+        :param socket_path: If set, requests are sent over this Unix domain
+            socket instead of TCP.
+        :param pool_size: The number of keep-alive connections to hold open
+            to the core. This should match the number of threads that make
+            requests concurrently.
+        :param connect_timeout: Seconds to wait for a connection to the core
+        :param read_timeout: Seconds to wait for the core to respond
+        :param coalesce_gets: Share one core request between identical GETs
+            made at the same time
+        :param cache_max_entries: The most GET responses to cache at once
+        :param cache_default_ttl: Seconds to cache GET responses for paths
+            without a TTL of their own. 0 doesn't cache them.
+        :param cache_ttls: Seconds to cache GET responses for, keyed by path
+            or OpenAPI path template
+        :param metrics: If given, requests to the core are counted in it
+        """
         self.logger = logging.getLogger(__name__)
-        self.logger.info(f"Initializing CoreClient against {base_url}")
+        self.logger.info(f"Initializing CoreClient against {socket_path or base_url}")
         self.base_url = base_url
+        self.socket_path = socket_path
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.metrics = metrics
+
+        # A single session keeps connections to the core alive between
+        # requests instead of opening a new one for every command and poll.
+        self.session = requests.Session()
+        adapter: HTTPAdapter
+        if socket_path:
+            adapter = UnixSocketAdapter(socket_path, pool_maxsize=pool_size)
+        else:
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount(self.base_url, adapter)
         self.api_url = f"{base_url}/api/v1"
         self.openapi_def_path = f"{self.api_url}/openapi.json"
 
@@ -21,6 +127,19 @@ class CoreClient:
             "accept": "application/json",
             # "content-type": "application/x-www-form-urlencoded",
         }
+        # Identical GETs that arrive while one is already in flight, say a
+        # dashboard and an automation asking for the same thing, wait for
+        # its response rather than asking the core again.
+        self.coalesce_gets = coalesce_gets
+        self.in_flight = SingleFlight()
+        # Successful GET responses are reused for a few seconds, by polls and
+        # commands alike. Any other request empties the cache, as it may
+        # have changed what the core would return.
+        self.response_cache = ResponseCache(
+            max_entries=cache_max_entries,
+            default_ttl=cache_default_ttl,
+            ttls=cache_ttls,
+        )
         self.logger.info("CoreClient initialized")
 
     def get_openapi_definition(self) -> dict:
@@ -28,37 +147,152 @@ class CoreClient:
 
         while True:
             try:
-                return requests.get(
-                    url=self.openapi_def_path, headers=self.base_headers
+                return self.session.get(
+                    url=self.openapi_def_path,
+                    headers=self.base_headers,
+                    timeout=self.timeout,
                 ).json()
-            except JSONDecodeError:
+            except (JSONDecodeError, RequestException):
                 self.logger.warning(
                     f"Failed to fetch OpenAPI definition from {self.openapi_def_path}"
                     ", waiting 5 seconds."
                 )
                 time.sleep(5)
 
+    def fetch_openapi_definition(self, etag: Optional[str] = None):
+        """
+        Makes a single request for the OpenAPI definition, conditional on
+        `etag` if given.
+        :param etag: The ETag of the copy we already have
+        :return: The core's response, which is a 304 if our copy is current
+        """
+        headers = dict(self.base_headers)
+        if etag:
+            headers["If-None-Match"] = etag
+        return self.session.get(
+            url=self.openapi_def_path, headers=headers, timeout=self.timeout
+        )
+
+    @staticmethod
+    def request_key(
+        method: str,
+        path: str,
+        data: Optional[Any] = None,
+        params: Optional[Any] = None,
+    ) -> Optional[Hashable]:
+        """
+        :return: A key shared by requests that can be answered by the same
+            core response, or None if the request mustn't be shared
+        """
+        if method.lower() != "get" or data is not None:
+            return None
+        try:
+            return path.strip("/"), json.dumps(params, sort_keys=True)
+        except (TypeError, ValueError):
+            return None
+
     def execute_request(
         self,
         method: str,
         path: str,
         data: Optional[Any] = None,
         params: Optional[Any] = None,
+    ):
+        key = self.request_key(method, path, data, params)
+        if key is None:
+            response = self.send_request(method, path, data, params)
+            if method.lower() not in SAFE_METHODS:
+                self.response_cache.invalidate()
+            return response
+
+        if self.response_cache.ttl_for(path) > 0:
+            cached = self.response_cache.get(key)
+            if cached is not None:
+                return cached
+        if not self.coalesce_gets:
+            return self.fetch(key, method, path, data, params)
+        return self.in_flight.do(key, self.fetch, key, method, path, data, params)
+
+    def fetch(
+        self,
+        key: Hashable,
+        method: str,
+        path: str,
+        data: Optional[Any] = None,
+        params: Optional[Any] = None,
+    ):
+        """Sends a GET request, caching the response if it succeeds"""
+        generation = self.response_cache.generation
+        response = self.send_request(method, path, data, params)
+        if response.status_code == 200:
+            self.response_cache.put(key, path, response, generation)
+        return response
+
+    def open_stream(
+        self,
+        method: str,
+        path: str,
+        data: Optional[Any] = None,
+        params: Optional[Any] = None,
+    ):
+        """
+        Sends a request without reading the response body, so that it can be
+        read a piece at a time with `iter_content`. The response isn't cached
+        and must be closed once done with.
+        """
+        response = self.send_request(method, path, data, params, stream=True)
+        if method.lower() not in SAFE_METHODS:
+            self.response_cache.invalidate()
+        return response
+
+    def send_request(
+        self,
+        method: str,
+        path: str,
+        data: Optional[Any] = None,
+        params: Optional[Any] = None,
+        stream: bool = False,
     ):
         self.logger.debug(
-            f"Executing {method.upper()} on path {path} with data: {str(data)}"
-        )
-        response = requests.request(
-            method=method,
-            params=params,
-            url=f"{self.base_url}/{path}",
-            json=data,
-            headers=self.base_headers,
+            "Executing %s on path %s with data: %s", method.upper(), path, data
         )
+        try:
+            response = self.session.request(
+                method=method,
+                url=self.url_for(path, params),
+                json=data,
+                headers=self.base_headers,
+                timeout=self.timeout,
+                stream=stream,
+            )
+        except RequestException:
+            if self.metrics:
+                self.metrics.core_request_errors.inc(method.lower())
+            raise
+        if self.metrics:
+            self.metrics.core_requests.inc(method.lower(), str(response.status_code))
         return response
 
+    def url_for(self, path: str, params: Optional[Any] = None) -> str:
+        """
+        :param path: The path of a core endpoint, relative to the base URL
+        :param params: Query parameters from a command, in any form `requests`
+            takes them
+        :return: The endpoint's URL, with the parameters encoded as
+            `requests` encodes them. Both engines build their URLs here, so
+            they send the core the same query for the same command.
+        """
+        prepared = requests.PreparedRequest()
+        prepared.prepare_url(f"{self.base_url}/{path}", params)
+        assert prepared.url is not None
+        return prepared.url
+
+    def close(self) -> None:
+        """Closes any open connections to the core."""
+        self.session.close()
+
     def get_current_path_data(self, path):
-        self.logger.debug(f"Getting current path data for {path}")
+        self.logger.debug("Getting current path data for %s", path)
         response = self.execute_request("get", path)
         if response.status_code != 200:
             self.logger.error("Unable to get vlan data")
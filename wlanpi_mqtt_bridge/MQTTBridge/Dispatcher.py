@@ -0,0 +1,160 @@
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Hashable, Optional
+
+Job = tuple[Callable, tuple, dict]
+
+
+class Dispatcher:
+    """
+    A bounded worker pool that runs jobs off of the calling thread.
+
+    Jobs submitted with the same serialization key are run one at a time, in
+    the order they were submitted. Jobs without a key are run as soon as a
+    worker is free. The number of jobs that may be waiting or running at once
+    is capped, and `submit` applies backpressure once that cap is reached.
+    """
+
+    def __init__(
+        self,
+        workers: int = 4,
+        max_queue_depth: int = 64,
+        name: str = "dispatch",
+    ):
+        self.logger = logging.getLogger(__name__)
+        self.workers = max(1, workers)
+        self.max_queue_depth = max(1, max_queue_depth)
+        self.name = name
+
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._slots = threading.BoundedSemaphore(self.max_queue_depth)
+        self._lock = threading.Lock()
+        # Backlog of jobs per serialization key. A key is present while a
+        # job for it is running, so later jobs for that key queue up here.
+        self._serialized: dict[Hashable, deque[Job]] = {}
+        self._outstanding = 0
+        self._threads: list[threading.Thread] = []
+        # Set once `stop` is called, after which no more jobs are accepted
+        self._stopping = False
+
+    @property
+    def queue_depth(self) -> int:
+        """The number of jobs currently waiting or running."""
+        return self._outstanding
+
+    def start(self) -> None:
+        """
+        Starts the worker threads. Calling this on a running dispatcher does
+        nothing.
+        :return:
+        """
+        if self._threads:
+            return
+        self._stopping = False
+        self.logger.info(f"Starting {self.workers} {self.name} workers")
+        for i in range(self.workers):
+            thread = threading.Thread(
+                target=self._work, name=f"{self.name}-{i}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """
+        Stops the worker threads after the jobs already queued have run. Jobs
+        submitted from now on are rejected.
+        :param timeout: How long to wait, in all, for the workers to finish.
+            `None` waits for as long as they take.
+        :return:
+        """
+        self._stopping = True
+        for _ in self._threads:
+            self._queue.put(None)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(
+                None if deadline is None else max(0.0, deadline - time.monotonic())
+            )
+            if thread.is_alive():
+                self.logger.warning(
+                    "%s worker %s didn't finish in time", self.name, thread.name
+                )
+        self._threads = []
+
+    def submit(
+        self,
+        func: Callable,
+        *args: Any,
+        key: Optional[Hashable] = None,
+        timeout: Optional[float] = None,
+        **kwargs: Any,
+    ) -> bool:
+        """
+        Queues a job to be run by a worker.
+        :param func: The function to run
+        :param key: Jobs that share a key are run in submission order, one at
+            a time. `None` means the job may run concurrently with anything.
+        :param timeout: How long to wait for room in the queue. `None` waits
+            forever, 0 does not wait at all.
+        :return: Whether the job was queued. False means the dispatcher was at
+            capacity for the whole timeout, or is stopping.
+        """
+        if self._stopping:
+            return False
+        if timeout is not None and timeout <= 0:
+            acquired = self._slots.acquire(blocking=False)
+        else:
+            acquired = self._slots.acquire(timeout=timeout)
+        if not acquired:
+            self.logger.warning(
+                "%s queue is full (%d jobs), rejecting job",
+                self.name,
+                self.max_queue_depth,
+            )
+            return False
+
+        with self._lock:
+            self._outstanding += 1
+        self._queue.put((key, (func, args, kwargs)))
+        return True
+
+    def _work(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            key, job = item
+
+            if key is not None:
+                with self._lock:
+                    if key in self._serialized:
+                        # Another worker is busy with this key. It will pick
+                        # this job up when it finishes.
+                        self._serialized[key].append(job)
+                        continue
+                    self._serialized[key] = deque()
+
+            while True:
+                self._run(job)
+                if key is None:
+                    break
+                with self._lock:
+                    backlog = self._serialized[key]
+                    if not backlog:
+                        del self._serialized[key]
+                        break
+                    job = backlog.popleft()
+
+    def _run(self, job: Job) -> None:
+        func, args, kwargs = job
+        try:
+            func(*args, **kwargs)
+        except Exception as e:
+            self.logger.error("Unhandled exception in %s job", self.name, exc_info=e)
+        finally:
+            with self._lock:
+                self._outstanding -= 1
+            self._slots.release()
@@ -0,0 +1,354 @@
+import abc
+import bisect
+import json
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Iterable, Optional, Union
+
+# Upper bounds, in seconds, of the buckets latency histograms count into
+DEFAULT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+Labels = tuple[str, ...]
+# A gauge function returns a single value, or values keyed by label values.
+GaugeValue = Union[float, dict[Labels, float]]
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Metric(abc.ABC):
+    """
+    A named metric, with one value per combination of label values. Label
+    values are given positionally, in the order of `label_names`.
+    """
+
+    metric_type = "untyped"
+
+    def __init__(self, name: str, documentation: str, label_names: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+
+    @abc.abstractmethod
+    def samples(self) -> list[tuple[str, dict[str, str], float]]:
+        """
+        :return: Each sample's name, labels and value
+        """
+
+    def labels(self, values: Labels, **extra: str) -> dict[str, str]:
+        labels = dict(zip(self.label_names, values))
+        labels.update(extra)
+        return labels
+
+
+class Counter(Metric):
+    metric_type = "counter"
+
+    def __init__(self, name: str, documentation: str, label_names: Iterable[str] = ()):
+        super().__init__(name, documentation, label_names)
+        self._values: dict[Labels, float] = {}
+
+    def inc(self, *label_values: str, amount: float = 1.0) -> None:
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0.0) + amount
+
+    def samples(self) -> list[tuple[str, dict[str, str], float]]:
+        with self._lock:
+            values = list(self._values.items())
+        return [(self.name, self.labels(key), value) for key, value in values]
+
+
+class Gauge(Metric):
+    """A value read from a function each time the metric is collected"""
+
+    metric_type = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        function: Callable[[], GaugeValue],
+        label_names: Iterable[str] = (),
+    ):
+        super().__init__(name, documentation, label_names)
+        self.function = function
+
+    def samples(self) -> list[tuple[str, dict[str, str], float]]:
+        value = self.function()
+        if isinstance(value, dict):
+            return [(self.name, self.labels(key), v) for key, v in value.items()]
+        return [(self.name, {}, float(value))]
+
+
+class HistogramValue:
+    __slots__ = ("counts", "total")
+
+    def __init__(self, buckets: int):
+        # Observations per bucket, with the +Inf bucket last
+        self.counts = [0] * (buckets + 1)
+        self.total = 0.0
+
+
+class Histogram(Metric):
+    metric_type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        label_names: Iterable[str] = (),
+        buckets: Iterable[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets))
+        self._values: dict[Labels, HistogramValue] = {}
+
+    def observe(self, value: float, *label_values: str) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(label_values)
+            if entry is None:
+                entry = self._values[label_values] = HistogramValue(len(self.buckets))
+            entry.counts[index] += 1
+            entry.total += value
+
+    def samples(self) -> list[tuple[str, dict[str, str], float]]:
+        with self._lock:
+            values = [
+                (key, list(entry.counts), entry.total)
+                for key, entry in self._values.items()
+            ]
+        samples: list[tuple[str, dict[str, str], float]] = []
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), counts):
+                cumulative += count
+                samples.append(
+                    (
+                        f"{self.name}_bucket",
+                        self.labels(key, le=format_value(bound)),
+                        cumulative,
+                    )
+                )
+            samples.append((f"{self.name}_sum", self.labels(key), total))
+            samples.append((f"{self.name}_count", self.labels(key), cumulative))
+        return samples
+
+
+class Registry:
+    """
+    A set of metrics that can be rendered in the Prometheus text exposition
+    format, or as JSON for publishing over MQTT.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        self.metrics: list[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def counter(
+        self, name: str, documentation: str, label_names: Iterable[str] = ()
+    ) -> Counter:
+        counter = Counter(name, documentation, label_names)
+        self.register(counter)
+        return counter
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        label_names: Iterable[str] = (),
+        buckets: Iterable[float] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        histogram = Histogram(name, documentation, label_names, buckets)
+        self.register(histogram)
+        return histogram
+
+    def gauge(
+        self,
+        name: str,
+        documentation: str,
+        function: Callable[[], GaugeValue],
+        label_names: Iterable[str] = (),
+    ) -> Gauge:
+        gauge = Gauge(name, documentation, function, label_names)
+        self.register(gauge)
+        return gauge
+
+    def collect(self) -> list[tuple[Metric, list[tuple[str, dict[str, str], float]]]]:
+        """
+        :return: Every metric with its current samples. A metric whose gauge
+            function fails is left out.
+        """
+        collected = []
+        for metric in self.metrics:
+            try:
+                collected.append((metric, metric.samples()))
+            except Exception as e:
+                self.logger.warning("Unable to collect %s: %s", metric.name, e)
+        return collected
+
+    def to_text(self) -> str:
+        """
+        :return: The metrics in the Prometheus text exposition format
+        """
+        lines = []
+        for metric, samples in self.collect():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.metric_type}")
+            for name, labels, value in samples:
+                if labels:
+                    formatted = ",".join(
+                        f'{key}="{escape_label_value(str(label))}"'
+                        for key, label in labels.items()
+                    )
+                    name = f"{name}{{{formatted}}}"
+                lines.append(f"{name} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def to_dict(self) -> dict[str, Any]:
+        """
+        :return: The metrics as {name: [{"labels": {...}, "value": ...}]}
+        """
+        metrics: dict[str, list[dict[str, Any]]] = {}
+        for _, samples in self.collect():
+            for name, labels, value in samples:
+                metrics.setdefault(name, []).append({"labels": labels, "value": value})
+        return metrics
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), separators=(",", ":"))
+
+
+class BridgeMetrics(Registry):
+    """The bridge's own counters and histograms"""
+
+    def __init__(self):
+        super().__init__()
+        self.messages = self.counter(
+            "wlanpi_bridge_messages_total",
+            "Commands received, by route",
+            ["route", "method"],
+        )
+        self.unrouted_messages = self.counter(
+            "wlanpi_bridge_unrouted_messages_total",
+            "Messages received on topics with no route",
+        )
+        self.command_phase_seconds = self.histogram(
+            "wlanpi_bridge_command_phase_seconds",
+            "Time spent handling commands, by phase: matching the topic and "
+            "parsing the payload, the REST call, serializing the response, "
+            "and publishing it",
+            ["phase"],
+        )
+        self.core_requests = self.counter(
+            "wlanpi_bridge_core_requests_total",
+            "Requests made to the core, by method and HTTP status",
+            ["method", "status"],
+        )
+        self.core_request_errors = self.counter(
+            "wlanpi_bridge_core_request_errors_total",
+            "Requests to the core that failed without a response",
+            ["method"],
+        )
+        self.poll_seconds = self.histogram(
+            "wlanpi_bridge_poll_seconds",
+            "Time taken by each poll of a monitored endpoint or autopublished topic",
+            ["name"],
+        )
+        self.mqtt_connects = self.counter(
+            "wlanpi_bridge_mqtt_connects_total",
+            "Connections made to the MQTT server, including reconnects",
+        )
+        self.mqtt_disconnects = self.counter(
+            "wlanpi_bridge_mqtt_disconnects_total",
+            "Connections to the MQTT server lost or closed",
+        )
+        self.mqtt_connect_failures = self.counter(
+            "wlanpi_bridge_mqtt_connect_failures_total",
+            "Failed attempts to connect to the MQTT server",
+        )
+
+
+class MetricsServer:
+    """Serves a registry's metrics over HTTP for Prometheus to scrape"""
+
+    def __init__(self, registry: Registry, host: str = "127.0.0.1", port: int = 0):
+        self.logger = logging.getLogger(__name__)
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.server: Optional[ThreadingHTTPServer] = None
+
+    def start(self) -> bool:
+        """
+        Starts serving on a thread of its own.
+        :return: Whether the server is listening
+        """
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path.split("?", 1)[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry.to_text().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args: Any) -> None:
+                pass
+
+        try:
+            self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+        except OSError as e:
+            self.logger.error(
+                "Unable to serve metrics on %s:%d: %s", self.host, self.port, e
+            )
+            return False
+        self.server.daemon_threads = True
+        threading.Thread(
+            target=self.server.serve_forever, name="metrics", daemon=True
+        ).start()
+        self.logger.info(
+            "Serving metrics on http://%s:%d/metrics", self.host, self.port
+        )
+        return True
+
+    def stop(self) -> None:
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
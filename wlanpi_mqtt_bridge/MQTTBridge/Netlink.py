@@ -0,0 +1,252 @@
+import os
+import socket
+import struct
+from typing import Iterator, Optional
+
+NETLINK_ROUTE = 0
+
+# Message types
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+RTM_GETLINK = 18
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+RTM_GETADDR = 22
+RTM_NEWROUTE = 24
+RTM_DELROUTE = 25
+
+# Message flags
+NLM_F_REQUEST = 0x1
+NLM_F_MULTI = 0x2
+NLM_F_DUMP = 0x300
+
+# Multicast groups, as a bitmask for bind()
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV4_ROUTE = 0x40
+RTMGRP_IPV6_IFADDR = 0x100
+RTMGRP_IPV6_ROUTE = 0x400
+
+# struct nlmsghdr
+NLMSG_HEADER = struct.Struct("=IHHII")
+# struct ifinfomsg
+IFINFOMSG = struct.Struct("=BxHiII")
+# struct ifaddrmsg
+IFADDRMSG = struct.Struct("=BBBBI")
+# struct rtattr
+RTATTR = struct.Struct("=HH")
+
+# Links
+IFLA_ADDRESS = 1
+IFLA_BROADCAST = 2
+IFLA_IFNAME = 3
+IFLA_MTU = 4
+IFLA_LINK = 5
+IFLA_QDISC = 6
+IFLA_MASTER = 10
+IFLA_TXQLEN = 13
+IFLA_OPERSTATE = 16
+IFLA_GROUP = 27
+IFLA_LINK_NETNSID = 37
+IFLA_PERM_ADDRESS = 54
+
+# Addresses
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+IFA_LABEL = 3
+IFA_BROADCAST = 4
+IFA_ANYCAST = 5
+IFA_CACHEINFO = 6
+IFA_FLAGS = 8
+
+# struct ifa_cacheinfo: preferred and valid lifetimes, then timestamps
+IFA_CACHEINFO_STRUCT = struct.Struct("=IIII")
+
+RECEIVE_BUFFER_SIZE = 65536
+
+Attributes = dict[int, bytes]
+
+
+def align(length: int) -> int:
+    return (length + 3) & ~3
+
+
+def parse_messages(data: bytes) -> Iterator[tuple[int, int, int, bytes]]:
+    """
+    Splits a buffer received from a netlink socket into messages.
+    :param data: The received buffer
+    :return: Each message's type, flags, sequence number and payload
+    """
+    offset = 0
+    while offset + NLMSG_HEADER.size <= len(data):
+        length, message_type, flags, sequence, _ = NLMSG_HEADER.unpack_from(
+            data, offset
+        )
+        if length < NLMSG_HEADER.size:
+            break
+        start = offset + NLMSG_HEADER.size
+        end = offset + length
+        yield message_type, flags, sequence, data[start:end]
+        offset += align(length)
+
+
+def parse_attributes(data: bytes, offset: int = 0) -> Attributes:
+    """
+    Parses the attributes that follow a message's fixed header.
+    :param data: The message payload
+    :param offset: Where the attributes start
+    :return: Each attribute's value, by type. Nested attributes are left
+        unparsed.
+    """
+    attributes: Attributes = {}
+    while offset + RTATTR.size <= len(data):
+        length, attribute_type = RTATTR.unpack_from(data, offset)
+        if length < RTATTR.size:
+            break
+        start = offset + RTATTR.size
+        end = offset + length
+        # The top bits flag nested and byte-order attributes.
+        attributes[attribute_type & 0x3FFF] = data[start:end]
+        offset += align(length)
+    return attributes
+
+
+def attribute_string(value: bytes) -> str:
+    return value.split(b"\0", 1)[0].decode("utf-8", errors="replace")
+
+
+def attribute_u32(value: bytes) -> int:
+    return struct.unpack_from("=I", value)[0]
+
+
+def raise_for_error(payload: bytes) -> None:
+    """Raises the error carried by an NLMSG_ERROR message, if it is one."""
+    (error,) = struct.unpack_from("=i", payload)
+    if error:
+        raise OSError(-error, os.strerror(-error))
+
+
+class RtnetlinkSocket:
+    """
+    A NETLINK_ROUTE socket, built on the standard library's AF_NETLINK
+    support. It covers what the bridge needs: dumping links and addresses,
+    and, given multicast groups, hearing about changes to them.
+    """
+
+    def __init__(self, groups: int = 0):
+        """
+        :param groups: The RTMGRP_* groups to listen to, or 0 for none
+        :raises OSError: If netlink sockets aren't available
+        """
+        self.sock = socket.socket(
+            socket.AF_NETLINK,  # type: ignore[attr-defined]
+            socket.SOCK_RAW,
+            NETLINK_ROUTE,
+        )
+        try:
+            self.sock.bind((0, groups))
+        except OSError:
+            self.sock.close()
+            raise
+        self.sequence = 0
+
+    def fileno(self) -> int:
+        return self.sock.fileno()
+
+    def close(self) -> None:
+        self.sock.close()
+
+    def __enter__(self) -> "RtnetlinkSocket":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def dump(self, message_type: int, header: bytes) -> list[tuple[int, bytes]]:
+        """
+        Makes a dump request and collects the replies.
+        :param message_type: The RTM_GET* request type
+        :param header: The request's fixed header, e.g. an ifinfomsg
+        :raises OSError: If the kernel reports an error
+        :return: Each reply's type and payload
+        """
+        self.sequence += 1
+        request = (
+            NLMSG_HEADER.pack(
+                NLMSG_HEADER.size + len(header),
+                message_type,
+                NLM_F_REQUEST | NLM_F_DUMP,
+                self.sequence,
+                0,
+            )
+            + header
+        )
+        self.sock.send(request)
+
+        replies: list[tuple[int, bytes]] = []
+        while True:
+            data = self.sock.recv(RECEIVE_BUFFER_SIZE)
+            for reply_type, _, sequence, payload in parse_messages(data):
+                if sequence != self.sequence:
+                    continue
+                if reply_type == NLMSG_DONE:
+                    return replies
+                if reply_type == NLMSG_ERROR:
+                    raise_for_error(payload)
+                    return replies
+                replies.append((reply_type, payload))
+
+    def receive(self) -> list[tuple[int, bytes]]:
+        """
+        Waits for the next batch of notifications.
+        :return: Each notification's type and payload
+        """
+        data = self.sock.recv(RECEIVE_BUFFER_SIZE)
+        return [
+            (message_type, payload)
+            for message_type, _, _, payload in parse_messages(data)
+            if message_type not in (NLMSG_DONE, NLMSG_ERROR)
+        ]
+
+    def dump_links(self) -> list[tuple[tuple[int, ...], Attributes]]:
+        """
+        :return: Every link's ifinfomsg fields (family, type, index, flags,
+            change) and attributes
+        """
+        return [
+            (IFINFOMSG.unpack_from(payload), parse_attributes(payload, IFINFOMSG.size))
+            for reply_type, payload in self.dump(
+                RTM_GETLINK, IFINFOMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0)
+            )
+            if reply_type == RTM_NEWLINK
+        ]
+
+    def dump_addresses(
+        self, family: int = socket.AF_UNSPEC
+    ) -> list[tuple[tuple[int, ...], Attributes]]:
+        """
+        :param family: Only dump addresses of this family
+        :return: Every address's ifaddrmsg fields (family, prefix length,
+            flags, scope, interface index) and attributes
+        """
+        return [
+            (IFADDRMSG.unpack_from(payload), parse_attributes(payload, IFADDRMSG.size))
+            for reply_type, payload in self.dump(
+                RTM_GETADDR, IFADDRMSG.pack(family, 0, 0, 0, 0)
+            )
+            if reply_type == RTM_NEWADDR
+        ]
+
+
+def format_address(family: Optional[int], value: bytes) -> str:
+    """
+    Formats a network or hardware address the way iproute2 does.
+    :param family: AF_INET or AF_INET6 for an IP address, or None for a
+        hardware address
+    :param value: The address, as sent by the kernel
+    """
+    if family is not None:
+        return socket.inet_ntop(family, value)
+    return ":".join(f"{byte:02x}" for byte in value)
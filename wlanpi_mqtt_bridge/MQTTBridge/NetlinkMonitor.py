@@ -0,0 +1,174 @@
+import errno
+import logging
+import select
+import threading
+from typing import Callable, Iterable, Optional
+
+from . import Netlink
+
+# The kinds of change the monitor reports, and the rtnetlink groups and
+# message types behind them.
+EVENT_GROUPS = {
+    "link": Netlink.RTMGRP_LINK,
+    "address": Netlink.RTMGRP_IPV4_IFADDR | Netlink.RTMGRP_IPV6_IFADDR,
+    "route": Netlink.RTMGRP_IPV4_ROUTE | Netlink.RTMGRP_IPV6_ROUTE,
+}
+EVENT_TYPES = {
+    Netlink.RTM_NEWLINK: "link",
+    Netlink.RTM_DELLINK: "link",
+    Netlink.RTM_NEWADDR: "address",
+    Netlink.RTM_DELADDR: "address",
+    Netlink.RTM_NEWROUTE: "route",
+    Netlink.RTM_DELROUTE: "route",
+}
+
+
+class NetlinkMonitor:
+    """
+    Listens for the kernel's rtnetlink notifications about links, addresses
+    and routes, and reports which kinds of thing changed. Bursts of
+    notifications, such as the handful sent for a single link flap, are
+    reported once `debounce` seconds after the first.
+
+    Either call `start` to listen on a thread of its own, or `open` and hand
+    `fileno` to an event loop, calling `read_events` when it is readable.
+    """
+
+    def __init__(
+        self,
+        callback: Callable[[set[str]], None],
+        kinds: Iterable[str] = tuple(EVENT_GROUPS),
+        debounce: float = 0.5,
+    ):
+        """
+        :param callback: Called with the kinds of change seen, e.g.
+            {"link", "address"}. Runs on the monitor's thread.
+        :param kinds: The kinds of change to listen for
+        :param debounce: Seconds to gather notifications for before
+            reporting them
+        """
+        self.logger = logging.getLogger(__name__)
+        self.callback = callback
+        self.kinds = set(kinds)
+        self.debounce = debounce
+        self.sock: Optional[Netlink.RtnetlinkSocket] = None
+        self.thread: Optional[threading.Thread] = None
+        self.stopping = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        if self.thread is not None and not self.thread.is_alive():
+            return False
+        return self.sock is not None
+
+    def open(self) -> bool:
+        """
+        Opens the netlink socket, if it isn't already.
+        :return: Whether the monitor is listening
+        """
+        if self.sock is not None:
+            return True
+        groups = 0
+        for kind in self.kinds:
+            groups |= EVENT_GROUPS[kind]
+        try:
+            self.sock = Netlink.RtnetlinkSocket(groups)
+        except OSError as e:
+            self.logger.warning("Unable to listen for netlink events: %s", e)
+            return False
+        self.sock.sock.setblocking(False)
+        self.logger.info(
+            "Listening for netlink events: %s", ", ".join(sorted(self.kinds))
+        )
+        return True
+
+    def fileno(self) -> int:
+        assert self.sock is not None
+        return self.sock.fileno()
+
+    def read_events(self) -> set[str]:
+        """
+        Reads every notification waiting on the socket without blocking.
+        :return: The kinds of change they report
+        """
+        assert self.sock is not None
+        kinds: set[str] = set()
+        while True:
+            try:
+                messages = self.sock.receive()
+            except BlockingIOError:
+                return kinds
+            except OSError as e:
+                if e.errno != errno.ENOBUFS:
+                    raise
+                # The kernel dropped notifications we were too slow to read,
+                # so assume everything changed.
+                self.logger.warning("Netlink events were lost, refreshing all")
+                kinds.update(self.kinds)
+                continue
+            kinds.update(
+                EVENT_TYPES[message_type]
+                for message_type, _ in messages
+                if EVENT_TYPES.get(message_type) in self.kinds
+            )
+
+    def start(self) -> bool:
+        """
+        Starts listening on a thread of its own.
+        :return: Whether the monitor is listening
+        """
+        if not self.open():
+            return False
+        self.stopping.clear()
+        self.thread = threading.Thread(
+            target=self.run, name="netlink-monitor", daemon=True
+        )
+        self.thread.start()
+        return True
+
+    def stop(self) -> None:
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join(timeout=2)
+            self.thread = None
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def wait_readable(self, timeout: float) -> bool:
+        readable, _, _ = select.select([self.fileno()], [], [], timeout)
+        return bool(readable)
+
+    def run(self) -> None:
+        try:
+            self.listen()
+        except Exception as e:
+            # `running` is now False, so the bridge goes back to polling.
+            self.logger.error(
+                "Netlink monitor stopped, falling back to polling", exc_info=e
+            )
+
+    def listen(self) -> None:
+        while not self.stopping.is_set():
+            try:
+                if not self.wait_readable(1.0):
+                    continue
+                kinds = self.read_events()
+                # Gather the rest of the burst before reporting it.
+                if kinds and self.debounce > 0:
+                    self.stopping.wait(self.debounce)
+                    kinds |= self.read_events()
+            except (OSError, ValueError) as e:
+                if self.stopping.is_set():
+                    return
+                self.logger.error("Error reading netlink events", exc_info=e)
+                if self.stopping.wait(5):
+                    return
+                # Anything could have changed meanwhile.
+                kinds = set(self.kinds)
+            if kinds:
+                self.logger.debug("Netlink events: %s", ", ".join(sorted(kinds)))
+                try:
+                    self.callback(kinds)
+                except Exception as e:
+                    self.logger.error("Error handling netlink events", exc_info=e)
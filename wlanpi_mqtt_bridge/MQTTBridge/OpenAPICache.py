@@ -0,0 +1,121 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from typing import Any, Optional
+
+from .Utils import json_loads
+
+
+class OpenAPICache:
+    """
+    Holds the core's OpenAPI definition, identified by a hash of its content,
+    in memory and optionally on disk so that it survives restarts.
+
+    The hash is taken over a canonical serialization of the parsed
+    definition, so it only changes when the API does, not when the core
+    changes how it formats the document. The core's ETag, if it sends one,
+    is kept so that revalidation can be a conditional request.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        """
+        :param path: Where to keep the definition on disk. None keeps it in
+            memory only.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        self.lock = threading.Lock()
+        self.definition: Optional[dict] = None
+        self.digest: Optional[str] = None
+        self.etag: Optional[str] = None
+
+    @staticmethod
+    def compute_digest(definition: Any) -> str:
+        canonical = json.dumps(definition, sort_keys=True, separators=(",", ":"))
+        return hashlib.blake2b(canonical.encode("utf-8"), digest_size=16).hexdigest()
+
+    def load(self) -> bool:
+        """
+        Loads the definition saved on disk, if there is one.
+        :return: Whether a definition was loaded
+        """
+        if not self.path or not os.path.exists(self.path):
+            return False
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                saved = json.load(f)
+            definition = saved["definition"]
+            digest = self.compute_digest(definition)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            self.logger.warning(
+                "Ignoring unreadable OpenAPI cache at %s: %s", self.path, e
+            )
+            return False
+
+        with self.lock:
+            self.definition = definition
+            self.digest = digest
+            self.etag = saved.get("etag")
+        self.logger.info("Loaded cached OpenAPI definition %s", digest)
+        return True
+
+    def save(self) -> None:
+        """Writes the definition to disk, replacing the previous copy whole."""
+        if not self.path or self.definition is None:
+            return
+        temporary_path = f"{self.path}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(temporary_path, "w", encoding="utf-8") as f:
+                json.dump(
+                    {
+                        "digest": self.digest,
+                        "etag": self.etag,
+                        "definition": self.definition,
+                    },
+                    f,
+                )
+            os.replace(temporary_path, self.path)
+        except OSError as e:
+            self.logger.warning("Unable to save OpenAPI cache to %s: %s", self.path, e)
+
+    def update_from_response(self, response) -> bool:
+        """
+        Takes in the core's response to a (possibly conditional) request for
+        its OpenAPI definition.
+        :param response: The core's response
+        :raises ValueError: If the response is an error, or not valid JSON
+        :return: Whether the definition changed
+        """
+        if response.status_code == 304:
+            self.logger.debug("OpenAPI definition not modified")
+            return False
+        if not response.ok:
+            raise ValueError(
+                f"Core answered {response.status_code} {response.reason} "
+                "for its OpenAPI definition"
+            )
+        return self.update(json_loads(response.content), response.headers.get("ETag"))
+
+    def update(self, definition: dict, etag: Optional[str] = None) -> bool:
+        """
+        Replaces the cached definition if its content has changed.
+        :param definition: The parsed OpenAPI definition
+        :param etag: The core's ETag for it, if any
+        :return: Whether the definition changed
+        """
+        digest = self.compute_digest(definition)
+        with self.lock:
+            changed = digest != self.digest
+            etag_changed = etag != self.etag
+            if changed:
+                self.definition = definition
+                self.digest = digest
+            self.etag = etag
+        if changed:
+            self.logger.info("OpenAPI definition is now %s", digest)
+        if changed or etag_changed:
+            self.save()
+        return changed
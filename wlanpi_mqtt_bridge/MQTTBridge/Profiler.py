@@ -0,0 +1,187 @@
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Any, Callable, Optional
+
+# A frame, as (file name, line number of the function, function name)
+FrameKey = tuple[str, int, str]
+
+
+def describe_frame(frame: FrameKey) -> str:
+    filename, line, function = frame
+    return f"{function} ({os.path.basename(filename)}:{line})"
+
+
+class SamplingProfiler:
+    """
+    A wall-clock profiler that periodically samples the Python stack of every
+    thread in the process, so it sees the Paho network thread, the scheduler
+    loop (or event loop) and the worker pools alike. Nothing is hooked into
+    the interpreter, so it costs nothing while it isn't running, and the cost
+    while it is depends only on the sampling interval.
+
+    Threads are sampled whether they are working or waiting, so a thread
+    that's blocked on a queue or socket shows up where it blocks.
+    """
+
+    def __init__(self, interval: float = 0.01, max_depth: int = 64):
+        """
+        :param interval: Seconds between samples
+        :param max_depth: The most frames of each stack to keep, innermost
+            first
+        """
+        self.logger = logging.getLogger(__name__)
+        self.interval = max(0.001, interval)
+        self.max_depth = max_depth
+        self.stopping = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+        self.started_at = 0.0
+        self.duration = 0.0
+        self.samples = 0
+        # (thread name, stack from outermost to innermost) -> samples
+        self.stacks: Counter[tuple[str, tuple[FrameKey, ...]]] = Counter()
+
+    @property
+    def running(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(
+        self,
+        duration: float,
+        on_complete: Optional[Callable[["SamplingProfiler"], Any]] = None,
+    ) -> None:
+        """
+        Samples on a thread of its own for `duration` seconds, or until
+        `stop` is called.
+        :param duration: Seconds to sample for
+        :param on_complete: Called with the profiler, on the sampling thread,
+            once it's done
+        :return:
+        """
+        if self.running:
+            raise RuntimeError("The profiler is already running")
+        self.stopping.clear()
+        self.thread = threading.Thread(
+            target=self.run, args=(duration, on_complete), name="profiler", daemon=True
+        )
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stopping.set()
+
+    def run(
+        self,
+        duration: float,
+        on_complete: Optional[Callable[["SamplingProfiler"], Any]],
+    ) -> None:
+        self.logger.info(
+            "Profiling for %.1f seconds, sampling every %.3f seconds",
+            duration,
+            self.interval,
+        )
+        self.started_at = time.time()
+        started = time.monotonic()
+        deadline = started + duration
+        while not self.stopping.is_set():
+            self.sample()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            self.stopping.wait(min(self.interval, remaining))
+        self.duration = time.monotonic() - started
+        self.logger.info("Profiling finished with %d samples", self.samples)
+        if on_complete is not None:
+            try:
+                on_complete(self)
+            except Exception as e:
+                self.logger.error("Unable to report the profile", exc_info=e)
+
+    def sample(self) -> None:
+        """Records the current stack of every thread but this one"""
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        me = threading.get_ident()
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack: list[FrameKey] = []
+            current: Any = frame
+            while current is not None and len(stack) < self.max_depth:
+                code = current.f_code
+                stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                current = current.f_back
+            stack.reverse()
+            self.stacks[(names.get(ident, str(ident)), tuple(stack))] += 1
+        self.samples += 1
+
+    def summary(self, top: int = 20) -> dict[str, Any]:
+        """
+        :param top: How many functions to list
+        :return: Samples per thread, and the functions seen most often at the
+            top of a stack (self) and anywhere in it (cumulative)
+        """
+        threads: Counter[str] = Counter()
+        own: Counter[FrameKey] = Counter()
+        cumulative: Counter[FrameKey] = Counter()
+        for (thread, stack), count in self.stacks.items():
+            threads[thread] += count
+            if not stack:
+                continue
+            own[stack[-1]] += count
+            for frame in set(stack):
+                cumulative[frame] += count
+
+        def ranked(counts: Counter[FrameKey]) -> list[dict[str, Any]]:
+            return [
+                {
+                    "function": describe_frame(frame),
+                    "samples": count,
+                    "percent": round(100 * count / total, 1),
+                }
+                for frame, count in counts.most_common(top)
+            ]
+
+        # Percentages are of all thread samples, not of sampling rounds.
+        total = max(1, sum(threads.values()))
+        return {
+            "started_at": self.started_at,
+            "duration": round(self.duration, 3),
+            "interval": self.interval,
+            "samples": self.samples,
+            "threads": dict(threads.most_common()),
+            "self": ranked(own),
+            "cumulative": ranked(cumulative),
+        }
+
+    def folded_stacks(self) -> str:
+        """
+        :return: The samples as collapsed stacks, one `thread;outer;...;inner
+            count` line per distinct stack, the input format of flame graph
+            tools such as flamegraph.pl and speedscope.
+        """
+        lines = []
+        for (thread, stack), count in self.stacks.most_common():
+            frames = ";".join(describe_frame(frame) for frame in stack)
+            lines.append(f"{thread};{frames} {count}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, directory: str, top: int = 20) -> str:
+        """
+        Writes the profile to `directory` as a JSON summary and a file of
+        collapsed stacks, named after when profiling started.
+        :param directory: Where to write the profile
+        :param top: How many functions to list in the summary
+        :return: The path the profile was written to, without an extension
+        """
+        os.makedirs(directory, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(self.started_at))
+        base = os.path.join(directory, f"profile-{stamp}")
+        with open(f"{base}.json", "w") as f:
+            json.dump(self.summary(top), f, indent=2)
+        with open(f"{base}.folded", "w") as f:
+            f.write(self.folded_stacks())
+        self.logger.info("Wrote profile to %s.json and %s.folded", base, base)
+        return base
@@ -0,0 +1,195 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+# The OpenAPI extension the core may set on a GET operation to say how many
+# seconds its response can be reused for.
+TTL_EXTENSION = "x-cache-ttl"
+
+
+def ttls_from_openapi_definition(
+    openapi_definition: Optional[dict],
+) -> dict[str, float]:
+    """
+    Collects the cache TTLs the core declares for its GET operations.
+    :param openapi_definition: The parsed OpenAPI definition
+    :return: TTLs in seconds, keyed by path template
+    """
+    ttls: dict[str, float] = {}
+    if not openapi_definition:
+        return ttls
+    for uri, action in openapi_definition.get("paths", {}).items():
+        operation = action.get("get")
+        if not isinstance(operation, dict) or TTL_EXTENSION not in operation:
+            continue
+        try:
+            ttls[uri.strip("/")] = float(operation[TTL_EXTENSION])
+        except (TypeError, ValueError):
+            continue
+    return ttls
+
+
+def matches_template(template: list[str], segments: list[str]) -> bool:
+    """
+    :param template: A path template such as `api/v1/{name}`, split on `/`
+    :param segments: A concrete path, split on `/`
+    :return: Whether the path is an instance of the template
+    """
+    return len(template) == len(segments) and all(
+        part == segment or part.startswith("{")
+        for part, segment in zip(template, segments)
+    )
+
+
+class ResponseCache:
+    """
+    Keeps the core's successful responses to GET requests for a short while,
+    so that a burst of identical reads, or a poll and a command for the same
+    endpoint, reach the core once.
+
+    How long a response is kept is set per path. TTLs may be keyed by a
+    concrete path, or by an OpenAPI path template such as
+    `api/v1/network/ethernet/{interface}/vlan`. Paths without a TTL use
+    `default_ttl`, and a TTL of 0 or less isn't cached. Once `max_entries`
+    responses are held, the least recently used is evicted.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 256,
+        default_ttl: float = 0.0,
+        ttls: Optional[dict[str, float]] = None,
+    ):
+        """
+        :param max_entries: The most responses to hold at once
+        :param default_ttl: Seconds to keep responses for paths without a TTL
+        :param ttls: TTLs in seconds, keyed by path or path template. These
+            take precedence over any the core declares.
+        """
+        self.max_entries = max(0, max_entries)
+        self.default_ttl = default_ttl
+        self.configured_ttls = {
+            path.strip("/"): float(ttl) for path, ttl in (ttls or {}).items()
+        }
+        self._lock = threading.Lock()
+        # key -> (monotonic expiry time, response)
+        self._entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        # Bumped by every invalidation, so responses fetched before one
+        # aren't stored after it.
+        self.generation = 0
+
+        self._ttls: dict[str, float] = {}
+        self._templates: list[tuple[list[str], float]] = []
+        self._ttl_memo: dict[str, float] = {}
+        self.set_core_ttls({})
+
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def set_core_ttls(self, ttls: dict[str, float]) -> None:
+        """
+        Sets the TTLs declared by the core, e.g. from its OpenAPI definition.
+        :param ttls: TTLs in seconds, keyed by path or path template
+        """
+        merged = {path.strip("/"): ttl for path, ttl in ttls.items()}
+        merged.update(self.configured_ttls)
+        with self._lock:
+            self._ttls = merged
+            self._templates = [
+                (path.split("/"), ttl) for path, ttl in merged.items() if "{" in path
+            ]
+            self._ttl_memo = {}
+
+    def ttl_for(self, path: str) -> float:
+        """
+        :param path: A concrete request path
+        :return: How many seconds its response may be reused for
+        """
+        if self.max_entries <= 0:
+            return 0.0
+        path = path.strip("/")
+        ttl = self._ttl_memo.get(path)
+        if ttl is not None:
+            return ttl
+        ttl = self._ttls.get(path)
+        if ttl is None:
+            ttl = self.default_ttl
+            segments = path.split("/")
+            for template, template_ttl in self._templates:
+                if matches_template(template, segments):
+                    ttl = template_ttl
+                    break
+        # Paths can carry arbitrary parameters, so don't let this grow forever.
+        if len(self._ttl_memo) >= 4 * max(self.max_entries, 64):
+            self._ttl_memo = {}
+        self._ttl_memo[path] = ttl
+        return ttl
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """
+        :param key: Identifies the request
+        :return: The cached response, if there is one that hasn't expired
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires, response = entry
+            if now >= expires:
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return response
+
+    def put(self, key: Hashable, path: str, response: Any, generation: int) -> None:
+        """
+        Stores a response, if its path has a TTL.
+        :param key: Identifies the request
+        :param path: The request's path, which decides its TTL
+        :param response: The core's response
+        :param generation: `generation` when the request was sent. If the
+            cache has been invalidated since, the response isn't stored.
+        """
+        ttl = self.ttl_for(path)
+        if ttl <= 0:
+            return
+        expires = time.monotonic() + ttl
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._entries[key] = (expires, response)
+            self._entries.move_to_end(key)
+            self.stores += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self) -> None:
+        """Drops every cached response, e.g. after the core's state changed."""
+        with self._lock:
+            self.generation += 1
+            if self._entries:
+                self._entries.clear()
+                self.invalidations += 1
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "stores": self.stores,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
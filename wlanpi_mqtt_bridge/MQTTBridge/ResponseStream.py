@@ -0,0 +1,102 @@
+import base64
+import hashlib
+import secrets
+from typing import Any, Optional
+
+from .structures import MQTTResponse
+from .Utils import get_current_unix_timestamp, get_full_class_name, json_dumps
+
+
+class ResponseStream:
+    """
+    Splits a core response into numbered chunk messages followed by a
+    manifest, so that a body of any size can be relayed without holding it
+    in memory or publishing it as one huge message.
+
+    Each chunk is a small JSON object on the route's response topic, with
+    the body's bytes base64 encoded:
+
+        {"_stream": "3f9c...", "_chunk": 0, "_bridge_ident": 1, "data": "..."}
+
+    On MQTT v5, with `binary`, a chunk is the body's bytes themselves,
+    saving the third again that base64 adds. The other fields are sent as
+    user properties of the same names instead.
+
+    Once the body has been read, a regular response is published with
+    `data` set to null and a `_stream` object describing what was sent:
+
+        {"status": "success", ..., "_stream": {"id": "3f9c...", "chunks": 12,
+         "size": 786432, "sha256": "...", "content_type": "text/plain",
+         "encoding": "base64", "complete": true}}
+
+    `encoding` is "binary" for binary chunks.
+
+    If reading the body fails part way, the manifest has a `bridge_error`
+    status and `complete` is false.
+    """
+
+    def __init__(
+        self,
+        bridge_ident: Optional[Any] = None,
+        rest_status: Optional[int] = None,
+        rest_reason: Optional[str] = None,
+        content_type: Optional[str] = None,
+        binary: bool = False,
+    ):
+        """
+        :param bridge_ident: The identifier sent with the command, if any
+        :param rest_status: The core's HTTP status
+        :param rest_reason: The core's HTTP reason
+        :param content_type: The Content-Type of the core's response
+        :param binary: Send chunks as raw bytes, described by user
+            properties. Only possible on MQTT v5.
+        """
+        self.id = secrets.token_hex(8)
+        self.bridge_ident = bridge_ident
+        self.rest_status = rest_status
+        self.rest_reason = rest_reason
+        self.content_type = content_type
+        self.binary = binary
+        self.chunks = 0
+        self.size = 0
+        self.digest = hashlib.sha256()
+
+    def chunk(self, data: bytes) -> tuple[bytes, list[tuple[str, str]]]:
+        """
+        :param data: The next part of the body
+        :return: The message carrying it, and the user properties to publish
+            it with, if it's binary
+        """
+        fields: dict[str, Any] = {"_stream": self.id, "_chunk": self.chunks}
+        if self.bridge_ident:
+            fields["_bridge_ident"] = self.bridge_ident
+        fields["published_at"] = get_current_unix_timestamp()
+        self.chunks += 1
+        self.size += len(data)
+        self.digest.update(data)
+        if self.binary:
+            return bytes(data), [(name, str(value)) for name, value in fields.items()]
+        fields["data"] = base64.b64encode(data).decode("ascii")
+        return json_dumps(fields), []
+
+    def manifest(self, error: Optional[Exception] = None) -> MQTTResponse:
+        """
+        :param error: What stopped the body being read in full, if anything
+        :return: The response that ends the stream
+        """
+        return MQTTResponse(
+            status="bridge_error" if error else "success",
+            errors=[[get_full_class_name(error), str(error)]] if error else None,
+            rest_status=self.rest_status,
+            rest_reason=self.rest_reason,
+            bridge_ident=self.bridge_ident,
+            stream={
+                "id": self.id,
+                "chunks": self.chunks,
+                "size": self.size,
+                "sha256": self.digest.hexdigest(),
+                "content_type": self.content_type,
+                "encoding": "binary" if self.binary else "base64",
+                "complete": error is None,
+            },
+        )
@@ -0,0 +1,125 @@
+import json
+import logging
+import os
+from typing import Iterable, Optional
+
+from .structures import Route
+
+
+class RouteSnapshot:
+    """
+    The bridge's route table and subscriptions as built from one version of
+    the core's OpenAPI definition, saved to disk so that a restarted bridge
+    can subscribe and take commands before the core is up.
+
+    Routes are stored without their callbacks, which the bridge supplies
+    again when it loads them.
+    """
+
+    # Bumped whenever the file layout changes, so older snapshots are ignored.
+    FORMAT_VERSION = 1
+
+    def __init__(self, path: Optional[str] = None):
+        """
+        :param path: Where to keep the snapshot on disk. None disables it.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        # The digest of the OpenAPI definition the routes were built from
+        self.digest: Optional[str] = None
+        # The bridge's own base topic when the snapshot was taken. Routes
+        # include it, so they don't carry over to a different identifier.
+        self.base_topic: Optional[str] = None
+        self.routes: list[Route] = []
+        self.subscriptions: list[str] = []
+
+    def load(self, base_topic: str) -> bool:
+        """
+        Loads the snapshot saved on disk, if there is one for this base topic.
+        :param base_topic: The bridge's own base topic
+        :return: Whether a snapshot was loaded
+        """
+        if not self.path or not os.path.exists(self.path):
+            return False
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                saved = json.load(f)
+            if saved.get("version") != self.FORMAT_VERSION:
+                self.logger.info("Ignoring route snapshot in an old format")
+                return False
+            if saved["base_topic"] != base_topic:
+                self.logger.info(
+                    "Ignoring route snapshot taken for %s", saved["base_topic"]
+                )
+                return False
+            routes = [
+                Route(route=route, topic=topic, response_topic=response, method=method)
+                for route, topic, response, method in saved["routes"]
+            ]
+            subscriptions = [
+                str(topic_filter) for topic_filter in saved["subscriptions"]
+            ]
+            digest = saved["digest"]
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            self.logger.warning(
+                "Ignoring unreadable route snapshot at %s: %s", self.path, e
+            )
+            return False
+
+        self.digest = digest
+        self.base_topic = base_topic
+        self.routes = routes
+        self.subscriptions = subscriptions
+        self.logger.info(
+            "Loaded %d routes for OpenAPI definition %s from snapshot",
+            len(routes),
+            digest,
+        )
+        return True
+
+    def update(
+        self,
+        digest: str,
+        base_topic: str,
+        routes: Iterable[Route],
+        subscriptions: Iterable[str],
+    ) -> None:
+        """
+        Replaces the snapshot and saves it to disk.
+        :param digest: The digest of the OpenAPI definition the routes were
+            built from
+        :param base_topic: The bridge's own base topic
+        :param routes: Every route in the route table
+        :param subscriptions: The topic filters the routes need
+        :return:
+        """
+        self.digest = digest
+        self.base_topic = base_topic
+        self.routes = list(routes)
+        self.subscriptions = list(subscriptions)
+        self.save()
+
+    def save(self) -> None:
+        """Writes the snapshot to disk, replacing the previous copy whole."""
+        if not self.path or self.digest is None:
+            return
+        temporary_path = f"{self.path}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(temporary_path, "w", encoding="utf-8") as f:
+                json.dump(
+                    {
+                        "version": self.FORMAT_VERSION,
+                        "digest": self.digest,
+                        "base_topic": self.base_topic,
+                        "routes": [
+                            [r.route, r.topic, r.response_topic, r.method]
+                            for r in self.routes
+                        ],
+                        "subscriptions": self.subscriptions,
+                    },
+                    f,
+                )
+            os.replace(temporary_path, self.path)
+        except OSError as e:
+            self.logger.warning("Unable to save route snapshot to %s: %s", self.path, e)
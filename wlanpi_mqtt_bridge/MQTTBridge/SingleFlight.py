@@ -0,0 +1,84 @@
+import asyncio
+import functools
+import threading
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Hashable
+
+
+class SingleFlight:
+    """
+    Collapses concurrent calls that share a key into one. The first caller
+    runs the call; anyone who asks for the same key while it's running waits
+    for it and gets the same result, or the same exception.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: dict[Hashable, Future] = {}
+        # How many calls were answered by another caller's call
+        self.shared = 0
+
+    def do(self, key: Hashable, func: Callable[..., Any], *args, **kwargs) -> Any:
+        """
+        :param key: Identifies calls that would return the same result
+        :param func: The call to make, if one isn't already running
+        :return: The call's result
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            leading = future is None
+            if future is None:
+                future = self._calls[key] = Future()
+            else:
+                self.shared += 1
+        if not leading:
+            return future.result()
+
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+class AsyncSingleFlight:
+    """
+    `SingleFlight` for coroutines, to be used from a single event loop.
+
+    The call runs in a task of its own, so any caller giving up on it,
+    including the one that started it, leaves it running for the others.
+    """
+
+    def __init__(self):
+        self._calls: dict[Hashable, asyncio.Task] = {}
+        self.shared = 0
+
+    async def do(
+        self, key: Hashable, func: Callable[..., Awaitable[Any]], *args, **kwargs
+    ) -> Any:
+        """
+        :param key: Identifies calls that would return the same result
+        :param func: The coroutine function to await, if a call isn't
+            already running
+        :return: The call's result
+        """
+        task = self._calls.get(key)
+        if task is not None:
+            self.shared += 1
+        else:
+            task = self._calls[key] = asyncio.ensure_future(func(*args, **kwargs))
+            task.add_done_callback(functools.partial(self._finished, key))
+        return await asyncio.shield(task)
+
+    def _finished(self, key: Hashable, task: asyncio.Task) -> None:
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # Mark any exception retrieved, in case everyone stopped waiting.
+        if not task.cancelled():
+            task.exception()
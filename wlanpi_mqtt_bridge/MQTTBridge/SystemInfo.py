@@ -0,0 +1,360 @@
+import os
+import socket
+import struct
+import time
+from typing import Any, Optional
+
+from . import Netlink
+from .Netlink import attribute_string, attribute_u32, format_address
+
+# Readers for the system information the bridge publishes, straight from the
+# kernel (rtnetlink, /proc and /sys) rather than by running `ip`, `jc` and
+# friends. Each produces the same output as the command it stands in for,
+# and raises OSError or ValueError if the kernel interface isn't available,
+# so that callers can fall back to the command.
+
+# Interface flags, in the order `ip` lists them
+LINK_FLAGS = (
+    ("LOOPBACK", 0x8),
+    ("BROADCAST", 0x2),
+    ("POINTOPOINT", 0x10),
+    ("MULTICAST", 0x1000),
+    ("NOARP", 0x80),
+    ("ALLMULTI", 0x200),
+    ("PROMISC", 0x100),
+    ("MASTER", 0x400),
+    ("SLAVE", 0x800),
+    ("DEBUG", 0x4),
+    ("DYNAMIC", 0x8000),
+    ("AUTOMEDIA", 0x4000),
+    ("PORTSEL", 0x2000),
+    ("NOTRAILERS", 0x20),
+    ("UP", 0x1),
+    ("LOWER_UP", 0x10000),
+    ("DORMANT", 0x20000),
+    ("ECHO", 0x40000),
+)
+IFF_UP = 0x1
+IFF_POINTOPOINT = 0x10
+IFF_RUNNING = 0x40
+
+OPERSTATES = (
+    "UNKNOWN",
+    "NOTPRESENT",
+    "DOWN",
+    "LOWERLAYERDOWN",
+    "TESTING",
+    "DORMANT",
+    "UP",
+)
+
+# ARPHRD_* hardware types, as `ip` names them
+LINK_TYPES = {
+    1: "ether",
+    24: "ieee1394",
+    32: "infiniband",
+    280: "can",
+    512: "ppp",
+    519: "rawip",
+    768: "ipip",
+    769: "tunnel6",
+    772: "loopback",
+    776: "sit",
+    778: "gre",
+    801: "ieee802.11",
+    802: "ieee802.11/prism",
+    803: "ieee802.11/radiotap",
+    823: "gre6",
+    65534: "none",
+    65535: "void",
+}
+IP_TUNNEL_LINK_TYPES = ("ipip", "tunnel6", "sit", "gre", "gre6")
+
+# Address flags, in the order `ip` lists them. IFA_F_PERMANENT is listed as
+# "dynamic" when it is missing.
+IFA_F_SECONDARY = 0x01
+IFA_F_PERMANENT = 0x80
+ADDRESS_FLAGS = (
+    ("secondary", IFA_F_SECONDARY),
+    ("nodad", 0x02),
+    ("optimistic", 0x04),
+    ("dadfailed", 0x08),
+    ("home", 0x10),
+    ("deprecated", 0x20),
+    ("tentative", 0x40),
+    ("permanent", IFA_F_PERMANENT),
+    ("mngtmpaddr", 0x100),
+    ("noprefixroute", 0x200),
+    ("autojoin", 0x400),
+    ("stable-privacy", 0x800),
+)
+
+SCOPES = {0: "global", 200: "site", 253: "link", 254: "host", 255: "nowhere"}
+
+FAMILIES: dict[int, str] = {socket.AF_INET: "inet", socket.AF_INET6: "inet6"}
+
+# /proc/net/route's flag for routes through a gateway
+RTF_GATEWAY = 0x2
+
+# struct utmp is 384 bytes on Linux; ut_type is its first field.
+UTMP_RECORD_SIZE = 384
+UTMP_USER_PROCESS = 7
+UTMP_PATHS = ("/run/utmp", "/var/run/utmp")
+
+
+def link_flag_names(flags: int) -> list[str]:
+    names = []
+    if flags & IFF_UP and not flags & IFF_RUNNING:
+        names.append("NO-CARRIER")
+    names.extend(name for name, mask in LINK_FLAGS if flags & mask)
+    return names
+
+
+def describe_link(
+    header: tuple[int, ...],
+    attributes: Netlink.Attributes,
+    names: dict[int, str],
+    all_flags: dict[int, int],
+) -> dict[str, Any]:
+    """
+    Describes a link the way `ip -j addr show` does, without its addresses.
+    :param header: The link's ifinfomsg fields
+    :param attributes: The link's attributes
+    :param names: Interface names by index, for master and parent links
+    :param all_flags: Interface flags by index, for parent links
+    """
+    _, link_type, index, flags, _ = header
+    link: dict[str, Any] = {"ifindex": index}
+    flag_names = link_flag_names(flags)
+    if Netlink.IFLA_LINK in attributes:
+        parent = attribute_u32(attributes[Netlink.IFLA_LINK])
+        if Netlink.IFLA_LINK_NETNSID in attributes:
+            link["link_index"] = parent
+        else:
+            link["link"] = names.get(parent, f"if{parent}") if parent else None
+            if parent in all_flags and not all_flags[parent] & IFF_UP:
+                flag_names.append("M-DOWN")
+    link["ifname"] = attribute_string(attributes.get(Netlink.IFLA_IFNAME, b""))
+    link["flags"] = flag_names
+    if Netlink.IFLA_MTU in attributes:
+        link["mtu"] = attribute_u32(attributes[Netlink.IFLA_MTU])
+    if Netlink.IFLA_QDISC in attributes:
+        link["qdisc"] = attribute_string(attributes[Netlink.IFLA_QDISC])
+    if Netlink.IFLA_MASTER in attributes:
+        master = attribute_u32(attributes[Netlink.IFLA_MASTER])
+        link["master"] = names.get(master, f"if{master}")
+    if Netlink.IFLA_OPERSTATE in attributes:
+        operstate = attributes[Netlink.IFLA_OPERSTATE][0]
+        link["operstate"] = (
+            OPERSTATES[operstate] if operstate < len(OPERSTATES) else str(operstate)
+        )
+    if Netlink.IFLA_GROUP in attributes:
+        group = attribute_u32(attributes[Netlink.IFLA_GROUP])
+        link["group"] = "default" if group == 0 else str(group)
+    if Netlink.IFLA_TXQLEN in attributes:
+        link["txqlen"] = attribute_u32(attributes[Netlink.IFLA_TXQLEN])
+
+    link["link_type"] = LINK_TYPES.get(link_type, f"[{link_type}]")
+    # Tunnels have IP addresses at the link layer.
+    address_family = None
+    if link["link_type"] in IP_TUNNEL_LINK_TYPES:
+        address_family = {4: socket.AF_INET, 16: socket.AF_INET6}.get(
+            len(attributes.get(Netlink.IFLA_ADDRESS, b""))
+        )
+    if Netlink.IFLA_ADDRESS in attributes:
+        address = format_address(address_family, attributes[Netlink.IFLA_ADDRESS])
+        link["address"] = address
+        permanent = attributes.get(Netlink.IFLA_PERM_ADDRESS)
+        if permanent and format_address(address_family, permanent) != address:
+            link["permaddr"] = format_address(address_family, permanent)
+    if Netlink.IFLA_BROADCAST in attributes:
+        if flags & IFF_POINTOPOINT:
+            link["link_pointtopoint"] = None
+        link["broadcast"] = format_address(
+            address_family, attributes[Netlink.IFLA_BROADCAST]
+        )
+    if Netlink.IFLA_LINK_NETNSID in attributes:
+        link["link_netnsid"] = struct.unpack_from(
+            "=i", attributes[Netlink.IFLA_LINK_NETNSID]
+        )[0]
+    return link
+
+
+def describe_address(
+    header: tuple[int, ...], attributes: Netlink.Attributes
+) -> Optional[dict[str, Any]]:
+    """
+    Describes an address the way `ip -j addr show` does in a link's
+    `addr_info`.
+    :param header: The address's ifaddrmsg fields
+    :param attributes: The address's attributes
+    :return: The description, or None for families `ip` doesn't list
+    """
+    family, prefixlen, flags, scope, _ = header
+    if family not in FAMILIES:
+        return None
+    if Netlink.IFA_FLAGS in attributes:
+        flags = attribute_u32(attributes[Netlink.IFA_FLAGS])
+
+    address: dict[str, Any] = {"family": FAMILIES[family]}
+    local = attributes.get(Netlink.IFA_LOCAL)
+    peer = attributes.get(Netlink.IFA_ADDRESS)
+    if local is not None:
+        address["local"] = format_address(family, local)
+        if peer is not None and peer != local:
+            address["address"] = format_address(family, peer)
+    elif peer is not None:
+        address["local"] = format_address(family, peer)
+    address["prefixlen"] = prefixlen
+    if Netlink.IFA_BROADCAST in attributes:
+        address["broadcast"] = format_address(family, attributes[Netlink.IFA_BROADCAST])
+    if Netlink.IFA_ANYCAST in attributes:
+        address["anycast"] = format_address(family, attributes[Netlink.IFA_ANYCAST])
+    address["scope"] = SCOPES.get(scope, str(scope))
+
+    for name, mask in ADDRESS_FLAGS:
+        if mask == IFA_F_PERMANENT:
+            if not flags & mask:
+                address["dynamic"] = True
+        elif flags & mask:
+            if mask == IFA_F_SECONDARY and family == socket.AF_INET6:
+                address["temporary"] = True
+            else:
+                address[name] = True
+
+    if Netlink.IFA_LABEL in attributes:
+        address["label"] = attribute_string(attributes[Netlink.IFA_LABEL])
+    if Netlink.IFA_CACHEINFO in attributes:
+        preferred, valid, _, _ = Netlink.IFA_CACHEINFO_STRUCT.unpack_from(
+            attributes[Netlink.IFA_CACHEINFO]
+        )
+        address["valid_life_time"] = valid
+        address["preferred_life_time"] = preferred
+    return address
+
+
+def read_interface_addresses(interface: Optional[str] = None) -> list[dict[str, Any]]:
+    """
+    Reads interfaces and their addresses over rtnetlink, in the same form as
+    `ip -j addr show [interface]`.
+    :param interface: Only describe this interface
+    :raises OSError: If rtnetlink isn't available
+    :raises ValueError: If the interface doesn't exist
+    :return: Each interface, with its addresses under `addr_info`
+    """
+    with Netlink.RtnetlinkSocket() as sock:
+        links = sock.dump_links()
+        addresses = sock.dump_addresses()
+
+    names = {
+        header[2]: attribute_string(attributes.get(Netlink.IFLA_IFNAME, b""))
+        for header, attributes in links
+    }
+    all_flags = {header[2]: header[3] for header, _ in links}
+    described = {
+        header[2]: describe_link(header, attributes, names, all_flags)
+        for header, attributes in links
+        if interface is None or names[header[2]] == interface
+    }
+    if interface is not None and not described:
+        raise ValueError(f'Device "{interface}" does not exist.')
+
+    for link in described.values():
+        link["addr_info"] = []
+    for header, attributes in addresses:
+        address = describe_address(header, attributes)
+        if header[4] in described and address is not None:
+            described[header[4]]["addr_info"].append(address)
+    return list(described.values())
+
+
+def read_default_gateways() -> dict[str, str]:
+    """
+    Reads the IPv4 default gateways from /proc/net/route.
+    :return: Each interface with a default route, and its gateway
+    """
+    gateways: dict[str, str] = {}
+    with open("/proc/net/route", "r", encoding="ascii") as f:
+        next(f)
+        for line in f:
+            fields = line.split()
+            if len(fields) < 8:
+                continue
+            interface, destination, gateway, flags, mask = (
+                fields[0],
+                fields[1],
+                fields[2],
+                int(fields[3], 16),
+                fields[7],
+            )
+            if destination == mask == "00000000" and flags & RTF_GATEWAY:
+                gateways[interface] = socket.inet_ntoa(
+                    struct.pack("<I", int(gateway, 16))
+                )
+    return gateways
+
+
+def count_logged_in_users() -> int:
+    """
+    Counts login sessions in utmp, as `uptime` does.
+    :return: The number of sessions, or 0 if there is no utmp
+    """
+    for path in UTMP_PATHS:
+        if not os.path.exists(path):
+            continue
+        with open(path, "rb") as f:
+            data = f.read()
+        return sum(
+            1
+            for offset in range(0, len(data) - UTMP_RECORD_SIZE + 1, UTMP_RECORD_SIZE)
+            if struct.unpack_from("=h", data, offset)[0] == UTMP_USER_PROCESS
+        )
+    return 0
+
+
+def read_uptime() -> dict[str, Any]:
+    """
+    Reads the uptime, logged in users and load averages from /proc and utmp,
+    in the same form as `jc uptime`.
+    :return: The parsed uptime
+    """
+    with open("/proc/uptime", "r", encoding="ascii") as f:
+        uptime_seconds = int(float(f.read().split()[0]))
+    with open("/proc/loadavg", "r", encoding="ascii") as f:
+        load_1m, load_5m, load_15m = (float(load) for load in f.read().split()[:3])
+
+    now = time.localtime()
+    days, remainder = divmod(uptime_seconds, 86400)
+    hours, remainder = divmod(remainder, 3600)
+    minutes = remainder // 60
+
+    # `uptime` itself only shows whole minutes.
+    uptime = f"{days} day{'s' if days != 1 else ''}, " if days else ""
+    uptime += f"{hours}:{minutes:02d}" if hours else f"{minutes} min"
+
+    return {
+        "time": time.strftime("%H:%M:%S", now),
+        "uptime": uptime,
+        "users": count_logged_in_users(),
+        "load_1m": load_1m,
+        "load_5m": load_5m,
+        "load_15m": load_15m,
+        "time_hour": now.tm_hour,
+        "time_minute": now.tm_min,
+        "time_second": now.tm_sec,
+        "uptime_days": days,
+        "uptime_hours": hours,
+        "uptime_minutes": minutes,
+        "uptime_total_seconds": days * 86400 + hours * 3600 + minutes * 60,
+    }
+
+
+def read_mac_address(interface: str) -> str:
+    """
+    Reads an interface's hardware address from /sys.
+    :param interface: The interface name
+    :raises OSError: If the interface doesn't exist
+    :return: The address, e.g. `dc:a6:32:8e:04:17`
+    """
+    with open(f"/sys/class/net/{interface}/address", "r", encoding="ascii") as f:
+        return f.read().strip()
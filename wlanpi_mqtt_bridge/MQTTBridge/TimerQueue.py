@@ -0,0 +1,95 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from typing import Callable, Optional
+
+
+class TimerQueue:
+    """
+    Runs functions after a delay, all on a single thread, in the order they
+    fall due. Unlike a `threading.Timer` per call, any number of pending
+    calls costs one thread.
+
+    The thread is started by the first call to `call_later`.
+    """
+
+    def __init__(self, name: str = "timers"):
+        self.logger = logging.getLogger(__name__)
+        self.name = name
+
+        # (due, sequence, function), with the sequence keeping calls that
+        # fall due together in the order they were made
+        self._heap: list[tuple[float, int, Callable]] = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = False
+
+    def __len__(self) -> int:
+        """The number of calls waiting to fall due."""
+        return len(self._heap)
+
+    def call_later(self, delay: float, func: Callable) -> None:
+        """
+        Runs `func` after `delay` seconds.
+        :param delay:
+        :param func:
+        :return:
+        """
+        with self._condition:
+            heapq.heappush(
+                self._heap, (time.monotonic() + delay, next(self._sequence), func)
+            )
+            if self._thread is None:
+                self._stopping = False
+                self._thread = threading.Thread(
+                    target=self._run, name=self.name, daemon=True
+                )
+                self._thread.start()
+            self._condition.notify()
+
+    def stop(self, timeout: float = 2.0) -> int:
+        """
+        Stops the thread, dropping any calls that haven't fallen due.
+        :param timeout: Seconds to wait for a call that's running to finish
+        :return: The number of calls dropped
+        """
+        with self._condition:
+            self._stopping = True
+            dropped = len(self._heap)
+            self._heap.clear()
+            thread, self._thread = self._thread, None
+            self._condition.notify()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout)
+        return dropped
+
+    def _next(self) -> Optional[Callable]:
+        """
+        Waits for the earliest call to fall due.
+        :return: Its function, or None once stopped
+        """
+        with self._condition:
+            while not self._stopping:
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+                remaining = self._heap[0][0] - time.monotonic()
+                if remaining <= 0:
+                    return heapq.heappop(self._heap)[2]
+                self._condition.wait(remaining)
+            return None
+
+    def _run(self) -> None:
+        while True:
+            func = self._next()
+            if func is None:
+                return
+            try:
+                func()
+            except Exception as e:
+                self.logger.error(
+                    "Unhandled exception in %s call", self.name, exc_info=e
+                )
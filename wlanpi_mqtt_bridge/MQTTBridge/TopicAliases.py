@@ -0,0 +1,109 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Optional
+
+import paho.mqtt.client as mqtt
+from paho.mqtt.properties import Properties
+
+
+class TopicAliases:
+    """
+    Assigns MQTT v5 topic aliases to the topics we publish to, so that after
+    the first message on a topic only a two byte alias is sent in place of
+    its name. Aliases only last as long as the connection, and there can be
+    no more than the server allows, so the least recently used topic gives
+    up its alias when they run out.
+
+    A message that sets up an alias has to reach the server before one that
+    relies on it, and an alias can't move to another topic while a message
+    using it is being sent. So setting one up is done under `lock`, once
+    nothing is sending with that alias. Messages sent by an alias already
+    set up, or without one, don't wait on each other.
+    """
+
+    def __init__(self, limit: int = 16):
+        """
+        :param limit: The most aliases to use, however many the server allows
+        """
+        self.limit = max(0, limit)
+        # The number of aliases we may use on the current connection
+        self.maximum = 0
+        # Alias by topic, least recently used first
+        self.aliases: OrderedDict[str, int] = OrderedDict()
+        # Messages being sent by each alias
+        self.sending: dict[int, int] = {}
+        self.lock = threading.Condition()
+
+    def reset(self, server_maximum: int = 0) -> None:
+        """
+        Forgets every alias, as the server does when the connection ends.
+        :param server_maximum: The server's Topic Alias Maximum for the new
+            connection, or 0 when disconnected
+        :return:
+        """
+        with self.lock:
+            self.maximum = min(self.limit, server_maximum)
+            self.aliases.clear()
+
+    def publish(
+        self, topic: str, properties: Optional[Properties], send: Callable[[str], Any]
+    ) -> Any:
+        """
+        Publishes a message under its topic's alias, assigning it one if
+        there's one to spare.
+        :param topic: The topic to publish to
+        :param properties: The message's publish properties, to add the alias
+            to. Without them, the topic is always sent in full.
+        :param send: Publishes the message to the topic it's given, which is
+            empty when the alias stands in for it
+        :return: Whatever `send` returns. An alias is only assigned once a
+            message setting it up has been published successfully.
+        """
+        if properties is None or self.maximum == 0:
+            return send(topic)
+
+        with self.lock:
+            alias = self.aliases.get(topic)
+            if alias is not None:
+                self.aliases.move_to_end(topic)
+                self.sending[alias] = self.sending.get(alias, 0) + 1
+        if alias is not None:
+            properties.TopicAlias = alias
+            try:
+                return send("")
+            finally:
+                with self.lock:
+                    self.sending[alias] -= 1
+                    self.lock.notify_all()
+
+        with self.lock:
+            while True:
+                # Another thread may have set one up while we waited.
+                alias = self.aliases.get(topic)
+                if alias is not None:
+                    self.aliases.move_to_end(topic)
+                    properties.TopicAlias = alias
+                    return send("")
+                if self.maximum == 0:
+                    return send(topic)
+                evicted: Optional[str] = None
+                if len(self.aliases) < self.maximum:
+                    alias = len(self.aliases) + 1
+                    break
+                # Sending a topic with an alias that's in use moves the alias
+                # over to the new topic, once nothing is sending with it.
+                evicted = next(iter(self.aliases))
+                alias = self.aliases[evicted]
+                if not self.sending.get(alias):
+                    break
+                self.lock.wait()
+            properties.TopicAlias = alias
+            result = send(topic)
+            # Only a message that was sent tells the server about the alias.
+            # If it wasn't, the alias still means what it did before.
+            if getattr(result, "rc", mqtt.MQTT_ERR_SUCCESS) != mqtt.MQTT_ERR_SUCCESS:
+                return result
+            if evicted is not None:
+                del self.aliases[evicted]
+            self.aliases[topic] = alias
+            return result
@@ -1,6 +1,9 @@
 import logging
 import re
-from typing import Optional, Union
+import threading
+from collections import OrderedDict
+from types import MappingProxyType
+from typing import Iterable, Mapping, Optional, Union
 
 from wlanpi_mqtt_bridge.MQTTBridge.structures import Route
 
@@ -8,80 +11,169 @@ REST_VERBS = ["GET", "PUT", "POST", "PATCH", "DELETE"]
 
 TopicNodePath = list[str]
 TopicReplacements = list[tuple[str, str]]
+# Path parameter names, without braces, mapped to their values in a topic
+PathBindings = dict[str, str]
+ResolvedRoute = tuple[Route, PathBindings]
+# A string with its path parameters swapped for the index of the topic
+# segment that fills them in.
+RouteTemplate = tuple[Union[str, int], ...]
+# Route paths, joined with "/", mapped to the path and the node holding the
+# route.
+RouteIndex = dict[str, tuple[TopicNodePath, "TopicNode"]]
+
+ROUTE_TEMPLATE_TARGETS = ("topic", "response_topic", "route")
+
+# Shared by every node without static children, which is most of them.
+NO_STATIC_CHILDREN: Mapping = MappingProxyType({})
+
+# One logger for the whole tree. Debug output in the matching code is
+# guarded, since it runs for every node visited on every message.
+logger = logging.getLogger(__name__)
+
+
+def is_command_topic(topic: str) -> bool:
+    """
+    :return: Whether a topic could be a command, i.e. ends in a REST verb.
+        Every route's topic does.
+    """
+    return topic.rsplit("/", 1)[-1].upper() in REST_VERBS
+
+
+def topic_filter_covers(outer: str, inner: str) -> bool:
+    """
+    :return: Whether every topic matched by the MQTT filter `inner` is also
+        matched by the filter `outer`.
+    """
+    outer_segments = outer.split("/")
+    inner_segments = inner.split("/")
+    for index, segment in enumerate(outer_segments):
+        if segment == "#":
+            # Also matches the parent level, e.g. "a/#" matches "a".
+            return True
+        if index >= len(inner_segments):
+            return False
+        if segment == "+":
+            if inner_segments[index] == "#":
+                return False
+        elif segment != inner_segments[index]:
+            return False
+    return len(outer_segments) == len(inner_segments)
+
+
+def collapse_topic_filters(filters: Iterable[str], depth: int = 0) -> list[str]:
+    """
+    Reduces a set of MQTT filters to a smaller set that still covers them.
+    :param filters: The filters to cover
+    :param depth: If above 0, filters longer than this many segments are
+        widened to their first `depth` segments followed by `#`. This covers
+        more topics than the original filters did.
+    :return: The covering filters, broadest first. Filters covered by another
+        are dropped.
+    """
+    widened = set()
+    for topic_filter in filters:
+        segments = topic_filter.split("/")
+        if 0 < depth < len(segments):
+            topic_filter = "/".join([*segments[:depth], "#"])
+        widened.add(topic_filter)
+
+    # Multi-level wildcards and shorter filters tend to be broader, so try
+    # them first.
+    candidates = sorted(widened, key=lambda f: (not f.endswith("#"), f.count("/"), f))
+    collapsed: list[str] = []
+    for candidate in candidates:
+        if not any(topic_filter_covers(kept, candidate) for kept in collapsed):
+            collapsed.append(candidate)
+    return collapsed
 
 
 class TopicNode:
+    """
+    A node in the route tree, one per topic segment. Nodes hold only what
+    matching needs, and leaves (the bulk of the tree) share a single empty
+    mapping and tuple for their children.
+    """
+
+    __slots__ = (
+        "name",
+        "dynamic",
+        "parent",
+        "route",
+        "route_path",
+        "static_children",
+        "dynamic_children",
+    )
+
     def __init__(
         self,
         name: str,
-        rest: Optional[TopicNodePath] = None,
         dynamic: bool = False,
-        route: Optional[Route] = None,
         parent: Optional["TopicNode"] = None,
     ):
         self.name = name
         self.dynamic = dynamic
         self.parent = parent
         self.route: Optional[Route] = None
-        rest = rest or []
 
-        self.logger = logging.getLogger(
-            f"{__name__}:{'/'.join(self.get_my_route_path())}"
+        # A node never moves once created, so its path is worked out once.
+        self.route_path: tuple[str, ...] = (
+            (*parent.route_path, name) if parent is not None else ()
         )
-        self.logger.setLevel(logging.DEBUG)
 
         # Children of the node
-        self.static_children: dict[str, TopicNode] = {}
-        self.dynamic_children: list[TopicNode] = []
+        self.static_children: Mapping[str, TopicNode] = NO_STATIC_CHILDREN
+        self.dynamic_children: tuple[TopicNode, ...] = ()
 
-        self.known_routes: dict[str, tuple[TopicNodePath, TopicNode]] = {}
-
-        if rest:
-            self.add_child(rest[0], rest[1:] if len(rest) > 1 else None, route)
+    def add_child(
+        self, name: str, rest: Optional[TopicNodePath], route: Optional[Route]
+    ) -> RouteIndex:
+        """
+        Adds the path `name/rest...` below this node, creating nodes as
+        needed, with `route` on its final node.
+        :return: The routes that were added, keyed by their path. Empty if
+            the path already existed.
+        """
+        dynamic = name.startswith("{") and name.endswith("}")
+        if dynamic:
+            child = next(
+                (node for node in self.dynamic_children if node.name == name), None
+            )
         else:
-            if name.upper() in REST_VERBS:
-                self.route = route
-                self.register_route_path(self.get_my_route_path(), self)
-        # Update logger with the path we should now have:
+            child = self.static_children.get(name)
 
-    def add_child(
-        self, name, rest: Optional[TopicNodePath], route: Optional[Route]
-    ) -> dict[str, tuple[list[str], "TopicNode"]]:
-        routes_to_return = {}
+        if child is None:
+            child = TopicNode(name, dynamic=dynamic, parent=self)
+            if dynamic:
+                self.dynamic_children = (*self.dynamic_children, child)
+            else:
+                if self.static_children is NO_STATIC_CHILDREN:
+                    self.static_children = {}
+                self.static_children[name] = child  # type: ignore[index]
+            if not rest and name.upper() in REST_VERBS:
+                child.route = route
+                path = child.get_my_route_path()
+                return {"/".join(path): (path, child)}
 
-        # Catch dynamic routes
-        if name.startswith("{") and name.endswith("}"):
-            found = False
-            for node in self.dynamic_children:
-                if node.name == name:
-                    if rest is not None:
-                        routes_to_return.update(
-                            node.add_child(
-                                rest[0],
-                                rest[1:] if len(rest) > 1 else None,
-                                route=route,
-                            )
-                        )
-                    found = True
-            if not found:
-                new_node = TopicNode(name, rest, route=route, parent=self, dynamic=True)
-                self.dynamic_children.append(new_node)
-                routes_to_return.update(new_node.known_routes)
-        # Handle static routes
+        if rest:
+            return child.add_child(rest[0], rest[1:] or None, route)
+        return {}
+
+    def remove_child(self, child: "TopicNode") -> None:
+        """
+        Detaches a child node. The child collections are replaced rather than
+        changed in place, so a lookup walking them meanwhile isn't disturbed.
+        """
+        if child.dynamic:
+            self.dynamic_children = tuple(
+                node for node in self.dynamic_children if node is not child
+            )
         else:
-            if name in self.static_children:
-                if rest is not None:
-                    routes_to_return.update(
-                        self.static_children[name].add_child(
-                            rest[0], rest[1:] if len(rest) > 1 else None, route=route
-                        )
-                    )
-            else:
-                self.static_children[name] = TopicNode(
-                    name, rest, route=route, parent=self
-                )
-                routes_to_return.update(self.static_children[name].known_routes)
-        return routes_to_return
+            static_children = {
+                name: node
+                for name, node in self.static_children.items()
+                if node is not child
+            }
+            self.static_children = static_children or NO_STATIC_CHILDREN
 
     def get_next_matching_node(
         self, path: TopicNodePath, replacements: Optional[TopicReplacements] = None
@@ -107,12 +199,13 @@ class TopicNode:
 
         # Try dynamic nodes
         if not found_node:
+            debug = logger.isEnabledFor(logging.DEBUG)
             for node in self.dynamic_children:
-                self.logger.debug(
-                    f"Checking node: {'/'.join(node.get_my_route_path())}"
-                )
+                if debug:
+                    logger.debug("Checking node: %s", "/".join(node.route_path))
                 if node.matches(current_segment):
-                    self.logger.debug("Match!")
+                    if debug:
+                        logger.debug("Match!")
                     found_node, additional_found_replacements = (
                         node.get_next_matching_node(rest)
                     )
@@ -125,9 +218,10 @@ class TopicNode:
         return found_node, found_replacements
 
     def matches(self, path_segment: str) -> bool:
-        self.logger.debug(
-            f"{'/'.join(self.get_my_route_path())} matching against {path_segment}"
-        )
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "%s matching against %s", "/".join(self.route_path), path_segment
+            )
         # We'll probably never have this case, but why not cover it?
         if not self.dynamic and self.name == path_segment:
             return True
@@ -140,6 +234,11 @@ class TopicNode:
         return False
 
     def get_route(self, segments: TopicNodePath) -> Union[Route, None]:
+        return self.get_route_with_replacements(segments)[0]
+
+    def get_route_with_replacements(
+        self, segments: TopicNodePath
+    ) -> tuple[Optional[Route], TopicReplacements]:
         node, replacements = self.get_next_matching_node(path=segments)
         if node and node.route:
             replacement_targets = ["topic", "response_topic", "route"]
@@ -153,37 +252,329 @@ class TopicNode:
                         )
 
             new_route = node.route.copy_with(**replaced)
-            return new_route
-        return None
+            return new_route, replacements
+        return None, replacements
 
     def get_my_route_path(self) -> TopicNodePath:
-        route_path = []
-        if self.parent:
-            route_path.extend(self.parent.get_my_route_path())
-            route_path.append(self.name)
-        return route_path
-
-    def register_route_path(self, path: TopicNodePath, node: "TopicNode") -> None:
-        if self.parent:
-            self.parent.register_route_path(path, node)
-        self.known_routes["/".join(path)] = (path, node)
+        return list(self.route_path)
 
     def get_wildcard_topic(self):
         path = self.get_my_route_path()
         return "/".join([re.sub(r"{.+?}", "+", el) for el in path])
 
 
+class CompiledRoute:
+    """
+    A route whose path parameter substitutions have been worked out ahead of
+    time, so that resolving it for a topic is a matter of joining strings.
+    """
+
+    __slots__ = ("route", "parameters", "templates")
+
+    def __init__(self, route: Route, parameters: list[tuple[str, int]]):
+        """
+        :param route: The route as registered, with `{name}` placeholders
+        :param parameters: Each path parameter's placeholder and the index of
+            the topic segment it is filled in from, in path order.
+        """
+        self.route = route
+        self.parameters = tuple(
+            (placeholder.strip("{}"), index) for placeholder, index in parameters
+        )
+        self.templates: tuple[tuple[str, RouteTemplate], ...] = tuple(
+            (target, self.compile_template(getattr(route, target), parameters))
+            for target in ROUTE_TEMPLATE_TARGETS
+        )
+
+    @staticmethod
+    def compile_template(
+        value: str, parameters: list[tuple[str, int]]
+    ) -> RouteTemplate:
+        # Mirrors TopicNode.get_route: each placeholder replaces its first
+        # remaining occurrence, in path order.
+        parts: list[Union[str, int]] = [value]
+        for placeholder, index in parameters:
+            for i, part in enumerate(parts):
+                if isinstance(part, str) and placeholder in part:
+                    before, after = part.split(placeholder, 1)
+                    parts[i] = before
+                    parts.insert(i + 1, index)
+                    parts.insert(i + 2, after)
+                    break
+        return tuple(part for part in parts if part != "")
+
+    def resolve(self, segments: TopicNodePath) -> Route:
+        """
+        Builds the concrete route for a topic that matched this route.
+        :param segments: The matched topic, split into segments
+        :return: A copy of the route with its path parameters filled in
+        """
+        replaced = {
+            target: "".join(
+                [part if isinstance(part, str) else segments[part] for part in template]
+            )
+            for target, template in self.templates
+        }
+        return self.route.copy_with(**replaced)
+
+    def bindings(self, segments: TopicNodePath) -> PathBindings:
+        """
+        :param segments: The matched topic, split into segments
+        :return: The values of the route's path parameters in the topic
+        """
+        return {name: segments[index] for name, index in self.parameters}
+
+
+class CompiledNode:
+    """A node of the frozen trie that TopicMatcher builds in compiled mode"""
+
+    __slots__ = ("static_children", "dynamic_children", "route")
+
+    def __init__(
+        self,
+        static_children: Mapping[str, "CompiledNode"],
+        dynamic_children: tuple["CompiledNode", ...],
+        route: Optional[CompiledRoute],
+    ):
+        self.static_children = static_children
+        self.dynamic_children = dynamic_children
+        self.route = route
+
+
 class TopicMatcher(TopicNode):
 
-    def __init__(self, name: str = ""):
+    def __init__(
+        self, name: str = "", compiled: bool = False, route_cache_size: int = 0
+    ):
+        """
+        :param name: The name of the root node
+        :param compiled: Resolve topics against a frozen copy of the route
+            tree, rebuilt lazily whenever routes are added. Lookups walk it
+            iteratively and fill in precomputed route templates, instead of
+            recursing through the tree and substituting strings.
+        :param route_cache_size: How many resolved topics to remember, least
+            recently used first out. 0 disables the cache.
+        """
         super().__init__(name)
-        self.logger = logging.getLogger(__name__)
-        self.logger.setLevel(logging.DEBUG)
-        self.logger.info("TopicMatcher initialized")
+        # Every route in the tree, kept in one place rather than at each
+        # ancestor of its node.
+        self.routes: RouteIndex = {}
+        self.compiled = compiled
+        self.compiled_root: Optional[CompiledNode] = None
+
+        # Concrete topic -> resolved route and bindings, or None for topics
+        # that matched nothing.
+        self.route_cache_size = route_cache_size
+        self.route_cache: OrderedDict[str, Optional[ResolvedRoute]] = OrderedDict()
+        self.route_cache_lock = threading.Lock()
+        # Bumped whenever the tree changes, so that a lookup that raced with
+        # add_route doesn't cache a stale result.
+        self.route_generation = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # Held while the tree is changed or compiled
+        self.tree_lock = threading.RLock()
+        logger.debug("TopicMatcher initialized")
+
+    def add_route(self, route: Route) -> RouteIndex:
+        with self.tree_lock:
+            new_routes = self.insert_route(route)
+            if new_routes:
+                self.routes_changed()
+        return new_routes
 
-    def add_route(self, route: Route) -> dict[str, tuple[list[str], "TopicNode"]]:
+    def remove_route(self, topic: str) -> Optional[Route]:
+        """
+        Removes a route, along with any nodes left with nothing below them.
+        :param topic: The route's topic, as registered
+        :return: The route that was removed, if there was one
+        """
+        with self.tree_lock:
+            route = self.delete_route(topic)
+            if route is not None:
+                self.routes_changed()
+        return route
+
+    def update(
+        self, add: Iterable[Route] = (), remove: Iterable[str] = ()
+    ) -> tuple[RouteIndex, list[Route]]:
+        """
+        Adds and removes routes as a single change. In compiled mode, lookups
+        carry on against the previous compiled tree until the new one has been
+        built, so they never see the change half done.
+        :param add: The routes to add
+        :param remove: The topics of the routes to remove, as registered
+        :return: The routes that were added, keyed by their path; and the
+            routes that were removed
+        """
+        with self.tree_lock:
+            removed = [
+                route
+                for route in (self.delete_route(topic) for topic in remove)
+                if route is not None
+            ]
+            added: RouteIndex = {}
+            for route in add:
+                added.update(self.insert_route(route))
+            if added or removed:
+                self.routes_changed(self.compile() if self.compiled else None)
+        return added, removed
+
+    def insert_route(self, route: Route) -> RouteIndex:
         next_part, *rest = route.topic.lstrip("/").split("/")
-        return self.add_child(next_part, rest, route=route)
+        new_routes = self.add_child(next_part, rest, route=route)
+        self.routes.update(new_routes)
+        return new_routes
+
+    def delete_route(self, topic: str) -> Optional[Route]:
+        entry = self.routes.pop(topic.lstrip("/"), None)
+        if entry is None:
+            return None
+        _, node = entry
+        route, node.route = node.route, None
+        # Prune the branch back to the nearest node still in use.
+        while (
+            node.parent is not None
+            and node.route is None
+            and not node.static_children
+            and not node.dynamic_children
+        ):
+            node.parent.remove_child(node)
+            node = node.parent
+        return route
+
+    def routes_changed(self, compiled_root: Optional[CompiledNode] = None) -> None:
+        """
+        Discards the compiled copy of the tree and anything cached from it,
+        after the tree has changed.
+        :param compiled_root: A compiled copy of the changed tree to use from
+            now on. By default, one is built on the next lookup.
+        """
+        with self.route_cache_lock:
+            self.compiled_root = compiled_root
+            self.route_generation += 1
+            self.route_cache.clear()
 
     def get_route_from_topic(self, topic: str) -> Union[Route, None]:
-        return self.get_route(topic.lstrip("/").split("/"))
+        resolved = self.resolve_topic(topic)
+        return resolved[0] if resolved is not None else None
+
+    def resolve_topic(self, topic: str) -> Optional[ResolvedRoute]:
+        """
+        Finds the route for a concrete topic, along with the values of its
+        path parameters. Results are cached if the route cache is enabled.
+        :param topic: The topic a message was received on
+        :return: The route with its path parameters filled in, and the
+            parameters' values; or None if no route matches.
+        """
+        if self.route_cache_size <= 0:
+            return self.resolve_topic_uncached(topic)
+
+        with self.route_cache_lock:
+            if topic in self.route_cache:
+                self.cache_hits += 1
+                self.route_cache.move_to_end(topic)
+                return self.route_cache[topic]
+            self.cache_misses += 1
+            generation = self.route_generation
+
+        resolved = self.resolve_topic_uncached(topic)
+
+        with self.route_cache_lock:
+            if generation == self.route_generation:
+                self.route_cache[topic] = resolved
+                if len(self.route_cache) > self.route_cache_size:
+                    self.route_cache.popitem(last=False)
+        return resolved
+
+    def resolve_topic_uncached(self, topic: str) -> Optional[ResolvedRoute]:
+        segments = topic.lstrip("/").split("/")
+        if not self.compiled:
+            route, replacements = self.get_route_with_replacements(segments)
+            if route is None:
+                return None
+            return route, {
+                placeholder.strip("{}"): value for placeholder, value in replacements
+            }
+
+        compiled_route = self.match_compiled(segments)
+        if compiled_route is None:
+            return None
+        return compiled_route.resolve(segments), compiled_route.bindings(segments)
+
+    def cache_info(self) -> dict[str, int]:
+        """
+        :return: Route cache statistics, for monitoring
+        """
+        with self.route_cache_lock:
+            return {
+                "hits": self.cache_hits,
+                "misses": self.cache_misses,
+                "size": len(self.route_cache),
+                "capacity": self.route_cache_size,
+            }
+
+    def compile(self) -> CompiledNode:
+        """
+        Builds a frozen copy of the route tree for compiled matching.
+        :return: The root of the compiled tree
+        """
+
+        def compile_node(
+            node: TopicNode, parameters: list[tuple[str, int]]
+        ) -> CompiledNode:
+            depth = len(node.route_path)
+            if node.dynamic:
+                parameters = [*parameters, (node.name, depth - 1)]
+            return CompiledNode(
+                static_children=(
+                    {
+                        name: compile_node(child, parameters)
+                        for name, child in node.static_children.items()
+                    }
+                    or NO_STATIC_CHILDREN
+                ),
+                dynamic_children=tuple(
+                    compile_node(child, parameters) for child in node.dynamic_children
+                ),
+                route=(
+                    CompiledRoute(node.route, parameters)
+                    if node.route is not None
+                    else None
+                ),
+            )
+
+        with self.tree_lock:
+            self.compiled_root = compile_node(self, [])
+            return self.compiled_root
+
+    def match_compiled(self, segments: TopicNodePath) -> Optional[CompiledRoute]:
+        """
+        Finds the compiled route for a topic. Like get_next_matching_node,
+        static children are preferred over dynamic ones, and the search backs
+        out of dead ends; but the walk is iterative and never copies the path.
+        A topic that ends on a node without a route is also treated as a dead
+        end, so a later dynamic sibling still gets its chance to match.
+        :param segments: The topic, split into segments
+        :return: The matching compiled route, if any
+        """
+        root = self.compiled_root
+        if root is None:
+            with self.tree_lock:
+                root = self.compiled_root or self.compile()
+        depth_limit = len(segments)
+        stack: list[tuple[CompiledNode, int]] = [(root, 0)]
+        while stack:
+            node, depth = stack.pop()
+            if depth == depth_limit:
+                if node.route is not None:
+                    return node.route
+                continue
+            # Dynamic children are pushed first, in reverse, so that the static
+            # child is tried first and dynamic ones in the order they were added.
+            for child in reversed(node.dynamic_children):
+                stack.append((child, depth + 1))
+            static_child = node.static_children.get(segments[depth])
+            if static_child is not None:
+                stack.append((static_child, depth + 1))
+        return None
@@ -1,15 +1,25 @@
 import datetime
+import json
+import logging
 import subprocess
 import time
-from typing import Any, Optional
+from typing import Any, Optional, Union
 
+from wlanpi_mqtt_bridge.MQTTBridge import SystemInfo
 from wlanpi_mqtt_bridge.MQTTBridge.models.command_result import CommandResult
 from wlanpi_mqtt_bridge.MQTTBridge.models.runcommand_error import RunCommandError
 
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None  # type: ignore
+
+logger = logging.getLogger(__name__)
+
 
 def run_command(cmd: list, shell=False, raise_on_fail=True) -> CommandResult:
     """Run a single CLI command with subprocess and returns the output"""
-    print("Running command:", cmd)
+    logger.debug("Running command: %s", cmd)
     cp = subprocess.run(
         cmd,
         encoding="utf-8",
@@ -34,7 +44,69 @@ def get_full_class_name(obj: object) -> str:
     return module + "." + obj.__class__.__name__
 
 
+def json_merge_patch(old: Any, new: Any) -> Any:
+    """
+    Builds a JSON merge patch (RFC 7386) that turns `old` into `new`.
+    :param old: The previous JSON-compatible data
+    :param new: The current JSON-compatible data
+    :return: The patch. Keys removed from an object are set to None.
+    """
+    if not isinstance(old, dict) or not isinstance(new, dict):
+        return new
+    patch = {key: None for key in old if key not in new}
+    for key, value in new.items():
+        if key not in old:
+            patch[key] = value
+        elif old[key] != value:
+            patch[key] = json_merge_patch(old[key], value)
+    return patch
+
+
+def json_default(obj: object) -> Any:
+    """Serializes otherwise unsupported objects by their attributes."""
+    return obj.__dict__
+
+
+def json_dumps(data: Any) -> bytes:
+    """
+    Serializes data to compact, UTF-8 encoded JSON, using orjson when it is
+    installed.
+    :param data: The JSON-compatible data to serialize
+    :return: The serialized data
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(
+                data, default=json_default, option=orjson.OPT_NON_STR_KEYS
+            )
+        except orjson.JSONEncodeError:
+            # orjson is stricter than json about some values, such as very
+            # large integers, so let json have a try too.
+            pass
+    return json.dumps(data, default=json_default, separators=(",", ":")).encode("utf-8")
+
+
+def json_loads(data: Union[str, bytes, bytearray]) -> Any:
+    """
+    Parses JSON, using orjson when it is installed.
+    :param data: The JSON text to parse
+    :raises ValueError: If the data is not valid JSON
+    :return: The parsed data
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
 def get_default_gateways() -> dict[str, str]:
+    try:
+        return SystemInfo.read_default_gateways()
+    except (OSError, ValueError) as e:
+        logger.debug("Unable to read default gateways natively: %s", e)
+    return get_default_gateways_from_command()
+
+
+def get_default_gateways_from_command() -> dict[str, str]:
     # Execute 'ip route show' command which lists all network routes
     cmd = "ip route show"
     output = run_command(cmd.split(" ")).output.split("\n")
@@ -43,7 +115,8 @@ def get_default_gateways() -> dict[str, str]:
     for line in output:
         if "default via" in line:  # This is the default gateway line
             res = line.split("via ")[1].split(" dev ")
-            gateways[res[1].strip()] = res[0].strip()
+            # The device may be followed by `proto dhcp metric 202` etc.
+            gateways[res[1].split()[0]] = res[0].strip()
     return gateways
 
 
@@ -57,17 +130,55 @@ def get_model_info() -> dict[str, str]:
 
 
 def get_uptime() -> dict[str, Any]:
+    try:
+        return SystemInfo.read_uptime()
+    except (OSError, ValueError) as e:
+        logger.debug("Unable to read uptime natively: %s", e)
+    return get_uptime_from_command()
+
+
+def get_uptime_from_command() -> dict[str, Any]:
     cmd = "jc uptime"
     return run_command(cmd.split(" ")).output_from_json()
 
 
 def get_interface_ip_addr(interface: Optional[str] = None) -> dict[str, Any]:
+    """
+    Lists interfaces and their addresses, as `ip -j addr show` does.
+    :param interface: Only list this interface
+    :return: The interfaces
+    """
+    try:
+        return SystemInfo.read_interface_addresses(  # type: ignore[return-value]
+            interface.strip() if interface is not None and interface.strip() else None
+        )
+    except (OSError, ValueError) as e:
+        logger.debug("Unable to read interface addresses natively: %s", e)
+    return get_interface_ip_addr_from_command(interface)
+
+
+def get_interface_ip_addr_from_command(
+    interface: Optional[str] = None,
+) -> dict[str, Any]:
     cmd: list[str] = "ip -j addr show".split(" ")
     if interface is not None and interface.strip() != "":
         cmd.append(interface.strip())
     return run_command(cmd).output_from_json()
 
 
+def get_mac_address(interface: str) -> str:
+    try:
+        return SystemInfo.read_mac_address(interface)
+    except (OSError, ValueError) as e:
+        logger.debug("Unable to read MAC address natively: %s", e)
+    return get_mac_address_from_command(interface)
+
+
+def get_mac_address_from_command(interface: str) -> str:
+    interfaces: Any = run_command(["jc", "ifconfig", interface]).output_from_json()
+    return interfaces[0]["mac_addr"]
+
+
 def get_current_unix_timestamp():
     ms = datetime.datetime.now()
     return time.mktime(ms.timetuple()) * 1000
@@ -1,11 +1,20 @@
 import json
 import logging
+from dataclasses import dataclass
 from ssl import VerifyMode
-from typing import Any, Callable, Literal, Optional
+from typing import Any, Callable, Literal, Optional, Union
 
-from requests import JSONDecodeError
+from wlanpi_mqtt_bridge.MQTTBridge.Compression import negotiate
+from wlanpi_mqtt_bridge.MQTTBridge.Utils import (
+    get_current_unix_timestamp,
+    json_dumps,
+    json_loads,
+)
 
-from wlanpi_mqtt_bridge.MQTTBridge.Utils import get_current_unix_timestamp
+logger = logging.getLogger(__name__)
+
+# Marks response data that hasn't been parsed yet.
+_UNPARSED = object()
 
 
 class Route:
@@ -14,6 +23,8 @@ class Route:
     topics for its invocation and response.
     """
 
+    __slots__ = ("route", "topic", "response_topic", "callback", "method")
+
     def __init__(
         self,
         route: str,
@@ -24,32 +35,147 @@ class Route:
             "post", "patch", "head", "options", "put", "delete", "get"
         ] = "get",
     ):
-        self.logger = logging.getLogger(__name__)
         self.route = route
         self.topic = topic
         self.response_topic = response_topic or f"{topic}/_response"
         self.method = method
-        self.callback = callback or self.default_callback
+        # A plain function shared by every route, rather than a bound method
+        # per route.
+        self.callback = callback or Route.default_callback
 
     # noinspection PyUnusedLocal
-    def default_callback(self, *args, **kwargs) -> None:
-        self.logger.info(
-            f"Default do-nothing callback for {self.topic}. You should really"
-            "define one that does something."
+    @staticmethod
+    def default_callback(*args, **kwargs) -> None:
+        logger.info(
+            "Default do-nothing callback for %s. You should really define one "
+            "that does something.",
+            kwargs.get("topic"),
         )
 
     def copy_with(self, **kwargs) -> "Route":
-        new_route = Route(
-            route=self.route,
-            topic=self.topic,
-            response_topic=self.response_topic,
-            callback=self.callback,
-            method=self.method,
-        )
+        fields = {name: getattr(self, name) for name in self.__slots__}
         for key, value in kwargs.items():
-            if hasattr(new_route, key):
-                setattr(new_route, key, value)
-        return new_route
+            if key in fields:
+                fields[key] = value
+        return Route(**fields)
+
+
+class BridgeRequest:
+    """
+    An inbound MQTT command that has been matched to a route, with the
+    bridge-specific fields separated out from the payload bound for the
+    REST API.
+    """
+
+    def __init__(
+        self,
+        route: Route,
+        payload: Optional[Any] = None,
+        query_params: Optional[Any] = None,
+        bridge_ident: Optional[Any] = None,
+        target: Optional[Any] = None,
+        stream: bool = False,
+        compression: Optional[str] = None,
+        response_topic: Optional[str] = None,
+        correlation_data: Optional[bytes] = None,
+    ):
+        self.route = route
+        self.payload = payload
+        self.query_params = query_params
+        self.bridge_ident = bridge_ident
+        # Which devices should answer a broadcast command, see
+        # `BroadcastPolicy`
+        self.target = target
+        # Whether the response should be relayed in chunks, see
+        # `ResponseStream`
+        self.stream = stream
+        # The encoding to compress the response with, if any
+        self.compression = compression
+        # Where to answer instead of the route's response topic, and what to
+        # echo back with the answer, from the Response Topic and Correlation
+        # Data properties of an MQTT v5 command
+        self.response_topic = response_topic
+        self.correlation_data = correlation_data
+
+    @staticmethod
+    def reply_fields(properties: Optional[Any]) -> dict[str, Any]:
+        """
+        :param properties: The MQTT v5 properties the command was sent with,
+            if any
+        :return: Its Response Topic and Correlation Data, as keyword
+            arguments. A response topic with wildcards can't be published to,
+            so it's left out and the route's response topic is used instead.
+        """
+        if properties is None:
+            return {}
+        fields: dict[str, Any] = {}
+        response_topic = getattr(properties, "ResponseTopic", None)
+        if response_topic:
+            if "+" in response_topic or "#" in response_topic:
+                logger.warning("Ignoring wildcard response topic '%s'", response_topic)
+            else:
+                fields["response_topic"] = response_topic
+        correlation_data = getattr(properties, "CorrelationData", None)
+        if correlation_data is not None:
+            fields["correlation_data"] = correlation_data
+        return fields
+
+    @classmethod
+    def from_payload(
+        cls,
+        route: Route,
+        raw_payload: Optional[Union[str, bytes]],
+        properties: Optional[Any] = None,
+    ) -> "BridgeRequest":
+        """
+        Parses a raw MQTT payload into a request.
+        :param route: The route the message was received on
+        :param raw_payload: The MQTT message payload, expected to be empty or
+            a JSON object.
+        :param properties: The message's MQTT v5 properties, if any
+        :return: The parsed request
+        """
+        reply = cls.reply_fields(properties)
+        if raw_payload is None or raw_payload in ["", b""]:
+            return cls(route, **reply)
+
+        payload = json.loads(raw_payload)
+        bridge_ident = payload.pop("_bridge_ident", None)
+        query_params = payload.pop("_query_params", None)
+        target = payload.pop("_target", None)
+        stream = payload.pop("_stream", False)
+        compression = negotiate(payload.pop("_compression", None))
+        return cls(
+            route,
+            payload=payload or None,
+            query_params=query_params,
+            bridge_ident=bridge_ident,
+            target=target,
+            stream=stream is True,
+            compression=compression,
+            **reply,
+        )
+
+    @property
+    def reply_topic(self) -> str:
+        """The topic to answer the command on"""
+        return self.response_topic or self.route.response_topic
+
+    @property
+    def is_get(self) -> bool:
+        return self.route.method.lower() == "get"
+
+    @property
+    def data(self) -> Optional[Any]:
+        """The body to send to the REST API"""
+        return self.payload if not self.is_get else None
+
+    @property
+    def params(self) -> Optional[Any]:
+        """The query parameters to send to the REST API"""
+        if self.is_get and not self.query_params:
+            return self.payload
+        return self.query_params
 
 
 class MQTTResponse:
@@ -58,6 +184,11 @@ class MQTTResponse:
     failures, REST failures, and the response data. Additionally, it
     tries to parse the response data into JSON but will return the
     original data in case of failure.
+
+    Data that arrives as JSON text is copied into the serialized response
+    as-is rather than being parsed and serialized again. With
+    `trusted_json`, it's only checked to be valid, and the parsed copy isn't
+    kept unless `data` is read.
     """
 
     def __init__(
@@ -70,49 +201,112 @@ class MQTTResponse:
         rest_status: Optional[int] = None,
         rest_reason: Optional[str] = None,
         bridge_ident: Optional[Any] = None,
+        trusted_json: bool = False,
+        stream: Optional[dict[str, Any]] = None,
     ):
-        self.logger = logging.getLogger(__name__)
-        if errors is None:
-            self.errors: list = []
+        self.errors: list = errors if errors is not None else []
         self.status = status
-        self.data = data
         self.rest_status = rest_status
         self.rest_reason = rest_reason
         self._bridge_ident = bridge_ident
+        # Describes the chunks the data was sent in instead, if it was
+        # streamed
+        self._stream = stream
         self.published_at = get_current_unix_timestamp()
-        self.is_hydrated_object = False
+        self.is_hydrated_object = True
+
+        # The data's JSON text, when it's known to be valid and can be used
+        # verbatim.
+        self._raw_data: Optional[bytes] = None
+        self._data: Any = data
 
-        # Try to parse data into json, but don't fret if we can't.
-        if type(data) in [str, bytes, bytearray]:
+        if isinstance(data, (str, bytes, bytearray)):
+            raw = data.encode("utf-8") if isinstance(data, str) else bytes(data)
+            if trusted_json:
+                # A body labelled as JSON may still not be, and splicing it
+                # in as-is would corrupt the whole response.
+                try:
+                    json_loads(raw)
+                    self._raw_data = raw
+                    self._data = _UNPARSED
+                    return
+                except ValueError:
+                    pass
+            # Try to parse data into json, but don't fret if we can't.
             try:
-                self.data = json.loads(data)
-                self.is_hydrated_object = True
-            except (JSONDecodeError, json.decoder.JSONDecodeError) as e:
-                self.logger.debug(
-                    f"Tried to decode data as JSON but it was not valid: {str(e)}"
-                )
-                self.logger.debug(data)
-        else:
-            # We're going to assume in this case it's some kind of
-            # JSON-compatible structure.
-            self.is_hydrated_object = True
+                self._data = json_loads(raw)
+                self._raw_data = raw
+            except ValueError as e:
+                logger.debug("Tried to decode data as JSON but it was not valid: %s", e)
+                self.is_hydrated_object = False
+                if not isinstance(data, str):
+                    self._data = raw.decode("utf-8", errors="replace")
+        # Otherwise, we're going to assume it's some kind of JSON-compatible
+        # structure.
 
-    def to_json(self) -> str:
-        res = json.dumps(
-            {
-                i: self.__dict__[i]
-                for i in self.__dict__
-                if (
-                    (i not in ["logger", "_bridge_ident"])
-                    or (i == "_bridge_ident" and self.__dict__[i])
-                )
-            },
-            default=lambda o: o.__dict__,
-            # sort_keys=True,
-            # indent=4,
+    @classmethod
+    def from_core_response(
+        cls,
+        response,
+        bridge_ident: Optional[Any] = None,
+        status: Optional[
+            Literal["success", "bridge_error", "rest_error", "other_error"]
+        ] = None,
+    ) -> "MQTTResponse":
+        """
+        Wraps a response from the core. Bodies the core labels as JSON are
+        passed through without being parsed.
+        :param response: The core's response
+        :param bridge_ident: The identifier sent with the command, if any
+        :param status: The response status. By default, this is based on the
+            REST status.
+        :return: The new response
+        """
+        content_type = response.headers.get("Content-Type") or ""
+        return cls(
+            data=response.content,
+            status=status or ("success" if response.ok else "rest_error"),
+            rest_status=response.status_code,
+            rest_reason=response.reason,
+            bridge_ident=bridge_ident,
+            trusted_json=content_type.startswith("application/json"),
         )
-        print(res)
-        return res
+
+    @property
+    def data(self) -> Any:
+        if self._data is _UNPARSED:
+            self._data = json_loads(self._raw_data)  # type: ignore[arg-type]
+        return self._data
+
+    @data.setter
+    def data(self, value: Any) -> None:
+        self._data = value
+        self._raw_data = None
+
+    def to_bytes(self) -> bytes:
+        """
+        Serializes the response to UTF-8 encoded JSON.
+        :return: The serialized response
+        """
+        data = self._raw_data
+        if data is None:
+            data = json_dumps(self._data)
+        head = json_dumps({"errors": self.errors, "status": self.status})
+        tail_fields: dict[str, Any] = {
+            "rest_status": self.rest_status,
+            "rest_reason": self.rest_reason,
+        }
+        if self._bridge_ident:
+            tail_fields["_bridge_ident"] = self._bridge_ident
+        if self._stream is not None:
+            tail_fields["_stream"] = self._stream
+        tail_fields["published_at"] = self.published_at
+        tail_fields["is_hydrated_object"] = self.is_hydrated_object
+        tail = json_dumps(tail_fields)
+        return b"".join((head[:-1], b',"data":', data, b",", tail[1:]))
+
+    def to_json(self) -> str:
+        return self.to_bytes().decode("utf-8")
 
 
 class TLSConfig:
@@ -135,15 +329,86 @@ class TLSConfig:
         self.keyfile_password = keyfile_password
 
 
+@dataclass
 class BridgeConfig:
-    def __init__(
-        self,
-        mqtt_server: str,
-        mqtt_port: int,
-        identifier: str,
-        tls_config: Optional[TLSConfig] = None,
-    ):
-        self.mqtt_server = mqtt_server
-        self.mqtt_port = mqtt_port
-        self.identifier = identifier
-        self.tls_config = tls_config
+    """
+    Everything the bridge can be configured with, and its defaults. Read from
+    the config file by `get_config`, where each section of it is documented.
+    """
+
+    # [MQTT] and [MQTT_TLS]
+    mqtt_server: str = "wi.fi"
+    mqtt_port: int = 1883
+    identifier: Optional[str] = None
+    tls_config: Optional[TLSConfig] = None
+    mqtt_protocol: str = "3.1.1"
+    response_expiry: int = 60
+    topic_alias_maximum: int = 16
+
+    # [DISPATCH]
+    dispatch_workers: int = 4
+    dispatch_queue_depth: int = 64
+    dispatch_timeout: float = 1.0
+    route_cache_size: int = 256
+
+    # [CORE]
+    wlan_pi_core_base_url: str = "http://127.0.0.1:31415"
+    core_socket_path: Optional[str] = None
+    core_pool_size: Optional[int] = None
+    core_connect_timeout: float = 3.0
+    core_read_timeout: float = 30.0
+    core_coalesce_gets: bool = True
+    openapi_cache_path: Optional[str] = "/var/cache/wlanpi-mqtt-bridge/openapi.json"
+    route_snapshot_path: Optional[str] = "/var/cache/wlanpi-mqtt-bridge/routes.json"
+    openapi_check_interval: float = 300.0
+
+    # [CACHE]
+    cache_max_entries: int = 256
+    cache_default_ttl: float = 0.0
+    cache_ttls: Optional[dict[str, float]] = None
+
+    # [PUBLISHING]
+    force_refresh_interval: float = 300.0
+    publish_patches: bool = False
+
+    # [POLLING]
+    default_poll_interval: float = 10.0
+    poll_intervals: Optional[dict[str, float]] = None
+    poll_jitter: bool = True
+    poll_workers: int = 2
+    netlink_events: bool = True
+    netlink_debounce: float = 0.5
+
+    # [BROADCAST]
+    broadcast_spread: float = 0.0
+    broadcast_max_spread: float = 60.0
+    broadcast_sample_rate: float = 1.0
+    tags: Optional[list[str]] = None
+
+    # [METRICS]
+    metrics_host: str = "127.0.0.1"
+    metrics_port: int = 0
+    metrics_publish_interval: float = 60.0
+
+    # [PROFILING]
+    profiling_enabled: bool = False
+    profile_on_start: float = 0.0
+    profile_dir: str = "/var/log/wlanpi-mqtt-bridge"
+    profile_interval: float = 0.01
+    profile_max_duration: float = 60.0
+
+    # [STREAMING]
+    stream_chunk_size: int = 65536
+    stream_routes: Optional[list[str]] = None
+
+    # [COMPRESSION]
+    compression_min_size: int = 512
+    compressed_topics: Optional[dict[str, str]] = None
+
+    # [LOGGING]
+    log_rate_limit: float = 20.0
+    log_burst: int = 100
+
+    # [SUBSCRIPTIONS]
+    subscription_batch_size: int = 100
+    subscription_collapse_depth: int = 0
@@ -10,6 +10,7 @@ from typing import Optional, Union
 
 # app imports
 from .__version__ import __description__, __version__
+from .MQTTBridge.AsyncBridge import AsyncBridge
 from .MQTTBridge.Bridge import Bridge
 from .utils import get_config
 
@@ -36,6 +37,31 @@ def setup_parser() -> argparse.ArgumentParser:
 
     parser.add_argument("--port", "-p", dest="port", action="store", default=None)
     parser.add_argument("--identifier", dest="identifier", action="store", default=None)
+    parser.add_argument(
+        "--engine",
+        dest="engine",
+        choices=["threaded", "asyncio"],
+        default="threaded",
+        help="Run the bridge on Paho's network thread and a worker pool "
+        "(threaded), or on a single asyncio event loop (asyncio)",
+    )
+
+    parser.add_argument(
+        "--profile",
+        dest="profile",
+        metavar="SECONDS",
+        type=float,
+        default=None,
+        help="Sample every thread's stack for SECONDS after starting, and write "
+        "the profile to the profiling directory",
+    )
+    parser.add_argument(
+        "--profiling",
+        dest="profiling",
+        action="store_true",
+        default=False,
+        help="Take profiles when asked to on our $SYS/profile topic",
+    )
 
     parser.add_argument(
         "--version", "-V", "-v", action="version", version=f"{__version__}"
@@ -52,12 +78,17 @@ def main():
     config = get_config(CONFIG_FILE)
 
     if args.server is not None:
-        config.server = args.server
+        config.mqtt_server = args.server
     if args.port is not None:
-        config.port = args.port
+        config.mqtt_port = args.port
+    if args.profile is not None:
+        config.profile_on_start = args.profile
+    if args.profiling:
+        config.profiling_enabled = True
 
     logging.info(f"Configuring bridge with {config.__dict__}")
-    bridge = Bridge(**config.__dict__)
+    bridge_class = AsyncBridge if args.engine == "asyncio" else Bridge
+    bridge = bridge_class(config)
 
     # noinspection PyUnusedLocal
     def signal_handler(
@@ -66,13 +97,21 @@ def main():
         logger.info("Caught signal {}".format(sig))
         if sig == signal.SIGINT:
             bridge.stop()
-            sys.exit(0)
+            # The asyncio engine finishes stopping on its loop once we return,
+            # then `go` returns.
+            if not isinstance(bridge, AsyncBridge):
+                sys.exit(0)
+
+        if sig == signal.SIGUSR1:
+            logger.info("SIGUSR1 detected, checking the core's API for changes")
+            bridge.check_openapi_definition()
 
         if sig == signal.SIGHUP:
             logger.info("SIGHUP detected, reloading config and restarting daemon")
             bridge.stop()
 
     signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGUSR1, signal_handler)
     return bridge.go()
 
 
@@ -1,13 +1,12 @@
-import json
 import logging
 import os
-import subprocess
 from ssl import VerifyMode
+from typing import Any
 
 import toml
 
 from wlanpi_mqtt_bridge.MQTTBridge.structures import BridgeConfig, TLSConfig
-from wlanpi_mqtt_bridge.MQTTBridge.Utils import get_default_gateways
+from wlanpi_mqtt_bridge.MQTTBridge.Utils import get_default_gateways, get_mac_address
 
 logger = logging.getLogger()
 
@@ -34,12 +33,7 @@ def get_config(filepath) -> BridgeConfig:
     if mqtt_server in ["<gateway>", "", None]:
         mqtt_server = get_default_gateways()["eth0"]
 
-    eth0_res = subprocess.run(
-        "jc ifconfig eth0", capture_output=True, text=True, shell=True
-    )
-
-    eth0_data = json.loads(eth0_res.stdout)[0]
-    eth0_mac = eth0_data["mac_addr"]
+    eth0_mac = get_mac_address("eth0")
 
     # TLS configuration
     # logger.debug("Checking TLS data")
@@ -65,6 +59,151 @@ def get_config(filepath) -> BridgeConfig:
             keyfile_password=tls_data.get("keyfile_password", None),
         )
 
+    options: dict[str, Any] = {}
+    options.update(
+        options_from(
+            mqtt_config,
+            mqtt_protocol="protocol",
+            response_expiry="response_expiry",
+            topic_alias_maximum="topic_alias_maximum",
+        )
+    )
+    # Inbound command dispatch
+    options.update(
+        options_from(
+            config.get("DISPATCH", {}),
+            dispatch_workers="workers",
+            dispatch_queue_depth="max_queue_depth",
+            dispatch_timeout="queue_timeout",
+            route_cache_size="route_cache_size",
+        )
+    )
+    # Connection to wlanpi-core
+    options.update(
+        options_from(
+            config.get("CORE", {}),
+            wlan_pi_core_base_url="base_url",
+            core_socket_path="socket_path",
+            core_pool_size="pool_size",
+            core_connect_timeout="connect_timeout",
+            core_read_timeout="read_timeout",
+            core_coalesce_gets="coalesce_gets",
+            openapi_cache_path="openapi_cache_path",
+            route_snapshot_path="route_snapshot_path",
+            openapi_check_interval="openapi_check_interval",
+        )
+    )
+    # Caching of core responses
+    options.update(
+        options_from(
+            config.get("CACHE", {}),
+            cache_max_entries="max_entries",
+            cache_default_ttl="default_ttl",
+            cache_ttls="ttls",
+        )
+    )
+    # Periodic publishing
+    options.update(
+        options_from(
+            config.get("PUBLISHING", {}),
+            force_refresh_interval="force_refresh_interval",
+            publish_patches="publish_patches",
+        )
+    )
+    options.update(
+        options_from(
+            config.get("POLLING", {}),
+            default_poll_interval="default_interval",
+            poll_intervals="intervals",
+            poll_jitter="jitter",
+            poll_workers="workers",
+            netlink_events="netlink_events",
+            netlink_debounce="netlink_debounce",
+        )
+    )
+    # Commands broadcast to the whole fleet
+    options.update(
+        options_from(
+            config.get("BROADCAST", {}),
+            broadcast_spread="spread",
+            broadcast_max_spread="max_spread",
+            broadcast_sample_rate="sample_rate",
+            tags="tags",
+        )
+    )
+    # Runtime metrics
+    options.update(
+        options_from(
+            config.get("METRICS", {}),
+            metrics_host="host",
+            metrics_port="port",
+            metrics_publish_interval="publish_interval",
+        )
+    )
+    # Profiling on request
+    options.update(
+        options_from(
+            config.get("PROFILING", {}),
+            profiling_enabled="enabled",
+            profile_dir="dir",
+            profile_interval="interval",
+            profile_max_duration="max_duration",
+        )
+    )
+    # Relaying large responses in chunks
+    options.update(
+        options_from(
+            config.get("STREAMING", {}),
+            stream_chunk_size="chunk_size",
+            stream_routes="routes",
+        )
+    )
+    # Compressing what we publish
+    options.update(
+        options_from(
+            config.get("COMPRESSION", {}),
+            compression_min_size="min_size",
+            compressed_topics="topics",
+        )
+    )
+    # Logging
+    options.update(
+        options_from(
+            config.get("LOGGING", {}),
+            log_rate_limit="rate_limit",
+            log_burst="burst",
+        )
+    )
+    # MQTT subscriptions
+    options.update(
+        options_from(
+            config.get("SUBSCRIPTIONS", {}),
+            subscription_batch_size="batch_size",
+            subscription_collapse_depth="collapse_depth",
+        )
+    )
+
+    if "mqtt_protocol" in options:
+        options["mqtt_protocol"] = str(options["mqtt_protocol"])
+    # An empty path turns what it's for off.
+    for name in ("core_socket_path", "openapi_cache_path", "route_snapshot_path"):
+        if name in options:
+            options[name] = options[name] or None
+
     return BridgeConfig(
-        mqtt_server, mqtt_port, identifier=eth0_mac, tls_config=tls_config
+        mqtt_server=mqtt_server,
+        mqtt_port=mqtt_port,
+        identifier=eth0_mac,
+        tls_config=tls_config,
+        **options,
     )
+
+
+def options_from(section: dict, **keys: str) -> dict[str, Any]:
+    """
+    :param section: A section of the config file
+    :param keys: The section's keys, by the `BridgeConfig` field each sets
+    :return: The fields whose keys are set in the section. The rest keep
+        `BridgeConfig`'s defaults.
+    """
+    return {field: section[key] for field, key in keys.items() if key in section}